@@ -1,7 +1,10 @@
-import json
 import pandas as pd
 import os
 import logging
+from es_reader import read_aggregation_output
+from report_writer import ReportWriter
+from table_cache import cached_table
+from flatten_aggs import Columns
 
 log_dir = '/app/logs'
 log_file = os.path.join(log_dir, '9_heating_installation_null_mediums.log')
@@ -12,45 +15,33 @@ if not os.path.exists(log_dir):
 logging.basicConfig(filename=log_file, level=logging.INFO, 
                     format='%(asctime)s - %(levelname)s - %(message)s')
 
+@cached_table
 def parse_elasticsearch_output(file_path):
-    with open(file_path, 'r') as file:
-        data = json.load(file)
+    data, buckets = read_aggregation_output(file_path)
     
     total_hits = data['hits']['total']['value']
     logging.info(f"Total buildings with heating installation 9 and null heating medium: {total_hits}")
 
-    results = []
+    columns = Columns(['municipality_code', 'unit_usage', 'heating_medium', 'count'],
+                      categorical=['municipality_code', 'unit_usage', 'heating_medium'])
     
     # Loop through municipality buckets
-    for municipality in data['aggregations']['municipalities']['buckets']:
+    for municipality in buckets:
         municipality_code = municipality['key']
         municipality_count = municipality['doc_count']
 
         units_usage_total = sum(usage['doc_count'] for usage in municipality['units_usage']['buckets'])
         
         if municipality_count > units_usage_total:
-            results.append({
-                'municipality_code': municipality_code,
-                'unit_usage': 'No specific usage',
-                'heating_medium': 'No medium',
-                'count': municipality_count - units_usage_total
-            })
+            columns.append(municipality_code, 'No specific usage', 'No medium', municipality_count - units_usage_total)
 
         # Loop through unit usage buckets inside the municipality
         for usage in municipality['units_usage']['buckets']:
-            usage_code = usage['key']
-            usage_count = usage['doc_count']
-            
-            results.append({
-                'municipality_code': municipality_code,
-                'unit_usage': usage_code,
-                'heating_medium': 'No medium',
-                'count': usage_count
-            })
-
-    return pd.DataFrame(results)
+            columns.append(municipality_code, usage['key'], 'No medium', usage['doc_count'])
 
-if __name__ == "__main__":
+    return columns.to_frame()
+
+def main():
     try:
         input_file = os.environ.get('INPUT_FILE', '9_heating_installation_null_mediums.txt')
         output_file = os.environ.get('OUTPUT_FILE', '9_heating_installation_null_mediums.xlsx')
@@ -65,8 +56,8 @@ if __name__ == "__main__":
 
         # Calculate summary statistics
         total_buildings = df['count'].sum()
-        buildings_by_usage = df.groupby('unit_usage')['count'].sum().sort_values(ascending=False)
-        buildings_by_municipality = df.groupby('municipality_code')['count'].sum().sort_values(ascending=False)
+        buildings_by_usage = df.groupby('unit_usage', observed=True)['count'].sum().sort_values(ascending=False)
+        buildings_by_municipality = df.groupby('municipality_code', observed=True)['count'].sum().sort_values(ascending=False)
 
         # Prepare summary data
         summary_data = [
@@ -79,9 +70,9 @@ if __name__ == "__main__":
 
         # Save to Excel
         output_path = f"/app/output/{output_file}"
-        with pd.ExcelWriter(output_path, engine='openpyxl') as writer:
-            df.to_excel(writer, sheet_name='Detailed Data', index=False)
-            summary_df.to_excel(writer, sheet_name='Summary', index=False)
+        with ReportWriter(output_path) as writer:
+            writer.write_sheet(df, 'Detailed Data')
+            writer.write_sheet(summary_df, 'Summary')
 
         logging.info(f"Results saved to {output_path}")
 
@@ -89,4 +80,7 @@ if __name__ == "__main__":
         logging.error(f"Error: {str(e)}")
         raise
 
-    logging.info("Script completed successfully")
\ No newline at end of file
+    logging.info("Script completed successfully")
+
+if __name__ == "__main__":
+    main()
@@ -1,7 +1,9 @@
-import json
-import pandas as pd
 import os
 import logging
+from es_reader import read_search_output, resolve_data_file
+from report_writer import ReportWriter
+from table_cache import cached_table
+from flatten_aggs import Columns
 
 log_dir = '/app/logs'
 log_file = os.path.join(log_dir, 'address_9_heating_installation_null_mediums_query.log')
@@ -12,17 +14,17 @@ if not os.path.exists(log_dir):
 logging.basicConfig(filename=log_file, level=logging.INFO, 
                     format='%(asctime)s - %(levelname)s - %(message)s')
 
+@cached_table
 def parse_elasticsearch_output(file_path):
-    with open(file_path, 'r') as file:
-        data = json.load(file)
+    data, hits = read_search_output(file_path)
     
     total_hits = data['hits']['total']['value']
     logging.info(f"Total addresses returned: {total_hits}")
 
-    results = []
+    columns = Columns(['Address', 'Unit Usage', 'Supplementary Heating'], categorical=['Unit Usage', 'Supplementary Heating'])
     
     # Process each result (each hit)
-    for hit in data['hits']['hits']:
+    for hit in hits:
         source = hit['_source']
         
         # Extract address, unit usage, and supplementary heating
@@ -30,22 +32,18 @@ def parse_elasticsearch_output(file_path):
         unit_usage = source.get('bbr_unit.enh020_units_usage', 'N/A')
         supplementary_heating = source.get('bbr_building.byg058_supplementary_heating', 'N/A')
         
-        # Add to results list
-        results.append({
-            'Address': address,
-            'Unit Usage': unit_usage,
-            'Supplementary Heating': supplementary_heating
-        })
+        # Add to the columns
+        columns.append(address, unit_usage, supplementary_heating)
     
-    # Convert results to a Pandas DataFrame
-    return pd.DataFrame(results)
+    # Build the DataFrame from the columns
+    return columns.to_frame()
 
-if __name__ == "__main__":
+def main():
     try:
         input_file = os.environ.get('INPUT_FILE', 'address_9_heating_installation_null_mediums_query.txt')
         output_file = os.environ.get('OUTPUT_FILE', 'address_9_heating_installation_null_mediums_query.xlsx')
 
-        file_path = f"/app/data/{input_file}"
+        file_path = resolve_data_file(f"/app/data/{input_file}")
         
         if not os.path.exists(file_path):
             logging.error(f"Input file not found at {file_path}")
@@ -57,8 +55,8 @@ if __name__ == "__main__":
 
         # Save results to Excel
         output_path = f"/app/output/{output_file}"
-        with pd.ExcelWriter(output_path, engine='openpyxl') as writer:
-            df.to_excel(writer, sheet_name='Address Data', index=False)
+        with ReportWriter(output_path) as writer:
+            writer.write_sheet(df, 'Address Data')
         
         logging.info(f"Results saved to {output_path}")
 
@@ -67,3 +65,6 @@ if __name__ == "__main__":
         raise
 
     logging.info("Script completed successfully")
+
+if __name__ == "__main__":
+    main()
@@ -1,23 +1,25 @@
-import json
-import pandas as pd
 import os
 import logging
+from es_reader import read_search_output, resolve_data_file
+from report_writer import ReportWriter
+from table_cache import cached_table
+from flatten_aggs import Columns
 
 logging.basicConfig(filename='/app/logs/address_brændeovn_pejs_query.log', level=logging.INFO, 
                     format='%(asctime)s - %(levelname)s - %(message)s')
 
+@cached_table
 def parse_elasticsearch_output(file_path):
     # Load the Elasticsearch JSON output from the file
-    with open(file_path, 'r') as file:
-        data = json.load(file)
+    data, hits = read_search_output(file_path)
     
-    results = []
+    columns = Columns(['Address', 'Unit Usage', 'Sup heating'], categorical=['Unit Usage', 'Sup heating'])
     
     total_hits = data['hits']['total']['value']
     logging.info(f"Total hits: {total_hits}")
     
     # Process each result from the Elasticsearch output
-    for hit in data['hits']['hits']:
+    for hit in hits:
         source = hit['_source']
         
         # Extract the address, unit usage, and unit area
@@ -25,26 +27,22 @@ def parse_elasticsearch_output(file_path):
         unit_usage = source.get('bbr_unit.enh020_units_usage', 'N/A')
         Sup_heating = source.get('bbr_building.byg058_supplementary_heating', 'N/A')
         
-        # Append the results
-        results.append({
-            'Address': address,
-            'Unit Usage': unit_usage,
-            'Sup heating': Sup_heating
-        })
+        # Append to the columns
+        columns.append(address, unit_usage, Sup_heating)
     
-    return pd.DataFrame(results)
+    return columns.to_frame()
     
     # Add percentage of total hits
     df['Percentage of Total'] = (1 / total_hits) * 100
     
     return df
 
-if __name__ == "__main__":
+def main():
     try:
         input_file = os.environ.get('INPUT_FILE', 'address_brændeovn_pejs_query.txt')
         output_file = os.environ.get('OUTPUT_FILE', 'address_brændeovn_pejs_query.xlsx')
 
-        file_path = f"/app/data/{input_file}"
+        file_path = resolve_data_file(f"/app/data/{input_file}")
         
         if not os.path.exists(file_path):
             logging.error(f"Input file not found at {file_path}")
@@ -62,8 +60,8 @@ if __name__ == "__main__":
 
         # Save to Excel
         output_path = f"/app/output/{output_file}"
-        with pd.ExcelWriter(output_path, engine='openpyxl') as writer:
-            df.to_excel(writer, sheet_name='Address Data', index=False)
+        with ReportWriter(output_path) as writer:
+            writer.write_sheet(df, 'Address Data')
         
         logging.info(f"Results saved to {output_path}")
 
@@ -72,3 +70,6 @@ if __name__ == "__main__":
         raise
 
     logging.info("Script completed successfully")
+
+if __name__ == "__main__":
+    main()
@@ -1,7 +1,10 @@
-import json
 import pandas as pd
 import os
 import logging
+from es_reader import read_search_output, resolve_data_file
+from report_writer import ReportWriter
+from table_cache import cached_table
+from flatten_aggs import Columns
 import time
 
 log_dir = '/app/logs'
@@ -13,10 +16,10 @@ if not os.path.exists(log_dir):
 logging.basicConfig(filename=log_file, level=logging.INFO, 
                     format='%(asctime)s - %(levelname)s - %(message)s')
 
+@cached_table
 def parse_elasticsearch_output(file_path):
     # Load Elasticsearch output from file
-    with open(file_path, 'r') as file:
-        data = json.load(file)
+    data, hits = read_search_output(file_path)
     
     # Check if query timed out and log a warning
     if data.get('timed_out'):
@@ -25,7 +28,7 @@ def parse_elasticsearch_output(file_path):
     total_hits = data['hits']['total']['value']
     logging.info(f"Total buildings with energy label and year of construction: {total_hits}")
 
-    results = []
+    columns = Columns(['Address', 'Energy Label', 'Construction Year'], categorical=['Energy Label'])
     
     # If total_hits is zero, explicitly log that no data matches the criteria
     if total_hits == 0:
@@ -33,22 +36,18 @@ def parse_elasticsearch_output(file_path):
         return pd.DataFrame()  # Return an empty DataFrame
     
     # Process the hits and extract the address, energy label, and year of construction
-    for hit in data['hits']['hits']:
+    for hit in hits:
         source = hit['_source']
         
         address = source.get('dar_address.address_designation', 'N/A')
         energy_label = source.get('emoweb_energy_label.current_energy_label', 'N/A')
         construction_year = source.get('bbr_building.byg026_year_of_construction', 'N/A')
         
-        # Append to results
-        results.append({
-            'Address': address,
-            'Energy Label': energy_label,
-            'Construction Year': construction_year
-        })
+        # Append to the columns
+        columns.append(address, energy_label, construction_year)
 
-    # Convert results to a Pandas DataFrame
-    return pd.DataFrame(results)
+    # Build the DataFrame from the columns
+    return columns.to_frame()
 
 def retry_query(file_path, max_retries=3, delay=10):
     """Retry logic for parsing Elasticsearch query."""
@@ -62,12 +61,12 @@ def retry_query(file_path, max_retries=3, delay=10):
                 raise
             time.sleep(delay)
 
-if __name__ == "__main__":
+def main():
     try:
         input_file = os.environ.get('INPUT_FILE', 'address_energy_labels_year_of_construction_query.txt')
         output_file = os.environ.get('OUTPUT_FILE', 'address_energy_labels_year_of_construction_query.xlsx')
 
-        file_path = f"/app/data/{input_file}"
+        file_path = resolve_data_file(f"/app/data/{input_file}")
         
         if not os.path.exists(file_path):
             logging.error(f"Input file not found at {file_path}")
@@ -83,8 +82,8 @@ if __name__ == "__main__":
 
         # Save results to Excel (even if empty)
         output_path = f"/app/output/{output_file}"
-        with pd.ExcelWriter(output_path, engine='openpyxl') as writer:
-            df.to_excel(writer, sheet_name='Energy Labels & Construction Year', index=False)
+        with ReportWriter(output_path) as writer:
+            writer.write_sheet(df, 'Energy Labels & Construction Year')
 
         logging.info(f"Results saved to {output_path}")
 
@@ -93,3 +92,6 @@ if __name__ == "__main__":
         raise
 
     logging.info("Script completed successfully")
+
+if __name__ == "__main__":
+    main()
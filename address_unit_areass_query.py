@@ -1,16 +1,19 @@
 import json
-import pandas as pd
 import os
 import sys
 import logging
+from es_reader import read_search_output, resolve_data_file
+from report_writer import ReportWriter
+from table_cache import cached_table
+from flatten_aggs import Columns
 
 logging.basicConfig(filename='/app/logs/address_unit_areass_query.log', level=logging.INFO, 
                     format='%(asctime)s - %(levelname)s - %(message)s')
 
+@cached_table
 def parse_elasticsearch_output(file_path):
     # Load the Elasticsearch JSON output from the file
-    with open(file_path, 'r') as file:
-        data = json.load(file)
+    data, hits = read_search_output(file_path)
     
     # Check for errors in the Elasticsearch query response
     if 'error' in data:
@@ -18,10 +21,10 @@ def parse_elasticsearch_output(file_path):
         logging.error(json.dumps(data['error'], indent=2))
         return None
     
-    results = []
+    columns = Columns(['Address', 'Unit Usage', 'Unit Area'], categorical=['Unit Usage'])
     
     # Process each result from the Elasticsearch output
-    for hit in data['hits']['hits']:
+    for hit in hits:
         source = hit['_source']
         
         # Extract the address, unit usage, and unit area
@@ -29,22 +32,18 @@ def parse_elasticsearch_output(file_path):
         unit_usage = source.get('bbr_unit.enh020_units_usage', 'N/A')
         unit_area = source.get('bbr_unit.enh026_unit_total_area', 'N/A')
         
-        # Append the results
-        results.append({
-            'Address': address,
-            'Unit Usage': unit_usage,
-            'Unit Area': unit_area
-        })
+        # Append to the columns
+        columns.append(address, unit_usage, unit_area)
     
-    return pd.DataFrame(results)
+    return columns.to_frame()
 
-if __name__ == "__main__":
+def main():
     try:
         input_file = os.environ.get('INPUT_FILE', 'address_unit_areass_query.txt')
         output_file = os.environ.get('OUTPUT_FILE', 'address_unit_areass_query.xlsx')
 
         # Construct the file path for the input file
-        file_path = f"/app/data/{input_file}"
+        file_path = resolve_data_file(f"/app/data/{input_file}")
         
         # Check if the input file exists
         if not os.path.exists(file_path):
@@ -65,8 +64,8 @@ if __name__ == "__main__":
 
         # Save the results to an Excel file
         output_path = f"/app/output/{output_file}"
-        with pd.ExcelWriter(output_path, engine='openpyxl') as writer:
-            df.to_excel(writer, sheet_name='Addresses', index=False)
+        with ReportWriter(output_path) as writer:
+            writer.write_sheet(df, 'Addresses')
 
         logging.info(f"Results saved to {output_path}")
 
@@ -75,3 +74,6 @@ if __name__ == "__main__":
         raise
 
     logging.info("Script completed successfully")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,142 @@
+import importlib
+import json
+import logging
+import os
+import subprocess
+import sys
+import threading
+import time
+import traceback
+
+import metrics
+
+from single_flight import LOCK_DIR, SingleFlight, file_lock
+
+# 'inprocess' runs the analysis scripts inside the calling (Flask) process,
+# 'subprocess' starts a separate Python interpreter for every run
+ANALYSIS_MODE = os.environ.get('ANALYSIS_MODE', 'inprocess')
+LOG_DIR = 'logs'
+
+_import_lock = threading.Lock()
+# Runs in progress, by (script, input fingerprint)
+_runs = SingleFlight()
+# One lock per script, so runs of a script never write its output file at the same time
+_script_locks = {}
+_script_locks_lock = threading.Lock()
+
+
+class _ThreadFilter(logging.Filter):
+    """Only pass records logged from one thread, so concurrent runs keep separate logs."""
+
+    def __init__(self, thread_id):
+        super().__init__()
+        self.thread_id = thread_id
+
+    def filter(self, record):
+        return record.thread == self.thread_id
+
+
+def load_script(script_name):
+    """Import an analysis script once and return its module."""
+    module_name = os.path.splitext(script_name)[0]
+    with _import_lock:
+        return importlib.import_module(module_name)
+
+
+def _run_in_process(script_name):
+    module = load_script(script_name)
+
+    # The scripts log through the root logger; while this run lasts, copy its
+    # records to the script's own log file like a standalone run would
+    log_path = os.path.join(LOG_DIR, f"{os.path.splitext(script_name)[0]}.log")
+    os.makedirs(LOG_DIR, exist_ok=True)
+    handler = logging.FileHandler(log_path)
+    handler.setLevel(logging.INFO)
+    handler.setFormatter(logging.Formatter('%(asctime)s - %(levelname)s - %(message)s'))
+    handler.addFilter(_ThreadFilter(threading.get_ident()))
+    root = logging.getLogger()
+    root.addHandler(handler)
+
+    try:
+        # The script's own work; parsing and writing report their own stages
+        with metrics.span('transform', os.path.splitext(script_name)[0]):
+            module.main()
+    except SystemExit as e:
+        if e.code not in (None, 0):
+            return f"Script {script_name} exited with status {e.code}"
+    except Exception:
+        return traceback.format_exc()
+    finally:
+        root.removeHandler(handler)
+        handler.close()
+    return None
+
+
+def _run_subprocess(script_name):
+    result = subprocess.run([sys.executable, script_name], capture_output=True, text=True)
+    if result.returncode != 0:
+        return result.stderr.strip()
+    return None
+
+
+def _get_script_lock(script_name):
+    with _script_locks_lock:
+        return _script_locks.setdefault(script_name, threading.Lock())
+
+
+def _get_last_run_path(script_name):
+    return os.path.join(LOCK_DIR, f"{os.path.splitext(script_name)[0]}.last_run.json")
+
+
+def _get_last_run(script_name):
+    try:
+        with open(_get_last_run_path(script_name), 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def _save_last_run(script_name, fingerprint, error):
+    path = _get_last_run_path(script_name)
+    tmp_path = f"{path}.{os.getpid()}.part"
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump({'fingerprint': fingerprint, 'finished_at': time.time(), 'error': error}, f)
+    os.replace(tmp_path, path)
+
+
+def _run(script_name, mode, fingerprint=None):
+    requested_at = time.time()
+    # The file lock keeps the runs of other processes (gunicorn workers) out as well
+    with _get_script_lock(script_name), file_lock(f"run-{script_name}"):
+        if fingerprint is not None:
+            # Another process finished a run on the same input while this one waited
+            last_run = _get_last_run(script_name)
+            if (last_run and last_run.get('fingerprint') == fingerprint
+                    and last_run.get('finished_at', 0) >= requested_at):
+                return last_run.get('error')
+
+        start = time.perf_counter()
+        if mode == 'subprocess':
+            error = _run_subprocess(script_name)
+        else:
+            error = _run_in_process(script_name)
+        metrics.record('analysis', os.path.splitext(script_name)[0], time.perf_counter() - start,
+                       error=error is not None)
+        _save_last_run(script_name, fingerprint, error)
+        return error
+
+
+def run_script(script_name, mode=None, fingerprint=None):
+    """Run an analysis script's main() and return an error message, or None on success.
+
+    In-process runs reuse the already imported pandas/openpyxl and the
+    script module, so they skip interpreter startup; subprocess runs keep
+    every script isolated in its own interpreter.
+
+    A call made while the same script runs on the same input `fingerprint`
+    (see request_data.get_input_fingerprint) attaches to that run and
+    returns its result, in this process or (through a file lock) another one.
+    Runs on other inputs wait for it to finish.
+    """
+    mode = mode or ANALYSIS_MODE
+    return _runs.do((script_name, fingerprint), _run, script_name, mode, fingerprint)
@@ -1,11 +1,16 @@
-from flask import Flask, render_template, jsonify, send_file, abort, request
-import subprocess
+from flask import Flask, Response, render_template, jsonify, send_file, request
 import os
 import traceback
 import logging
 import json
-import io
-import zipfile
+import time
+import request_data
+import analysis_runner
+import jobs
+import metrics
+import pipeline
+import report_writer
+import zip_stream
 
 app = Flask(__name__)
 logging.basicConfig(level=logging.DEBUG)
@@ -53,6 +58,8 @@ SCRIPTS = [
 # Map scripts to their required query files
 SCRIPT_QUERIES = {
     'unit_areas.py': ['unit_areas_below_900.json', 'unit_areas_above_900.json'],
+    # The pipeline variant of energy_labels.json counts the units itself
+    'energy_labels.py': ['energy_labels.json'] + ([] if request_data.PIPELINE_AGGS else ['total_units.json']),
     # Add other scripts here if they have special query requirements
     # For all other scripts, we'll assume they use a single query file with the same name
 }
@@ -101,6 +108,137 @@ SCRIPT_DESCRIPTIONS = {
 
 last_run_times = []
 
+def fetch_all_queries():
+    """Fetch every query in query/ over the shared Elasticsearch session.
+
+    Returns an error message, or None when all queries succeeded.
+    """
+    query_files = [f for f in os.listdir('query') if f.endswith('.json')]
+    failed = request_data.process_all_queries(query_files)
+    if failed:
+        return '\n'.join(f"{qf}: {error}" for qf, error in sorted(failed.items()))
+    return None
+
+def get_input_fingerprint(query_files):
+    """Fingerprint of the data read from `query_files`, or None when a query file is missing."""
+    try:
+        return request_data.get_input_fingerprint(query_files)
+    except FileNotFoundError:
+        return None
+
+def find_output_file(script_name, fmt=None, sheet=None):
+    """Return the path of a script's report in `fmt`, or None when it was not written.
+
+    Without `fmt` the xlsx report is preferred, then the first table written
+    in another of report_writer.FORMATS (see OUTPUT_FORMATS). `sheet` picks a
+    sheet other than the first one in the flat formats.
+    """
+    xlsx_path = os.path.join('/app/output', f"{script_name[:-3]}.xlsx")
+    if fmt in (None, 'xlsx') and os.path.exists(xlsx_path):
+        return xlsx_path
+    candidates = [fmt] if fmt else report_writer.FORMATS
+    for candidate in candidates:
+        if candidate == 'xlsx':
+            continue
+        path = report_writer.get_table_path(xlsx_path, candidate, sheet)
+        if os.path.exists(path):
+            return path
+    return None
+
+def get_requested_format():
+    """The format=... and sheet=... query arguments of a download; raises ValueError on an unknown format."""
+    fmt = request.args.get('format')
+    if fmt is not None and fmt not in report_writer.FORMATS:
+        raise ValueError(f"Unknown format '{fmt}', expected one of {', '.join(report_writer.FORMATS)}")
+    return fmt, request.args.get('sheet') or None
+
+def send_output_file(file_path):
+    fmt = os.path.splitext(file_path)[1].lstrip('.')
+    return send_file(file_path, as_attachment=True, mimetype=report_writer.MIMETYPES.get(fmt))
+
+def send_zip(entries, download_name):
+    """Stream a ZIP of `entries` ((path, name in the archive) pairs) as it is compressed."""
+    return Response(
+        zip_stream.iter_zip(entries),
+        mimetype='application/zip',
+        headers={'Content-Disposition': f'attachment; filename="{download_name}"'},
+    )
+
+def summarize_pipeline(analysis_scripts, nodes):
+    """Turn the pipeline nodes into the per-script results of Run All.
+
+    The fetches are reported as the request_data.py step, followed by the analyses.
+    """
+    fetch_errors = [f"{name}: {node['error']}" for name, node in nodes.items() if node['type'] == 'fetch' and node['error']]
+    results = [{'script': 'request_data.py', 'status': 'failed' if fetch_errors else 'success'}]
+    if fetch_errors:
+        results[0]['error'] = '\n'.join(fetch_errors)
+    for script in analysis_scripts:
+        node = nodes[script]
+        result = {'script': script, 'status': node['status'], 'seconds': node['seconds']}
+        if node['error']:
+            app.logger.error(f"Script {script} {node['status']}:\n{node['error']}")
+            result['error'] = node['error'].strip()
+        else:
+            app.logger.info(f"Script {script} completed successfully in {node['seconds']}s.")
+        results.append(result)
+    return results
+
+def run_all_job(job):
+    analysis_scripts = [script for script in SCRIPTS if script != 'request_data.py']
+    graph = pipeline.build_graph(analysis_scripts, SCRIPT_QUERIES)
+    job.set_total(len(graph) + len({qf for qfs in graph.values() for qf in qfs}))
+
+    def on_node(name, node):
+        job.add_stage(name, node['status'], node['seconds'], node['error'])
+
+    nodes = pipeline.run_pipeline(analysis_scripts, SCRIPT_QUERIES, on_node=on_node)
+    return {
+        'message': 'All scripts executed click Download All Results',
+        'results': summarize_pipeline(analysis_scripts, nodes),
+        'download_url': '/download_all',
+    }
+
+def fetch_all_job(job):
+    job.set_total(1)
+    start = time.perf_counter()
+    error = fetch_all_queries()
+    job.add_stage('request_data.py', 'failed' if error else 'success', round(time.perf_counter() - start, 3), error)
+    if error:
+        return {'error': f"Script request_data.py failed with error:\n{error}"}
+    return {'message': 'Script request_data.py executed successfully. No output file generated.'}
+
+def make_analysis_job(script_name, fingerprint):
+    """Return a job function that fetches a script's queries (through the cache) and runs it."""
+    def run(job):
+        query_files = pipeline.get_script_queries(script_name, SCRIPT_QUERIES)
+        job.set_total(len(query_files) + 1)
+
+        for qf in query_files:
+            start = time.perf_counter()
+            try:
+                request_data.process_query_file(qf)
+            except Exception as e:
+                job.add_stage(qf, 'failed', round(time.perf_counter() - start, 3), str(e))
+                return {'error': f"Request data failed with error:\n{str(e)}"}
+            job.add_stage(qf, 'success', round(time.perf_counter() - start, 3))
+
+        start = time.perf_counter()
+        error = analysis_runner.run_script(script_name, fingerprint=fingerprint)
+        job.add_stage(script_name, 'failed' if error else 'success', round(time.perf_counter() - start, 3), error)
+        if error:
+            return {'error': f"Script {script_name} failed with error:\n{error}"}
+
+        output_path = find_output_file(script_name)
+        if output_path is None:
+            return {'warning': f'Script {script_name} executed, but no output file was created'}
+        return {
+            'message': f'Analysis {script_name} executed successfully',
+            'output_file': os.path.basename(output_path),
+            'download_url': f'/download/{script_name}',
+        }
+    return run
+
 @app.route('/')
 def index():
     query_files = [f for f in os.listdir('query') if f.endswith('.json')]
@@ -114,30 +252,19 @@ def download_query(script_name):
     # Check if the script has multiple query files
     if script_name in SCRIPT_QUERIES:
         query_files = SCRIPT_QUERIES[script_name]
-        file_paths = [os.path.join('query', qf) for qf in query_files]
+        file_paths = [request_data.get_query_path(qf) for qf in query_files]
         
         # Check if all query files exist
         for fp in file_paths:
             if not os.path.exists(fp):
                 return jsonify({'error': f'Query file {fp} not found'}), 404
         
-        # Create a zip file in memory
-        zip_buffer = io.BytesIO()
-        with zipfile.ZipFile(zip_buffer, 'w') as zip_file:
-            for fp in file_paths:
-                zip_file.write(fp, arcname=os.path.basename(fp))
-        zip_buffer.seek(0)
         zip_filename = f"{base_script_name}_queries.zip"
-        return send_file(
-            zip_buffer,
-            mimetype='application/zip',
-            as_attachment=True,
-            download_name=zip_filename  # For Flask >=2.0
-        )
+        return send_zip([(fp, os.path.basename(fp)) for fp in file_paths], zip_filename)
     else:
         # Default case: one query file with the same name as the script
         query_file_name = f"{base_script_name}.json"
-        file_path = os.path.join('query', query_file_name)
+        file_path = request_data.get_query_path(query_file_name)
         if os.path.exists(file_path):
             try:
                 return send_file(
@@ -161,44 +288,32 @@ def run_analysis(script_name):
         # Extract the base script name without extension
         base_script_name = os.path.splitext(script_name)[0]
 
-        # Determine the required data files and query files
-        data_files = []
-        query_files = []
-
-        # Check if the script requires special query files
+        # Determine the required query files
         if script_name in SCRIPT_QUERIES:
             # For scripts with multiple query files
             query_files = SCRIPT_QUERIES[script_name]
-            for query_file in query_files:
-                data_file = os.path.join('data', os.path.splitext(query_file)[0] + '.txt')
-                data_files.append(data_file)
         else:
-            # Default case: one query file and one data file
-            query_file = f"{base_script_name}.json"
-            data_file = os.path.join('data', f"{base_script_name}.txt")
-            query_files = [query_file]
-            data_files = [data_file]
-
-        # Check if all required data files exist
-        missing_data_files = [df for df in data_files if not os.path.exists(df)]
-        if missing_data_files:
-            # Run the corresponding queries for missing data files
-            for qf in query_files:
-                query_file_path = os.path.join('query', qf)
-                if not os.path.exists(query_file_path):
-                    return jsonify({'error': f'Query file {query_file_path} not found'}), 404
-
-                result = subprocess.run(['python', 'request_data.py', '--query-file', query_file_path], capture_output=True, text=True)
-                if result.returncode != 0:
-                    error_msg = f"Request data failed with error:\n{result.stderr}"
-                    app.logger.error(error_msg)
-                    return jsonify({'error': error_msg}), 500
+            # Default case: one query file with the same name as the script
+            query_files = [f"{base_script_name}.json"]
+
+        # Fetch the data, reusing cached results that are still fresh for the current query
+        for qf in query_files:
+            query_file_path = os.path.join('query', qf)
+            if not os.path.exists(query_file_path):
+                return jsonify({'error': f'Query file {query_file_path} not found'}), 404
+
+            try:
+                request_data.process_query_file(qf)
+            except Exception as e:
+                error_msg = f"Request data failed with error:\n{str(e)}"
+                app.logger.error(error_msg)
+                return jsonify({'error': error_msg}), 500
 
-        # Run the script
-        result = subprocess.run(['python', script_name], capture_output=True, text=True)
+        # Run the script, or wait for an identical run that is already in progress
+        error = analysis_runner.run_script(script_name, fingerprint=get_input_fingerprint(query_files))
 
-        if result.returncode != 0:
-            error_msg = f"Script {script_name} failed with error:\n{result.stderr}"
+        if error:
+            error_msg = f"Script {script_name} failed with error:\n{error}"
             app.logger.error(error_msg)
             return jsonify({'error': error_msg}), 500
 
@@ -216,10 +331,10 @@ def run_query(query_name):
         if not os.path.exists(query_file):
             return jsonify({'error': f'Query file {query_name} not found'}), 404
 
-        result = subprocess.run(['python', 'request_data.py', '--query-file', query_file], capture_output=True, text=True)
-
-        if result.returncode != 0:
-            error_msg = f"Request data failed with error:\n{result.stderr}"
+        try:
+            request_data.process_query_file(query_name)
+        except Exception as e:
+            error_msg = f"Request data failed with error:\n{str(e)}"
             app.logger.error(error_msg)
             return jsonify({'error': error_msg}), 500
 
@@ -244,21 +359,14 @@ def run_custom_query():
         except json.JSONDecodeError as e:
             return jsonify({'error': f'Invalid JSON: {str(e)}'}), 400
 
-        result = subprocess.run(['python', 'request_data.py', '--custom-query', json.dumps(json_query)], capture_output=True, text=True)
-
-        if result.returncode != 0:
-            error_msg = f"Request data failed with error:\n{result.stderr}"
+        try:
+            output_path = request_data.process_query('custom_query', json_query)
+        except Exception as e:
+            error_msg = f"Request data failed with error:\n{str(e)}"
             app.logger.error(error_msg)
             return jsonify({'error': error_msg}), 500
 
-        # Find the latest custom_query output file
-        data_files = [f for f in os.listdir('data') if f.startswith('custom_query_') and f.endswith('.txt')]
-        if data_files:
-            latest_file = max(data_files, key=lambda x: os.path.getctime(os.path.join('data', x)))
-        else:
-            latest_file = None
-
-        return jsonify({'message': 'Custom query executed successfully', 'output_file': latest_file}), 200
+        return jsonify({'message': 'Custom query executed successfully', 'output_file': os.path.basename(output_path)}), 200
 
     except Exception as e:
         error_msg = f"Error running custom query: {str(e)}\n{traceback.format_exc()}"
@@ -279,10 +387,17 @@ def download_query_result(filename):
     
 @app.route('/download_output/<filename>')
 def download_output(filename):
+    # ?format=csv|parquet|ndjson (and &sheet=<name>) serves that table of the report instead
+    try:
+        fmt, sheet = get_requested_format()
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
     file_path = os.path.join('output', filename)
+    if fmt is not None and fmt != 'xlsx':
+        file_path = report_writer.get_table_path(file_path, fmt, sheet)
     if os.path.exists(file_path):
         try:
-            return send_file(file_path, as_attachment=True)
+            return send_output_file(file_path)
         except Exception as e:
             app.logger.error(f"Error sending file {file_path}: {str(e)}")
             return jsonify({'error': f'Error sending file: {str(e)}'}), 500
@@ -296,37 +411,31 @@ def run_script(script_name):
     
     try:
         if script_name == 'all':
-            results = []
             app.logger.info("Running all scripts...")
-            for script in SCRIPTS:
-                app.logger.info(f"Running script: {script}")
-                result = subprocess.run(['python', script], capture_output=True, text=True)
-
-                if result.returncode != 0:
-                    error_msg = f"Script {script} failed with error:\n{result.stderr}"
-                    app.logger.error(error_msg)
-                    results.append({'script': script, 'status': 'failed', 'error': result.stderr.strip()})
-                else:
-                    app.logger.info(f"Script {script} completed successfully.")
-                    results.append({'script': script, 'status': 'success'})
-
+            analysis_scripts = [script for script in SCRIPTS if script != 'request_data.py']
+            nodes = pipeline.run_pipeline(analysis_scripts, SCRIPT_QUERIES)
+            results = summarize_pipeline(analysis_scripts, nodes)
             app.logger.info("All scripts have been executed.")
-            return jsonify({'message': 'All scripts executed click Download All Results', 'results': results})
+            return jsonify({'message': 'All scripts executed click Download All Results', 'results': results, 'timings': nodes})
         else:
             app.logger.info(f"Running individual script: {script_name}")
-            result = subprocess.run(['python', script_name], capture_output=True, text=True)
+            if script_name == 'request_data.py':
+                error = fetch_all_queries()
+                if error:
+                    error_msg = f"Script {script_name} failed with error:\n{error}"
+                    app.logger.error(error_msg)
+                    return jsonify({'error': error_msg}), 500
+                return jsonify({'message': f'Script {script_name} executed successfully. No output file generated.'}), 200
+
+            fingerprint = get_input_fingerprint(pipeline.get_script_queries(script_name, SCRIPT_QUERIES))
+            error = analysis_runner.run_script(script_name, fingerprint=fingerprint)
             
-            if result.returncode != 0:
-                error_msg = f"Script {script_name} failed with error:\n{result.stderr}"
+            if error:
+                error_msg = f"Script {script_name} failed with error:\n{error}"
                 app.logger.error(error_msg)
                 return jsonify({'error': error_msg}), 500
             
-            if script_name == 'request_data.py':
-                return jsonify({'message': f'Script {script_name} executed successfully. No output file generated.'}), 200
-            
-            output_file = f"{script_name[:-3]}.xlsx"
-            output_path = os.path.join('/app/output', output_file)
-            if os.path.exists(output_path):
+            if find_output_file(script_name) is not None:
                 app.logger.info(f"Script {script_name} executed successfully. Output file created.")
                 return jsonify({'message': f'Script {script_name} executed successfully'})
             else:
@@ -347,8 +456,14 @@ def download_file(script_name):
         return jsonify({'message': 'No file to download for request_data.py'}), 200
     
     if script_name.endswith('.py'):
-        file_name = f"{script_name[:-3]}.xlsx"
-        file_path = os.path.join('/app/output', file_name)
+        # ?format=csv|parquet|ndjson (and &sheet=<name>) picks the report table to send
+        try:
+            fmt, sheet = get_requested_format()
+        except ValueError as e:
+            return jsonify({'error': str(e)}), 400
+        file_path = find_output_file(script_name, fmt, sheet)
+        if file_path is None:
+            file_path = os.path.join('/app/output', f"{script_name[:-3]}.{fmt or 'xlsx'}")
     elif script_name.endswith('.log'):
         file_path = os.path.join('/app/logs', script_name)
     else:
@@ -360,7 +475,7 @@ def download_file(script_name):
     if os.path.exists(file_path):
         try:
             app.logger.info(f"File found. Attempting to send: {file_path}")
-            return send_file(file_path, as_attachment=True)
+            return send_output_file(file_path)
         except Exception as e:
             app.logger.error(f"Error sending file {file_path}: {str(e)}")
             return jsonify({'error': f'Error sending file: {str(e)}'}), 500
@@ -375,18 +490,52 @@ def download_file(script_name):
 
 @app.route('/download_all')
 def download_all():
-    memory_file = io.BytesIO()
-    with zipfile.ZipFile(memory_file, 'w') as zf:
-        for root, dirs, files in os.walk('output'):
-            for file in files:
-                zf.write(os.path.join(root, file), file)
-    memory_file.seek(0)
-    return send_file(
-        memory_file,
-        mimetype='application/zip',
-        as_attachment=True,
-        download_name='all_results.zip'
-    )
+    # Skip the links report_writer makes to a report's first sheet, they would repeat its table
+    entries = [(os.path.join(root, file), file) for root, dirs, files in os.walk('output') for file in files
+               if not os.path.islink(os.path.join(root, file))]
+    return send_zip(entries, 'all_results.zip')
+
+@app.route('/jobs/run/<script_name>', methods=['POST'])
+def submit_job(script_name):
+    if script_name not in SCRIPTS and script_name != 'all':
+        return jsonify({'error': 'Invalid script name'}), 400
+
+    # A run identical to one that is still queued or running (same script,
+    # same query inputs) attaches to that job instead of starting another
+    if script_name == 'all':
+        query_files = [f for f in os.listdir('query') if f.endswith('.json')]
+        job = jobs.submit('all', script_name, run_all_job, key=('all', get_input_fingerprint(query_files)))
+    elif script_name == 'request_data.py':
+        query_files = [f for f in os.listdir('query') if f.endswith('.json')]
+        job = jobs.submit('fetch', script_name, fetch_all_job, key=('fetch', get_input_fingerprint(query_files)))
+    else:
+        query_files = pipeline.get_script_queries(script_name, SCRIPT_QUERIES)
+        for qf in query_files:
+            query_file_path = os.path.join('query', qf)
+            if not os.path.exists(query_file_path):
+                return jsonify({'error': f'Query file {query_file_path} not found'}), 404
+        fingerprint = get_input_fingerprint(query_files)
+        job = jobs.submit('analysis', script_name, make_analysis_job(script_name, fingerprint),
+                          key=('analysis', script_name, fingerprint))
+
+    app.logger.info(f"Queued job {job.id} for {script_name}")
+    return jsonify({'job_id': job.id, 'status_url': f'/jobs/{job.id}'}), 202
+
+@app.route('/jobs/<job_id>')
+def job_status(job_id):
+    job = jobs.get_job(job_id)
+    if job is None:
+        return jsonify({'error': 'Job not found'}), 404
+    return jsonify(job)
+
+@app.route('/jobs')
+def list_jobs():
+    return jsonify({'jobs': jobs.list_jobs()})
+
+@app.route('/metrics')
+def get_metrics():
+    # Stage timings of every process (web workers, Run All workers, CLI runs), for Prometheus to scrape
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
 
 @app.route('/log/<script_name>')
 def get_log(script_name):
@@ -0,0 +1,294 @@
+import argparse
+import fnmatch
+import importlib
+import json
+import logging
+import multiprocessing
+import os
+import platform
+import sys
+import time
+import traceback
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+import synthetic_es
+
+# Synthetic data files, reports and metrics of benchmark runs
+BENCHMARK_DIR = os.environ.get('BENCHMARK_DIR', os.path.join('data', '.benchmark'))
+BASELINE_FILE = os.environ.get('BENCHMARK_BASELINE', os.path.join('benchmarks', 'baseline.json'))
+DEFAULT_REPEAT = int(os.environ.get('BENCHMARK_REPEAT', 5))
+
+# A case has regressed when its median time or its peak memory grew by more than
+# BENCHMARK_TOLERANCE (a fraction of the baseline) and by more than the minimum
+# change below, so that cases taking a few milliseconds do not flap
+BENCHMARK_TOLERANCE = float(os.environ.get('BENCHMARK_TOLERANCE', 0.25))
+MIN_SECONDS_CHANGE = 0.05
+MIN_MEMORY_CHANGE = 16 * 1024 * 1024
+
+# Query files read by a script that is not named after them: query -> (script, parser, keyword arguments)
+PARSERS = {
+    'total_units': ('energy_labels', 'parse_municipalities', {}),
+    'unit_areas_below_900': ('unit_areas', 'parse_elasticsearch_output', {}),
+    'unit_areas_above_900': ('unit_areas', 'parse_elasticsearch_output', {'is_above_900': True}),
+}
+# Parser function names tried, in order, in a script named after its query file
+PARSER_NAMES = ('parse_elasticsearch_output', 'parse_energy_label_validity', 'parse_energy_labels')
+
+
+def get_query_files(patterns=None):
+    """The query files to benchmark, by name; `patterns` are fnmatch patterns of the names."""
+    query_files = {}
+    for file in sorted(os.listdir('query')):
+        name, ext = os.path.splitext(file)
+        if ext == '.json' and (not patterns or any(fnmatch.fnmatch(name, p) for p in patterns)):
+            query_files[name] = os.path.join('query', file)
+    return query_files
+
+
+def get_parser(name):
+    """Import the script reading the data of query `name` and return its parser and keyword arguments."""
+    script, parser_name, kwargs = PARSERS.get(name, (name, None, {}))
+    module = importlib.import_module(script)
+    if parser_name is None:
+        parser_name = next((attr for attr in PARSER_NAMES if hasattr(module, attr)), None)
+        if parser_name is None:
+            raise AttributeError(f"{script}.py has none of the parsers {PARSER_NAMES}")
+    return getattr(module, parser_name), kwargs
+
+
+def prepare_data(query_files, sizes, seed):
+    """Write the synthetic responses, unless they were written with the same sizes and seed already."""
+    data_dir = os.path.join(BENCHMARK_DIR, 'data')
+    settings_path = os.path.join(data_dir, 'settings.json')
+    settings = {'sizes': sizes, 'seed': seed}
+    try:
+        with open(settings_path, 'r', encoding='utf-8') as f:
+            previous = json.load(f)
+    except (OSError, ValueError):
+        previous = None
+
+    paths = {}
+    missing = {}
+    for name, query_file in query_files.items():
+        paths[name] = os.path.join(data_dir, f"{name}.txt")
+        if previous != settings or not os.path.exists(paths[name]):
+            missing[name] = query_file
+    if missing:
+        print(f"Generating {len(missing)} synthetic responses in {data_dir}")
+        synthetic_es.write_responses(missing.values(), data_dir, sizes, seed)
+        with open(settings_path, 'w', encoding='utf-8') as f:
+            json.dump(settings, f)
+    return paths
+
+
+def _percentiles(values):
+    p50, p95, p99 = np.percentile(values, [50, 95, 99])
+    return {'p50': float(p50), 'p95': float(p95), 'p99': float(p99),
+            'min': float(min(values)), 'max': float(max(values))}
+
+
+def run_case(name, data_path, repeat, formats, table_cache_enabled):
+    """Parse `data_path` with the parser of query `name` and write the table, `repeat` times.
+
+    Runs in a process of its own (see run_cases), so that the peak RSS is
+    that of this case alone. The first run is a warm-up and is not counted.
+    """
+    # Configure logging before the scripts do, so they do not need /app/logs
+    logging.basicConfig(level=logging.WARNING)
+    import pandas as pd
+
+    import metrics
+    import table_cache
+    from report_writer import ReportWriter
+
+    try:
+        parse, kwargs = get_parser(name)
+    except Exception as e:
+        return {'name': name, 'error': f"{type(e).__name__}: {e}"}
+
+    table_cache.TABLE_CACHE = table_cache_enabled
+    table_cache.TABLE_CACHE_DIR = os.path.join(BENCHMARK_DIR, 'tables')
+    output_dir = os.path.join(BENCHMARK_DIR, 'output')
+    os.makedirs(output_dir, exist_ok=True)
+    output_path = os.path.join(output_dir, f"{name}.xlsx")
+
+    start_rss = metrics.get_peak_rss()
+    runs = []
+    rows = 0
+    try:
+        for i in range(repeat + 1):
+            before = metrics.totals()
+            start = time.perf_counter()
+            result = parse(data_path, **kwargs)
+            parsed = time.perf_counter()
+            if isinstance(result, pd.DataFrame):
+                with ReportWriter(output_path, formats=formats) as writer:
+                    writer.write_sheet(result, 'Sheet1')
+            end = time.perf_counter()
+            after = metrics.totals()
+
+            rows = len(result) if hasattr(result, '__len__') else 0
+            del result
+            if i == 0:
+                continue
+            run = {'seconds': end - start, 'parse': parsed - start, 'write': end - parsed}
+            for stage in ('decode', 'flatten'):
+                run[stage] = after.get(stage, {}).get('seconds', 0.0) - before.get(stage, {}).get('seconds', 0.0)
+            runs.append(run)
+    except Exception:
+        return {'name': name, 'error': traceback.format_exc().strip().splitlines()[-1]}
+
+    peak_rss = metrics.get_peak_rss()
+    input_bytes = os.path.getsize(data_path)
+    parse_seconds = float(np.median([run['parse'] for run in runs]))
+    return {
+        'name': name,
+        'rows': rows,
+        'input_bytes': input_bytes,
+        'seconds': _percentiles([run['seconds'] for run in runs]),
+        'stages': {stage: float(np.median([run[stage] for run in runs]))
+                   for stage in ('decode', 'flatten', 'parse', 'write')},
+        'rows_per_second': rows / parse_seconds if parse_seconds else 0.0,
+        'bytes_per_second': input_bytes / parse_seconds if parse_seconds else 0.0,
+        'peak_rss': peak_rss,
+        'peak_rss_delta': peak_rss - start_rss,
+    }
+
+
+def run_cases(paths, repeat=DEFAULT_REPEAT, formats=('xlsx',), table_cache_enabled=False):
+    """Run every case in a fresh process, one at a time; yields the results as they come."""
+    # The benchmark's metrics are kept apart from the app's logs/metrics/
+    os.environ['METRICS_DIR'] = os.path.join(BENCHMARK_DIR, 'metrics')
+    context = multiprocessing.get_context('spawn')
+    for name, data_path in paths.items():
+        with ProcessPoolExecutor(max_workers=1, mp_context=context) as pool:
+            try:
+                yield pool.submit(run_case, name, data_path, repeat, list(formats), table_cache_enabled).result()
+            except Exception as e:
+                yield {'name': name, 'error': f"{type(e).__name__}: {e}"}
+
+
+def load_baseline(path=BASELINE_FILE):
+    try:
+        with open(path, 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return None
+
+
+def save_baseline(results, settings, path=BASELINE_FILE):
+    baseline = load_baseline(path) or {}
+    if baseline.get('settings') != settings:
+        baseline = {}
+    cases = baseline.get('cases', {})
+    cases.update({result['name']: result for result in results if 'error' not in result})
+    baseline.update({
+        'settings': settings,
+        'created': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'machine': f"{platform.node()} {platform.machine()} Python {platform.python_version()}",
+        'cases': dict(sorted(cases.items())),
+    })
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    tmp_path = f"{path}.part"
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(baseline, f, indent=2)
+    os.replace(tmp_path, path)
+
+
+def _regressed(new, old, min_change):
+    return new > old * (1 + BENCHMARK_TOLERANCE) and new - old > min_change
+
+
+def compare(result, baseline_case):
+    """Regressions of a result against its baseline, as messages."""
+    regressions = []
+    new, old = result['seconds']['p50'], baseline_case['seconds']['p50']
+    if _regressed(new, old, MIN_SECONDS_CHANGE):
+        regressions.append(f"{result['name']}: median {new * 1000:.0f} ms, baseline {old * 1000:.0f} ms "
+                           f"(+{(new / old - 1) * 100:.0f}%)")
+    new, old = result['peak_rss'], baseline_case['peak_rss']
+    if _regressed(new, old, MIN_MEMORY_CHANGE):
+        regressions.append(f"{result['name']}: peak RSS {new / 2 ** 20:.0f} MB, baseline {old / 2 ** 20:.0f} MB "
+                           f"(+{(new / old - 1) * 100:.0f}%)")
+    return regressions
+
+
+def format_result(result, baseline_case=None):
+    if 'error' in result:
+        return f"{result['name']:<56} ERROR {result['error']}"
+    seconds = result['seconds']
+    stages = result['stages']
+    change = ''
+    if baseline_case:
+        change = f" {(seconds['p50'] / baseline_case['seconds']['p50'] - 1) * 100:+6.0f}%"
+    return (f"{result['name']:<56} {result['rows']:>9} {result['input_bytes'] / 2 ** 20:>8.1f} "
+            f"{seconds['p50'] * 1000:>8.0f} {seconds['p95'] * 1000:>8.0f} {seconds['p99'] * 1000:>8.0f} "
+            f"{stages['decode'] * 1000:>8.0f} {stages['flatten'] * 1000:>8.0f} {stages['write'] * 1000:>8.0f} "
+            f"{result['rows_per_second']:>10.0f} {result['bytes_per_second'] / 2 ** 20:>7.1f} "
+            f"{result['peak_rss'] / 2 ** 20:>8.0f}{change}")
+
+
+HEADER = (f"{'case':<56} {'rows':>9} {'in MB':>8} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8} "
+          f"{'decode':>8} {'flatten':>8} {'write':>8} {'rows/s':>10} {'MB/s':>7} {'peak MB':>8}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description='Benchmark every parser and report writer on synthetic Elasticsearch responses.')
+    parser.add_argument('patterns', nargs='*', help='Only run the queries whose names match these patterns')
+    parser.add_argument('--repeat', type=int, default=DEFAULT_REPEAT,
+                        help=f'Timed runs per case, after one warm-up run (default: {DEFAULT_REPEAT})')
+    parser.add_argument('--formats', default='xlsx',
+                        help='Report formats written, comma separated (default: xlsx)')
+    parser.add_argument('--table-cache', action='store_true',
+                        help='Read the parsed tables from the table cache (filled by the warm-up run)')
+    parser.add_argument('--baseline', default=BASELINE_FILE, help=f'Baseline file (default: {BASELINE_FILE})')
+    parser.add_argument('--save-baseline', action='store_true',
+                        help='Store the results as the new baseline instead of comparing with it')
+    parser.add_argument('--json', help='Also write the results to this file')
+    synthetic_es.add_size_arguments(parser)
+    args = parser.parse_args()
+
+    sizes = synthetic_es.get_sizes(args)
+    formats = [f.strip().lower() for f in args.formats.split(',') if f.strip()]
+    settings = {'sizes': sizes, 'seed': args.seed, 'repeat': args.repeat, 'formats': formats,
+                'table_cache': args.table_cache}
+
+    query_files = get_query_files(args.patterns)
+    if not query_files:
+        print("No query files match.")
+        sys.exit(1)
+    paths = prepare_data(query_files, sizes, args.seed)
+
+    baseline = None if args.save_baseline else load_baseline(args.baseline)
+    if baseline and baseline.get('settings') != settings:
+        print(f"Baseline {args.baseline} was made with other settings ({baseline.get('settings')}), not comparing")
+        baseline = None
+    baseline_cases = (baseline or {}).get('cases', {})
+
+    print(HEADER + (' change' if baseline else ''))
+    results = []
+    regressions = []
+    for result in run_cases(paths, args.repeat, formats, args.table_cache):
+        baseline_case = baseline_cases.get(result['name']) if 'error' not in result else None
+        print(format_result(result, baseline_case), flush=True)
+        results.append(result)
+        if baseline_case:
+            regressions += compare(result, baseline_case)
+
+    if args.json:
+        with open(args.json, 'w', encoding='utf-8') as f:
+            json.dump({'settings': settings, 'results': results}, f, indent=2)
+
+    errors = [result for result in results if 'error' in result]
+    if args.save_baseline:
+        save_baseline(results, settings, args.baseline)
+        print(f"Saved the baseline of {len(results) - len(errors)} cases to {args.baseline}")
+    if errors:
+        print(f"{len(errors)} cases failed", file=sys.stderr)
+    for regression in regressions:
+        print(f"Regression: {regression}", file=sys.stderr)
+    if errors or regressions:
+        sys.exit(1)
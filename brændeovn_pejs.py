@@ -1,44 +1,31 @@
-import json
 import pandas as pd
 import os
 import logging
+from es_reader import read_aggregation_output
+from report_writer import ReportWriter
+from table_cache import cached_table
+from flatten_aggs import flatten_buckets
 
 logging.basicConfig(filename='/app/logs/brændeovn_pejs.log', level=logging.INFO, 
                     format='%(asctime)s - %(levelname)s - %(message)s')
 
+@cached_table
 def parse_elasticsearch_output(file_path):
-    with open(file_path, 'r') as file:
-        data = json.load(file)
-    
-    results = []
+    data, buckets = read_aggregation_output(file_path)
     
     total_hits = data['hits']['total']['value']
     logging.info(f"Total hits: {total_hits}")
     
-    # Process each municipality bucket
-    for municipality in data['aggregations']['municipalities']['buckets']:
-        municipality_code = municipality['key']
-        municipality_count = municipality['doc_count']
-        
-        # Process each unit usage bucket inside the municipality
-        for usage in municipality['unit_usage']['buckets']:
-            unit_usage = usage['key']
-            unit_usage_count = usage['doc_count']
-            
-            results.append({
-                'municipality_code': municipality_code,
-                'unit_usage': unit_usage,
-                'count': unit_usage_count
-            })
-    
-    df = pd.DataFrame(results)
+    # One row per unit usage bucket inside each municipality
+    df = flatten_buckets(buckets, 'municipalities > unit_usage', ['municipality_code', 'unit_usage'],
+                         categorical=['municipality_code', 'unit_usage'])
     
     # Calculate the percentage
     df['percentage_of_all_brændovn'] = (df['count'] / total_hits) * 100
     
     return df
 
-if __name__ == "__main__":
+def main():
     try:
         input_file = os.environ.get('INPUT_FILE', 'brændeovn_pejs.txt')
         output_file = os.environ.get('OUTPUT_FILE', 'brændeovn_pejs.xlsx')
@@ -61,7 +48,7 @@ if __name__ == "__main__":
 
         # Calculate summary statistics
         total_brændovn = df['count'].sum()
-        avg_brændovn_per_municipality = df.groupby('municipality_code')['count'].mean().mean()
+        avg_brændovn_per_municipality = df.groupby('municipality_code', observed=True)['count'].mean().mean()
         max_brændovn = df['count'].max()
         min_brændovn = df['count'].min()
 
@@ -69,15 +56,15 @@ if __name__ == "__main__":
 
         # Save to Excel
         output_path = f"/app/output/{output_file}"
-        with pd.ExcelWriter(output_path, engine='openpyxl') as writer:
-            df.to_excel(writer, sheet_name='Municipality Data', index=False)
+        with ReportWriter(output_path) as writer:
+            writer.write_sheet(df, 'Municipality Data')
             
             # Create a summary sheet
             summary_df = pd.DataFrame({
                 'Metric': ['Total Brændovn', 'Avg Brændovn per Municipality', 'Max Brændovn in a Municipality', 'Min Brændovn in a Municipality'],
                 'Value': [total_brændovn, avg_brændovn_per_municipality, max_brændovn, min_brændovn]
             })
-            summary_df.to_excel(writer, sheet_name='Summary', index=False)
+            writer.write_sheet(summary_df, 'Summary')
 
         logging.info(f"Results saved to {output_path}")
 
@@ -86,3 +73,6 @@ if __name__ == "__main__":
         raise
 
     logging.info("Script completed successfully")
+
+if __name__ == "__main__":
+    main()
@@ -3,42 +3,32 @@ import pandas as pd
 import os
 import sys
 import logging
+from es_reader import read_aggregation_output
+from report_writer import ReportWriter
+from table_cache import cached_table
+from flatten_aggs import flatten_buckets
 
 logging.basicConfig(filename='/app/logs/building_area.log', level=logging.INFO, 
                     format='%(asctime)s - %(levelname)s - %(message)s')
 
+@cached_table
 def parse_elasticsearch_output(file_path):
-    with open(file_path, 'r') as file:
-        data = json.load(file)
+    data, buckets = read_aggregation_output(file_path)
     
     if 'error' in data:
         logging.error("Elasticsearch query failed. Error details:")
         logging.error(json.dumps(data['error'], indent=2))
         return None
     
-    results = []
+    df = flatten_buckets(buckets, 'municipalities > unit_usage > building_areas',
+                         ['municipality_code', 'unit_usage', 'area_range'],
+                         categorical=['municipality_code', 'unit_usage'])
     
-    for municipality in data['aggregations']['municipalities']['buckets']:
-        municipality_code = municipality['key']
-        
-        for usage in municipality['unit_usage']['buckets']:
-            unit_usage = usage['key']
-            
-            for area_bucket in usage['building_areas']['buckets']:
-                min_area = area_bucket['key']
-                max_area = min_area + 300
-                count = area_bucket['doc_count']
-                
-                results.append({
-                    'municipality_code': municipality_code,
-                    'unit_usage': unit_usage,
-                    'area_range': f"{min_area}-{max_area}",
-                    'count': count
-                })
-    
-    return pd.DataFrame(results)
+    # Histogram keys are the lower bound of 300 m² ranges
+    df['area_range'] = [f"{min_area}-{min_area + 300}" for min_area in df['area_range'].tolist()]
+    return df
 
-if __name__ == "__main__":
+def main():
     try:
         input_file = os.environ.get('INPUT_FILE', 'building_area.txt')
         output_file = os.environ.get('OUTPUT_FILE', 'building_area.xlsx')
@@ -61,16 +51,16 @@ if __name__ == "__main__":
 
         # Calculate summary statistics
         total_buildings = df['count'].sum()
-        avg_buildings_per_range = df.groupby(['unit_usage', 'area_range'])['count'].mean()
-        max_buildings = df.groupby(['unit_usage', 'area_range'])['count'].max()
-        min_buildings = df.groupby(['unit_usage', 'area_range'])['count'].min()
+        avg_buildings_per_range = df.groupby(['unit_usage', 'area_range'], observed=True)['count'].mean()
+        max_buildings = df.groupby(['unit_usage', 'area_range'], observed=True)['count'].max()
+        min_buildings = df.groupby(['unit_usage', 'area_range'], observed=True)['count'].min()
 
         logging.info(f"Summary statistics calculated: Total={total_buildings}, Avg per range={avg_buildings_per_range.mean():.2f}, Max={max_buildings.max()}, Min={min_buildings.min()}")
 
         # Save to Excel
         output_path = f"/app/output/{output_file}"
-        with pd.ExcelWriter(output_path, engine='openpyxl') as writer:
-            df.to_excel(writer, sheet_name='Detailed Data', index=False)
+        with ReportWriter(output_path) as writer:
+            writer.write_sheet(df, 'Detailed Data')
             
             # Create a summary sheet
             summary_stats_df = pd.DataFrame({
@@ -83,7 +73,7 @@ if __name__ == "__main__":
             # Add total row
             total_row = pd.DataFrame({'Unit Usage': ['Total'], 'Area Range': [''], 'Avg Units': [total_buildings], 'Max Units': [None], 'Min Units': [None]})
             summary_stats_df = pd.concat([summary_stats_df, total_row], ignore_index=True)
-            summary_stats_df.to_excel(writer, sheet_name='Summary Statistics', index=False)
+            writer.write_sheet(summary_stats_df, 'Summary Statistics')
 
         logging.info(f"Results saved to {output_path}")
 
@@ -91,4 +81,7 @@ if __name__ == "__main__":
         logging.error(f"Error: {str(e)}")
         raise
 
-    logging.info("Script completed successfully")
\ No newline at end of file
+    logging.info("Script completed successfully")
+
+if __name__ == "__main__":
+    main()
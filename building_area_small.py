@@ -1,42 +1,28 @@
 import json
 import pandas as pd
-import numpy as np
 import os
 import sys
 import logging
+from es_reader import read_aggregation_output
+from report_writer import ReportWriter
+from table_cache import cached_table
+from flatten_aggs import flatten_buckets
 
 logging.basicConfig(filename='/app/logs/building_area_small.log', level=logging.INFO, 
                     format='%(asctime)s - %(levelname)s - %(message)s')
 
+@cached_table
 def parse_elasticsearch_output(file_path):
-    with open(file_path, 'r') as file:
-        data = json.load(file)
+    data, buckets = read_aggregation_output(file_path)
     
     if 'error' in data:
         logging.error("Elasticsearch query failed. Error details:")
         logging.error(json.dumps(data['error'], indent=2))
         return None
     
-    results = []
-    
-    for municipality in data['aggregations']['municipalities']['buckets']:
-        municipality_code = municipality['key']
-        
-        for usage in municipality['unit_usage']['buckets']:
-            unit_usage = usage['key']
-            
-            for area_bucket in usage['building_areas']['buckets']:
-                area = area_bucket['key']
-                count = area_bucket['doc_count']
-                
-                results.append({
-                    'municipality_code': municipality_code,
-                    'unit_usage': unit_usage,
-                    'building_area': area,
-                    'count': count
-                })
-    
-    return pd.DataFrame(results)
+    return flatten_buckets(buckets, 'municipalities > unit_usage > building_areas',
+                           ['municipality_code', 'unit_usage', 'building_area'],
+                           categorical=['municipality_code', 'unit_usage'])
 
 def create_area_ranges(df):
     bins = [0, 5] + list(range(10, 101, 5))  # Creates bins [0, 5, 10, 15, ..., 95, 100]
@@ -49,7 +35,7 @@ def create_area_ranges(df):
                               include_lowest=True)
     return df
 
-if __name__ == "__main__":
+def main():
     try:
         input_file = os.environ.get('INPUT_FILE', 'building_area_small.txt')
         output_file = os.environ.get('OUTPUT_FILE', 'building_area_small.xlsx')
@@ -89,8 +75,8 @@ if __name__ == "__main__":
 
         # Save to Excel
         output_path = f"/app/output/{output_file}"
-        with pd.ExcelWriter(output_path, engine='openpyxl') as writer:
-            grouped_df.to_excel(writer, sheet_name='Detailed Data', index=False)
+        with ReportWriter(output_path) as writer:
+            writer.write_sheet(grouped_df, 'Detailed Data')
             
             # Create a summary sheet
             summary_stats_df = pd.DataFrame({
@@ -103,7 +89,7 @@ if __name__ == "__main__":
             # Add total row
             total_row = pd.DataFrame({'Unit Usage': ['Total'], 'Area Range': [''], 'Avg Units': [total_buildings], 'Max Units': [None], 'Min Units': [None]})
             summary_stats_df = pd.concat([summary_stats_df, total_row], ignore_index=True)
-            summary_stats_df.to_excel(writer, sheet_name='Summary Statistics', index=False)
+            writer.write_sheet(summary_stats_df, 'Summary Statistics')
 
         logging.info(f"Results saved to {output_path}")
 
@@ -111,4 +97,7 @@ if __name__ == "__main__":
         logging.error(f"Error: {str(e)}")
         raise
 
-    logging.info("Script completed successfully")
\ No newline at end of file
+    logging.info("Script completed successfully")
+
+if __name__ == "__main__":
+    main()
@@ -1,31 +1,25 @@
-import json
 import pandas as pd
 import os
 import logging
+from es_reader import read_aggregation_output
+from report_writer import ReportWriter
+from table_cache import cached_table
+from flatten_aggs import flatten_buckets
 
 logging.basicConfig(filename='/app/logs/buildings_1000.log', level=logging.INFO, 
                     format='%(asctime)s - %(levelname)s - %(message)s')
 
+@cached_table
 def parse_elasticsearch_output(file_path):
-    with open(file_path, 'r') as file:
-        data = json.load(file)
+    data, buckets = read_aggregation_output(file_path)
     
     total_hits = data['hits']['total']['value']
     logging.info(f"Total buildings from year 1000 with energy labels: {total_hits}")
 
-    results = []
-    for municipality in data['aggregations']['municipalities']['buckets']:
-        municipality_code = municipality['key']
-        for label in municipality['energy_label']['buckets']:
-            results.append({
-                'municipality_code': municipality_code,
-                'energy_label': label['key'],
-                'count': label['doc_count']
-            })
-    
-    return pd.DataFrame(results)
+    return flatten_buckets(buckets, 'municipalities > energy_label', ['municipality_code', 'energy_label'],
+                           categorical=['municipality_code', 'energy_label'])
 
-if __name__ == "__main__":
+def main():
     try:
         input_file = os.environ.get('INPUT_FILE', 'buildings_1000.txt')
         output_file = os.environ.get('OUTPUT_FILE', 'buildings_1000.xlsx')
@@ -40,8 +34,8 @@ if __name__ == "__main__":
 
         # Calculate summary statistics
         total_buildings = df['count'].sum()
-        buildings_by_municipality = df.groupby('municipality_code')['count'].sum().sort_values(ascending=False)
-        buildings_by_label = df.groupby('energy_label')['count'].sum().sort_values(ascending=False)
+        buildings_by_municipality = df.groupby('municipality_code', observed=True)['count'].sum().sort_values(ascending=False)
+        buildings_by_label = df.groupby('energy_label', observed=True)['count'].sum().sort_values(ascending=False)
 
         # Prepare summary data
         summary_data = [
@@ -55,9 +49,9 @@ if __name__ == "__main__":
 
         # Save to Excel
         output_path = f"/app/output/{output_file}"
-        with pd.ExcelWriter(output_path, engine='openpyxl') as writer:
-            df.to_excel(writer, sheet_name='Detailed Data', index=False)
-            summary_df.to_excel(writer, sheet_name='Summary', index=False)
+        with ReportWriter(output_path) as writer:
+            writer.write_sheet(df, 'Detailed Data')
+            writer.write_sheet(summary_df, 'Summary')
 
         logging.info(f"Results saved to {output_path}")
 
@@ -65,4 +59,7 @@ if __name__ == "__main__":
         logging.error(f"Error: {str(e)}")
         raise
 
-    logging.info("Script completed successfully")
\ No newline at end of file
+    logging.info("Script completed successfully")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,157 @@
+import math
+import re
+from datetime import datetime, timezone
+
+# Bucket aggregations that can become composite sources, with the parameters
+# that can be carried over (size, min_doc_count, extended_bounds and format
+# are handled when the nested buckets are rebuilt)
+SOURCE_PARAMS = {
+    'terms': {'field', 'size'},
+    'histogram': {'field', 'interval', 'min_doc_count', 'extended_bounds'},
+    'date_histogram': {'field', 'calendar_interval', 'fixed_interval', 'interval', 'format', 'min_doc_count'},
+}
+ADAPTER_ONLY_PARAMS = {'size', 'min_doc_count', 'extended_bounds', 'format'}
+
+# Date format fields key_as_string can be rebuilt from, as strftime directives;
+# date_histograms with other fields in their format are not converted
+DATE_FORMAT_FIELDS = {'yyyy': '%Y', 'MM': '%m', 'dd': '%d', 'HH': '%H', 'mm': '%M', 'ss': '%S'}
+# key_as_string of a date_histogram without a format (strict_date_optional_time)
+DEFAULT_DATE_FORMAT = '%Y-%m-%dT%H:%M:%S.000Z'
+_DATE_FORMAT_TOKEN = re.compile(r'yyyy|MM|dd|HH|mm|ss|[A-Za-z]+|[^A-Za-z]+')
+
+
+def to_strftime(date_format):
+    """strftime pattern of an Elasticsearch date format, or None when it uses other fields."""
+    parts = []
+    for token in _DATE_FORMAT_TOKEN.findall(date_format):
+        if token in DATE_FORMAT_FIELDS:
+            parts.append(DATE_FORMAT_FIELDS[token])
+        elif token[0].isalpha():
+            return None
+        else:
+            parts.append(token.replace('%', '%%'))
+    return ''.join(parts)
+
+
+def _sub_aggs(agg):
+    return agg.get('aggs', agg.get('aggregations', {}))
+
+
+class _Node:
+    __slots__ = ('doc_count', 'children', 'aggs')
+
+    def __init__(self):
+        self.doc_count = 0
+        self.children = {}
+        self.aggs = {}
+
+
+class CompositeAggregation:
+    """A chain of nested bucket aggregations fetched as one paged composite aggregation.
+
+    `request` is the composite aggregation to send, with every level of the
+    chain as a source. Each page of composite buckets is folded into a bucket
+    tree with `add_page`, and `to_aggregations` renders that tree back into
+    the nested terms/histogram response the parsers expect. Sources use
+    missing_bucket, so the parent doc_counts still include documents that are
+    missing a child field, just like the nested aggregations. Date sources
+    are keyed by epoch millis, and key_as_string is formatted from the key.
+    """
+
+    def __init__(self, name, levels, sub_aggs, size):
+        self.name = name
+        self.levels = levels
+        sources = []
+        for level_name, agg_type, params in levels:
+            source = {k: v for k, v in params.items() if k not in ADAPTER_ONLY_PARAMS}
+            source['missing_bucket'] = True
+            sources.append({level_name: {agg_type: source}})
+        self.request = {'composite': {'size': size, 'sources': sources}}
+        if sub_aggs:
+            self.request['aggs'] = sub_aggs
+        self._root = _Node()
+
+    def set_after(self, after_key):
+        self.request['composite']['after'] = after_key
+
+    def add_page(self, buckets):
+        for bucket in buckets:
+            doc_count = bucket['doc_count']
+            node = self._root
+            node.doc_count += doc_count
+            for level_name, _, _ in self.levels:
+                key = bucket['key'][level_name]
+                if key is None:
+                    # Missing value: only counted in the parent levels
+                    break
+                node = node.children.setdefault(key, _Node())
+                node.doc_count += doc_count
+            else:
+                node.aggs = {k: v for k, v in bucket.items() if k not in ('key', 'doc_count')}
+
+    def to_aggregations(self):
+        return {self.name: self._render(self._root, 0)}
+
+    def _render(self, node, depth):
+        level_name, agg_type, params = self.levels[depth]
+        children = dict(node.children)
+
+        if agg_type == 'histogram' and params.get('min_doc_count', 0) == 0:
+            self._fill_histogram_gaps(children, params)
+
+        buckets = []
+        for key, child in children.items():
+            bucket = {'key': key, 'doc_count': child.doc_count}
+            if isinstance(key, bool):
+                bucket['key'], bucket['key_as_string'] = int(key), str(key).lower()
+            elif agg_type == 'date_histogram':
+                date = datetime.fromtimestamp(key / 1000, timezone.utc)
+                bucket['key_as_string'] = date.strftime(to_strftime(params['format']) if 'format' in params
+                                                        else DEFAULT_DATE_FORMAT)
+            if depth + 1 < len(self.levels):
+                bucket[self.levels[depth + 1][0]] = self._render(child, depth + 1)
+            else:
+                bucket.update(child.aggs)
+            buckets.append(bucket)
+
+        if agg_type == 'terms':
+            # Same order as a terms aggregation: most documents first, then by key
+            buckets.sort(key=lambda b: (-b['doc_count'], b['key']))
+            return {'doc_count_error_upper_bound': 0, 'sum_other_doc_count': 0, 'buckets': buckets}
+        buckets.sort(key=lambda b: b['key'])
+        return {'buckets': buckets}
+
+    @staticmethod
+    def _fill_histogram_gaps(children, params):
+        # A histogram returns empty buckets between its first and last key
+        # (and across extended_bounds); composite only returns non-empty ones
+        interval = params['interval']
+        keys = [key / interval for key in children]
+        bounds = params.get('extended_bounds', {})
+        keys += [math.floor(bounds[b] / interval) for b in ('min', 'max') if b in bounds]
+        if not keys:
+            return
+        for i in range(round(min(keys)), round(max(keys)) + 1):
+            children.setdefault(float(i * interval), _Node())
+
+
+def from_aggs(aggs, size):
+    """Build a CompositeAggregation from a query's `aggs`, or return None when
+    the aggregations are not a single chain of terms/histogram levels."""
+    levels = []
+    current = aggs
+    while len(current) == 1:
+        level_name, agg = next(iter(current.items()))
+        agg_type = next((t for t in SOURCE_PARAMS if t in agg), None)
+        if agg_type is None or set(agg) - {agg_type, 'aggs', 'aggregations'}:
+            break
+        if set(agg[agg_type]) - SOURCE_PARAMS[agg_type]:
+            break
+        if 'format' in agg[agg_type] and to_strftime(agg[agg_type]['format']) is None:
+            break
+        levels.append((level_name, agg_type, agg[agg_type]))
+        current = _sub_aggs(agg)
+
+    if not levels:
+        return None
+    return CompositeAggregation(levels[0][0], levels, current, size)
@@ -1,33 +1,22 @@
-import json
 import pandas as pd
 import os
 import logging
+from es_reader import read_aggregation_output
+from report_writer import ReportWriter
+from table_cache import cached_table
+from flatten_aggs import flatten_buckets
 
 logging.basicConfig(filename='/app/logs/construction_years.log', level=logging.INFO, 
                     format='%(asctime)s - %(levelname)s - %(message)s')
 
+@cached_table
 def parse_elasticsearch_output(file_path):
-    with open(file_path, 'r') as file:
-        data = json.load(file)
+    data, buckets = read_aggregation_output(file_path)
     
-    results = []
-    
-    for municipality in data['aggregations']['municipalities']['buckets']:
-        municipality_code = municipality['key']
-        
-        for year in municipality['construction_years']['buckets']:
-            construction_year = year['key']
-            count = year['doc_count']
-            
-            results.append({
-                'municipality_code': municipality_code,
-                'construction_year': construction_year,
-                'count': count
-            })
-    
-    return pd.DataFrame(results)
+    return flatten_buckets(buckets, 'municipalities > construction_years', ['municipality_code', 'construction_year'],
+                           categorical=['municipality_code'])
 
-if __name__ == "__main__":
+def main():
     try:
         input_file = os.environ.get('INPUT_FILE', 'construction_years.txt')
         output_file = os.environ.get('OUTPUT_FILE', 'construction_years.xlsx')
@@ -55,15 +44,15 @@ if __name__ == "__main__":
 
         # Save to Excel
         output_path = f"/app/output/{output_file}"
-        with pd.ExcelWriter(output_path, engine='openpyxl') as writer:
-            df.to_excel(writer, sheet_name='Municipality Data', index=False)
+        with ReportWriter(output_path) as writer:
+            writer.write_sheet(df, 'Municipality Data')
             
             # Create a summary sheet
             summary_df = pd.DataFrame({
                 'Metric': ['Total Units', 'Median Construction Year', 'Avg Units per Year', 'Max Units in a Year', 'Min Units in a Year'],
                 'Value': [total_buildings, median_year, avg_buildings_per_year.mean(), max_buildings.max(), min_buildings.min()]
             })
-            summary_df.to_excel(writer, sheet_name='Summary', index=False)
+            writer.write_sheet(summary_df, 'Summary')
 
         logging.info(f"Results saved to {output_path}")
 
@@ -71,4 +60,7 @@ if __name__ == "__main__":
         logging.error(f"Error: {str(e)}")
         raise
 
-    logging.info("Script completed successfully")
\ No newline at end of file
+    logging.info("Script completed successfully")
+
+if __name__ == "__main__":
+    main()
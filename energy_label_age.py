@@ -1,54 +1,70 @@
-import json
+import numpy as np
 import pandas as pd
 import os
 from datetime import datetime
 import logging
+from es_reader import read_aggregation_output
+from flatten_aggs import Columns
+import metrics
+from report_writer import ReportWriter
 
 logging.basicConfig(filename='/app/logs/energy_label_age.log', level=logging.INFO, 
                     format='%(asctime)s - %(levelname)s - %(message)s')
 
+# Labels up to this many whole years old get an energy_label_created_<year> column
+MAX_LABEL_AGE = 10
+MILLIS_PER_DAY = 24 * 3600 * 1000
+CREATED_PREFIX = 'energy_label_created_'
+
+def count_by_age(n_rows, rows, keys, counts, now):
+    """Doc counts summed by (row, age in whole years since the bucket date), as an (n_rows, MAX_LABEL_AGE + 1) array.
+
+    The age is (now - date).days // 365 as before, with the naive `now`
+    compared to the UTC bucket dates.
+    """
+    now_millis = int((now - datetime(1970, 1, 1)).total_seconds() * 1000)
+    ages = (now_millis - np.asarray(keys, dtype=np.int64)) // MILLIS_PER_DAY // 365
+    rows = np.asarray(rows, dtype=np.int64)
+    in_range = (ages >= 0) & (ages <= MAX_LABEL_AGE)
+    cells = rows[in_range] * (MAX_LABEL_AGE + 1) + ages[in_range]
+    summed = np.bincount(cells, weights=np.asarray(counts, dtype=np.float64)[in_range],
+                         minlength=n_rows * (MAX_LABEL_AGE + 1))
+    return summed.reshape(n_rows, MAX_LABEL_AGE + 1).astype(np.int64)
+
+@metrics.stage('flatten')
 def parse_energy_labels(file_path):
-    with open(file_path, 'r') as file:
-        data = json.load(file)
-    
-    results = []
-    today = datetime.now()
-    
-    for municipality in data['aggregations']['municipalities']['buckets']:
+    data, buckets = read_aggregation_output(file_path)
+    now = datetime.now()
+
+    labels = Columns(['municipality_code', 'energy_label', 'label_count'])
+    # One entry per label_age bucket: the label row it belongs to, its key and doc_count
+    age_rows, age_keys, age_counts = [], [], []
+    row = 0
+    for municipality in buckets:
         municipality_code = municipality['key']
-        
         for label in municipality['energy_label']['buckets']:
-            label_key = label['key']
-            label_count = label['doc_count']
             age_buckets = label['label_age']['buckets']
-            
-            age_counts = {i: 0 for i in range(11)}
-            
-            for age_bucket in age_buckets:
-                date = datetime.strptime(age_bucket['key_as_string'], "%Y-%m-%d")
-                age = (today - date).days // 365
-                if 0 <= age < 11:
-                    age_counts[age] += age_bucket['doc_count']
-            
-            row = {
-                'municipality_code': municipality_code,
-                'energy_label': label_key,
-                'label_count': label_count
-            }
-            row.update({f'energy_label_created_{2024-i}': age_counts[i] for i in range(11)})
-            
-            results.append(row)
-    
-    return pd.DataFrame(results)
+            age_rows.extend([row] * len(age_buckets))
+            age_keys.extend([age_bucket['key'] for age_bucket in age_buckets])
+            age_counts.extend([age_bucket['doc_count'] for age_bucket in age_buckets])
+            labels.append(municipality_code, label['key'], label['doc_count'])
+            row += 1
 
-def calculate_weighted_average_age(row):
-    total_count = sum(row[f'energy_label_created_{year}'] for year in range(2014, 2025))
-    if total_count == 0:
-        return 0
-    weighted_sum = sum((2024 - year) * row[f'energy_label_created_{year}'] for year in range(2014, 2025))
-    return weighted_sum / total_count
+    df = labels.to_frame()
+    counts = count_by_age(len(df), age_rows, age_keys, age_counts, now)
+    for age in range(MAX_LABEL_AGE + 1):
+        df[f'{CREATED_PREFIX}{now.year - age}'] = counts[:, age]
+    return df
 
-if __name__ == "__main__":
+def calculate_weighted_average_ages(df):
+    """Average age of the labels of every row, weighted by the energy_label_created_<year> counts (0 without any)."""
+    # The columns are in age order, from 0 years old (the current year) up
+    counts = df[[column for column in df.columns if column.startswith(CREATED_PREFIX)]].to_numpy()
+    total_counts = counts.sum(axis=1)
+    weighted_sums = counts @ np.arange(counts.shape[1])
+    return np.divide(weighted_sums, total_counts, out=np.zeros(len(df)), where=total_counts > 0)
+
+def main():
     try:
         energy_labels_file = os.environ.get('INPUT_FILE', 'energy_label_age.txt')
         output_file = os.environ.get('OUTPUT_FILE', 'energy_label_age.xlsx')
@@ -63,18 +79,17 @@ if __name__ == "__main__":
         logging.info(f"Energy labels data processed. Shape: {df.shape}")
         
         # Calculate weighted average age for each row
-        df['weighted_avg_energy_label_age'] = df.apply(calculate_weighted_average_age, axis=1)
+        df['weighted_avg_energy_label_age'] = calculate_weighted_average_ages(df)
         logging.info("Weighted average age calculated for each row")
-        
+
         # Calculate overall weighted average age for each municipality
-        municipality_avg_age = df.groupby('municipality_code').apply(
-            lambda x: sum(x['weighted_avg_energy_label_age'] * x['label_count']) / x['label_count'].sum()
-        ).reset_index(name='municipality_weighted_avg_energy_label_age')
+        sums = pd.DataFrame({
+            'weighted_age': df['weighted_avg_energy_label_age'] * df['label_count'],
+            'label_count': df['label_count'],
+        }).groupby(df['municipality_code']).transform('sum')
+        df['municipality_weighted_avg_energy_label_age'] = sums['weighted_age'] / sums['label_count']
         logging.info("Overall weighted average age calculated for each municipality")
-        
-        # Merge the municipality average age back to the main dataframe
-        df = df.merge(municipality_avg_age, on='municipality_code')
-        
+
         # Sort by municipality code and label count
         df = df.sort_values(['municipality_code', 'label_count'], ascending=[True, False])
         
@@ -91,15 +106,15 @@ if __name__ == "__main__":
 
         # Save to Excel
         output_path = f"/app/output/{output_file}"
-        with pd.ExcelWriter(output_path, engine='openpyxl') as writer:
-            df.to_excel(writer, sheet_name='Municipality Data', index=False)
+        with ReportWriter(output_path) as writer:
+            writer.write_sheet(df, 'Municipality Data')
             
             # Create a summary sheet
             summary_df = pd.DataFrame({
                 'Metric': ['Total Energy Labels', 'Average Label Age', 'Newest Label Age', 'Oldest Label Age'],
                 'Value': [total_labels, avg_age, newest_label_age, oldest_label_age]
             })
-            summary_df.to_excel(writer, sheet_name='Summary', index=False)
+            writer.write_sheet(summary_df, 'Summary')
 
         logging.info(f"Results saved to {output_path}")
 
@@ -107,4 +122,7 @@ if __name__ == "__main__":
         logging.error(f"Error: {str(e)}")
         raise
 
-    logging.info("Script completed successfully")
\ No newline at end of file
+    logging.info("Script completed successfully")
+
+if __name__ == "__main__":
+    main()
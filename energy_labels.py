@@ -1,7 +1,9 @@
-import json
 import pandas as pd
 import os
 import logging
+from es_reader import read_aggregation_output
+import metrics
+from report_writer import ReportWriter
 
 logging.basicConfig(filename='/app/logs/energy_labels.log', level=logging.INFO, 
                     format='%(asctime)s - %(levelname)s - %(message)s')
@@ -9,31 +11,43 @@ logging.basicConfig(filename='/app/logs/energy_labels.log', level=logging.INFO,
 # Hardcoded path for municipalities file
 MUNICIPALITIES_FILE = "/app/data/total_units.txt"
 
+@metrics.stage('flatten')
 def parse_municipalities(file_path):
-    with open(file_path, 'r') as file:
-        data = json.load(file)
+    data, buckets = read_aggregation_output(file_path)
     
     results = {}
     
-    for municipality in data['aggregations']['municipalities']['buckets']:
+    for municipality in buckets:
         municipality_code = municipality['key']
         count = municipality['doc_count']
         results[municipality_code] = count
     
     return results
 
+@metrics.stage('flatten')
 def parse_energy_labels(file_path):
-    with open(file_path, 'r') as file:
-        data = json.load(file)
+    """({label: count}, totals) by municipality code.
+
+    totals is (total units, labeled units, label percentage) as computed by the
+    pipeline query (query/pipeline/energy_labels.json), or None for data
+    fetched with the plain energy_labels.json, whose totals come from total_units.txt.
+    """
+    data, buckets = read_aggregation_output(file_path)
     
     results = {}
     
-    for municipality in data['aggregations']['municipalities']['buckets']:
+    for municipality in buckets:
         municipality_code = municipality['key']
+        totals = None
+        labeled = municipality
+        if 'labeled' in municipality:
+            # The pipeline query nests the labels in a filter on labeled units
+            labeled = municipality['labeled']
+            totals = (municipality['doc_count'], labeled['doc_count'], municipality['label_percentage']['value'])
         energy_labels = {}
-        for label in municipality['energy_label']['buckets']:
+        for label in labeled['energy_label']['buckets']:
             energy_labels[label['key']] = label['doc_count']
-        results[municipality_code] = energy_labels
+        results[municipality_code] = (energy_labels, totals)
     
     return results
 
@@ -41,14 +55,18 @@ def combine_data(municipalities, energy_labels):
     results = []
     
     for code, total in municipalities.items():
-        labels = energy_labels.get(code, {})
-        labeled_count = sum(labels.values())
+        labels, totals = energy_labels.get(code, ({}, None))
+        if totals:
+            _, labeled_count, label_percentage = totals
+        else:
+            labeled_count = sum(labels.values())
+            label_percentage = (labeled_count / total) * 100 if total > 0 else 0
         
         row = {
             'municipality_code': code,
             'total_units': total,
             'labeled_buildings': labeled_count,
-            'label_percentage': (labeled_count / total) * 100 if total > 0 else 0
+            'label_percentage': label_percentage
         }
         
         # Add counts for each energy label
@@ -59,29 +77,34 @@ def combine_data(municipalities, energy_labels):
     
     return pd.DataFrame(results)
 
-if __name__ == "__main__":
+def main():
     try:
         energy_labels_file = os.environ.get('INPUT_FILE', 'energy_labels.txt')
         output_file = os.environ.get('OUTPUT_FILE', 'energy_labels.xlsx')
 
         energy_labels_path = f"/app/data/{energy_labels_file}"
         
-        if not os.path.exists(MUNICIPALITIES_FILE):
-            logging.error(f"Municipalities file not found at {MUNICIPALITIES_FILE}")
-            raise FileNotFoundError(f"Municipalities file not found at {MUNICIPALITIES_FILE}")
-        
         if not os.path.exists(energy_labels_path):
             logging.error(f"Energy labels file not found at {energy_labels_path}")
             raise FileNotFoundError(f"Energy labels file not found at {energy_labels_path}")
 
-        logging.info("Parsing municipalities data...")
-        municipalities = parse_municipalities(MUNICIPALITIES_FILE)
-        logging.info(f"Municipalities data parsed. Number of municipalities: {len(municipalities)}")
-        
         logging.info("Parsing energy labels data...")
         energy_labels = parse_energy_labels(energy_labels_path)
         logging.info(f"Energy labels data parsed. Number of municipalities with labels: {len(energy_labels)}")
         
+        label_totals = {code: totals for code, (_, totals) in energy_labels.items() if totals}
+        if label_totals:
+            logging.info("Unit totals and label percentages were computed by the query's pipeline aggregations")
+            municipalities = {code: totals[0] for code, totals in label_totals.items()}
+        else:
+            if not os.path.exists(MUNICIPALITIES_FILE):
+                logging.error(f"Municipalities file not found at {MUNICIPALITIES_FILE}")
+                raise FileNotFoundError(f"Municipalities file not found at {MUNICIPALITIES_FILE}")
+
+            logging.info("Parsing municipalities data...")
+            municipalities = parse_municipalities(MUNICIPALITIES_FILE)
+        logging.info(f"Municipalities data parsed. Number of municipalities: {len(municipalities)}")
+        
         logging.info("Combining data...")
         df = combine_data(municipalities, energy_labels)
         logging.info(f"Data combined. Shape of resulting dataframe: {df.shape}")
@@ -104,8 +127,8 @@ if __name__ == "__main__":
 
         # Save to Excel
         output_path = f"/app/output/{output_file}"
-        with pd.ExcelWriter(output_path, engine='openpyxl') as writer:
-            df.to_excel(writer, sheet_name='Municipality Data', index=False)
+        with ReportWriter(output_path) as writer:
+            writer.write_sheet(df, 'Municipality Data')
             
             # Create a summary sheet
             summary_data = {
@@ -116,7 +139,7 @@ if __name__ == "__main__":
                          label_totals.tolist() + label_percentages.tolist()
             }
             summary_df = pd.DataFrame(summary_data)
-            summary_df.to_excel(writer, sheet_name='Summary', index=False)
+            writer.write_sheet(summary_df, 'Summary')
 
         logging.info(f"Results saved to {output_path}")
 
@@ -124,4 +147,7 @@ if __name__ == "__main__":
         logging.error(f"An error occurred: {str(e)}")
         raise
 
-    logging.info("Script completed successfully")
\ No newline at end of file
+    logging.info("Script completed successfully")
+
+if __name__ == "__main__":
+    main()
@@ -1,61 +1,88 @@
 import json
+import numpy as np
 import pandas as pd
 import os
 from datetime import datetime
 import logging
+from es_reader import read_aggregation_output
+import metrics
+from report_writer import ReportWriter
+from flatten_aggs import flatten_buckets
 
 logging.basicConfig(filename='/app/logs/energy_labels_year_of_construction.log', level=logging.INFO, 
                     format='%(asctime)s - %(levelname)s - %(message)s')
 
 ENERGY_LABEL_ORDER = ['A2020', 'A2015', 'A2010', 'B', 'C', 'D', 'E', 'F', 'G']
+# Anomaly rules as 'label:age' pairs: a label up to `label` in ENERGY_LABEL_ORDER on
+# buildings older than `age` years is flagged. Labels outside ENERGY_LABEL_ORDER
+# rank as the best label.
+ANOMALY_RULES = os.environ.get('ENERGY_LABEL_ANOMALY_RULES', 'A2010:100,C:150')
+# The query the data is fetched with; its construction_year_histogram interval sets the bucket width
+QUERY_FILE = os.path.join('query', 'energy_labels_year_of_construction.json')
 
-def parse_energy_labels(file_path):
-    with open(file_path, 'r') as file:
-        data = json.load(file)
+def parse_anomaly_rules(rules):
+    """'A2010:100,C:150' -> [(2, 100.0), (4, 150.0)], as (worst label rank, age above which it is flagged)."""
+    parsed = []
+    for rule in rules.split(','):
+        label, _, age = rule.strip().partition(':')
+        if label not in ENERGY_LABEL_ORDER or not age:
+            raise ValueError(f"Invalid anomaly rule {rule!r}, expected <label>:<age> with a label from {ENERGY_LABEL_ORDER}")
+        parsed.append((ENERGY_LABEL_ORDER.index(label), float(age)))
+    return parsed
+
+def get_label_ranks(labels):
+    """Position of every label in ENERGY_LABEL_ORDER (-1 for other labels), through an ordered categorical."""
+    return pd.Categorical(labels, categories=ENERGY_LABEL_ORDER, ordered=True).codes
+
+def get_interval(query_file=QUERY_FILE):
+    """The interval of the construction_year_histogram aggregation in `query_file`."""
+    with open(query_file, 'r', encoding='utf-8') as f:
+        aggs = json.load(f)['aggs']
+    for name in ('municipalities', 'energy_label', 'construction_year_histogram'):
+        agg = aggs[name]
+        aggs = agg.get('aggs', {})
+    return agg['histogram']['interval']
+
+@metrics.stage('flatten')
+def parse_energy_labels(file_path, interval=None):
+    """Buckets by municipality, label and construction year; `interval` defaults to the one of QUERY_FILE."""
+    data, buckets = read_aggregation_output(file_path)
+    if interval is None:
+        interval = get_interval()
     
-    results = []
     current_year = datetime.now().year
     
-    for municipality in data['aggregations']['municipalities']['buckets']:
-        municipality_code = municipality['key']
-        
-        for label in municipality['energy_label']['buckets']:
-            label_key = label['key']
-            
-            for year_bucket in label['construction_year_histogram']['buckets']:
-                construction_year_start = year_bucket['key']
-                construction_year_end = construction_year_start + 9
-                count = year_bucket['doc_count']
-                
-                # Calculate the average age of the buildings in this bucket
-                avg_construction_year = construction_year_start + 5
-                building_age = current_year - avg_construction_year
-                
-                results.append({
-                    'municipality_code': municipality_code,
-                    'energy_label': label_key,
-                    'construction_year_range': f"{construction_year_start}-{construction_year_end}",
-                    'avg_building_age': building_age,
-                    'count': count
-                })
+    df = flatten_buckets(buckets, 'municipalities > energy_label > construction_year_histogram',
+                         ['municipality_code', 'energy_label', 'construction_year_range'])
     
-    return pd.DataFrame(results)
+    # Histogram keys are the first year of each bucket (a decade in the shipped query)
+    construction_year_start = df['construction_year_range']
+    codes, starts = pd.factorize(construction_year_start)
+    ranges = np.array([f"{start}-{start + interval - 1}" if interval != 1 else f"{start}"
+                       for start in starts.tolist()], dtype=object)
+    df['construction_year_range'] = ranges[codes]
+    # Calculate the average age of the buildings in each bucket
+    df.insert(3, 'avg_building_age', current_year - (construction_year_start + interval // 2))
+    return df
 
-def calculate_weighted_average_age(group):
-    return (group['avg_building_age'] * group['count']).sum() / group['count'].sum()
+def calculate_weighted_average_ages(df, by):
+    """avg_building_age weighted by count within the groups of `by`, for every row."""
+    sums = pd.DataFrame({
+        'weighted_age': df['avg_building_age'] * df['count'],
+        'count': df['count'],
+    }).groupby([df[column] for column in by]).transform('sum')
+    return sums['weighted_age'] / sums['count']
 
-def flag_anomalies(row):
-    label_index = ENERGY_LABEL_ORDER.index(row['energy_label']) if row['energy_label'] in ENERGY_LABEL_ORDER else -1
-    age = row['avg_building_age']
-    
-    if label_index < 3 and age > 100:  # High energy rating (A2020, A2015, A2010, B) for very old buildings
-        return 'Potential anomaly'
-    elif label_index < 5 and age > 150:  # Good energy rating (up to C) for extremely old buildings
-        return 'Potential anomaly'
-    else:
-        return 'Normal'
+def flag_anomalies(df, rules):
+    """'Potential anomaly' for the rows matching any of the (label rank, age) rules, 'Normal' otherwise."""
+    ranks = get_label_ranks(df['energy_label'])
+    ages = df['avg_building_age'].to_numpy()
+    anomalous = np.zeros(len(df), dtype=bool)
+    for worst_rank, age in rules:
+        anomalous |= (ranks <= worst_rank) & (ages > age)
+    return np.where(anomalous, 'Potential anomaly', 'Normal')
 
-if __name__ == "__main__":
+def main():
     try:
         energy_labels_file = os.environ.get('INPUT_FILE', 'energy_labels_year_of_construction.txt')
         output_file = os.environ.get('OUTPUT_FILE', 'energy_labels_year_of_construction.xlsx')
@@ -70,25 +97,16 @@ if __name__ == "__main__":
         logging.info(f"Energy labels data processed. Shape: {df.shape}")
         
         # Calculate weighted average building age for each municipality and energy label
-        weighted_avg_age = df.groupby(['municipality_code', 'energy_label']).apply(calculate_weighted_average_age)
-        weighted_avg_age_df = weighted_avg_age.reset_index()
-        weighted_avg_age_df.columns = ['municipality_code', 'energy_label', 'energy_label_weighted_avg_building_age']
+        df['energy_label_weighted_avg_building_age'] = calculate_weighted_average_ages(
+            df, ['municipality_code', 'energy_label'])
         logging.info("Weighted average building age calculated for each municipality and energy label")
         
-        # Merge the weighted average age back to the main dataframe
-        df = df.merge(weighted_avg_age_df, on=['municipality_code', 'energy_label'])
-        
         # Calculate overall weighted average building age for each municipality
-        municipality_avg_age = df.groupby('municipality_code').apply(
-            lambda x: (x['avg_building_age'] * x['count']).sum() / x['count'].sum()
-        ).reset_index(name='municipality_weighted_avg_building_age')
+        df['municipality_weighted_avg_building_age'] = calculate_weighted_average_ages(df, ['municipality_code'])
         logging.info("Overall weighted average building age calculated for each municipality")
         
-        # Merge the municipality average age back to the main dataframe
-        df = df.merge(municipality_avg_age, on='municipality_code')
-        
         # Flag potential anomalies
-        df['anomaly_flag'] = df.apply(flag_anomalies, axis=1)
+        df['anomaly_flag'] = flag_anomalies(df, parse_anomaly_rules(ANOMALY_RULES))
         logging.info("Potential anomalies flagged")
         
         # Sort by municipality code, energy label, and construction year range
@@ -99,11 +117,15 @@ if __name__ == "__main__":
 
         # Save to Excel
         output_path = f"/app/output/{output_file}"
-        df.to_excel(output_path, index=False)
+        with ReportWriter(output_path) as writer:
+            writer.write_sheet(df, 'Sheet1')
         logging.info(f"Results saved to {output_path}")
 
     except Exception as e:
         logging.error(f"Error: {str(e)}")
         raise
 
-    logging.info("Script completed successfully")
\ No newline at end of file
+    logging.info("Script completed successfully")
+
+if __name__ == "__main__":
+    main()
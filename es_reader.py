@@ -0,0 +1,335 @@
+import json
+import os
+import re
+import time
+
+import metrics
+
+try:
+    import orjson
+except ImportError:  # the json module decodes everything without orjson
+    orjson = None
+
+# Characters of a data file decoded at a time by the streaming readers
+READ_CHUNK_SIZE = 1024 * 1024
+# Data files up to this size are decoded whole with orjson (when installed);
+# everything larger is streamed. Set to 0 to always stream
+FAST_DECODE_MAX_BYTES = int(os.environ.get('FAST_DECODE_MAX_BYTES', 4 * 1024 * 1024))
+
+HITS_PATH = ['hits', 'hits']
+
+_loads = orjson.loads if orjson is not None else json.loads
+_decoder = json.JSONDecoder()
+_scan = _decoder.scan_once
+_WHITESPACE = re.compile(r'[ \t\n\r]*')
+_NUMBER_CHARS = '0123456789.eE+-'
+_SEPARATOR = re.compile(r'[ \t\n\r]*([,\]])[ \t\n\r]*')
+
+
+class _StreamReader:
+    """Walks a JSON document in a file, decoding one value at a time.
+
+    Only the current value and the unread part of the current chunk are held
+    in memory, so arrays of any size can be iterated element by element.
+    """
+
+    def __init__(self, file):
+        self.file = file
+        self.buffer = ''
+        self.pos = 0
+        self.eof = False
+
+    def _fill(self):
+        if self.pos > READ_CHUNK_SIZE:
+            self.buffer = self.buffer[self.pos:]
+            self.pos = 0
+        chunk = self.file.read(READ_CHUNK_SIZE)
+        if not chunk:
+            self.eof = True
+        self.buffer += chunk
+
+    def peek(self):
+        """Skip whitespace and return the next character ('' at the end of the file)."""
+        while True:
+            self.pos = _WHITESPACE.match(self.buffer, self.pos).end()
+            if self.pos < len(self.buffer) or self.eof:
+                return self.buffer[self.pos:self.pos + 1]
+            self._fill()
+
+    def _next(self, expected):
+        char = self.peek()
+        if char not in expected:
+            raise ValueError(f"Expected one of {expected!r} but found {char!r} in {self.file.name}")
+        self.pos += 1
+        return char
+
+    def read_value(self):
+        if self.pos >= len(self.buffer) or self.buffer[self.pos] in ' \t\n\r':
+            self.peek()
+        while True:
+            try:
+                value, end = _scan(self.buffer, self.pos)
+                # A value that ends with the buffer, or a number followed by
+                # more of a number, may continue in the next chunk
+                if self.eof or (end < len(self.buffer) and self.buffer[end] not in _NUMBER_CHARS):
+                    self.pos = end
+                    return value
+            except (StopIteration, json.JSONDecodeError):
+                if self.eof:
+                    # Raise the decoder's own error for the invalid value
+                    _decoder.raw_decode(self.buffer, self.pos)
+            self._fill()
+
+    def members(self):
+        """Iterate over the keys of the object at the current position.
+
+        The caller must consume each member's value before asking for the next key.
+        """
+        self._next('{')
+        if self.peek() == '}':
+            self.pos += 1
+            return
+        while True:
+            key = self.read_value()
+            self._next(':')
+            yield key
+            if self._next(',}') == '}':
+                return
+
+    def values(self):
+        """Decode the elements of the array at the current position one at a time."""
+        self._next('[')
+        if self.peek() == ']':
+            self.pos += 1
+            return
+        while True:
+            yield self.read_value()
+            match = _SEPARATOR.match(self.buffer, self.pos)
+            if match is not None and match.end() < len(self.buffer):
+                self.pos = match.end()
+                separator = match.group(1)
+            else:
+                separator = self._next(',]')
+            if separator == ']':
+                return
+
+    def objects(self):
+        """For every object of the array at the current position, yield an iterator over its keys.
+
+        As with members(), each key's value must be consumed before the next
+        key; members the caller did not ask for are skipped.
+        """
+        self._next('[')
+        if self.peek() == ']':
+            self.pos += 1
+            return
+        while True:
+            keys = self.members()
+            yield keys
+            for _ in keys:
+                self.read_value()
+            if self._next(',]') == ']':
+                return
+
+
+_ARRAY_START = object()
+
+
+def _walk(reader, path, data, elements=_StreamReader.values):
+    # Decode the members of the object at the reader into `data`; at the
+    # array at `path`, yield _ARRAY_START and then its elements one by one
+    for key in reader.members():
+        if key != path[0]:
+            data[key] = reader.read_value()
+        elif len(path) > 1 and reader.peek() == '{':
+            data[key] = {}
+            yield from _walk(reader, path[1:], data[key], elements)
+        elif len(path) == 1 and reader.peek() == '[':
+            yield _ARRAY_START
+            yield from elements(reader)
+        else:
+            data[key] = reader.read_value()
+
+
+def _missing_array(data, path):
+    for key in path:
+        if not isinstance(data, dict) or key not in data:
+            raise KeyError(key)
+        data = data[key]
+    raise TypeError(f"{'.'.join(path)} is not an array")
+    yield
+
+
+def _split_document(data, path):
+    parent = data
+    for key in path[:-1]:
+        parent = parent.get(key) if isinstance(parent, dict) else None
+    if isinstance(parent, dict) and isinstance(parent.get(path[-1]), list):
+        return data, iter(parent.pop(path[-1]))
+    return data, _missing_array(data, path)
+
+
+def split_json(file_path, path):
+    """Read a JSON file in one pass and return (data, elements).
+
+    `data` is the document up to the array at `path` (a list of keys), and
+    `elements` decodes that array one element at a time; once it is used up,
+    any members after the array are added to `data` as well. When the
+    document has no such array, `data` is the whole document and iterating
+    `elements` raises KeyError, like indexing the loaded document would.
+
+    With orjson installed, small files (up to FAST_DECODE_MAX_BYTES) are
+    decoded in one call instead, and `elements` iterates over the decoded
+    array; that holds the whole document in memory, so it is kept to files
+    of a few MB.
+    """
+    if orjson is not None and os.path.getsize(file_path) <= FAST_DECODE_MAX_BYTES:
+        with open(file_path, 'rb') as f:
+            return _split_document(orjson.loads(f.read()), path)
+    data, elements, _ = _stream_array(file_path, path, _StreamReader.values)
+    return data, elements
+
+
+def _stream_array(file_path, path, elements):
+    # split_json's streaming read, with `elements` iterating over the array
+    file = open(file_path, 'r', encoding='utf-8')
+    reader = _StreamReader(file)
+    if reader.peek() != '{':
+        with file:
+            data = reader.read_value()
+        return data, _missing_array(data, path), reader
+
+    data = {}
+    walker = _walk(reader, path, data, elements)
+    if next(walker, None) is not _ARRAY_START:
+        file.close()
+        return data, _missing_array(data, path), reader
+
+    def iterate():
+        with file:
+            yield from walker
+    return data, iterate(), reader
+
+
+def iter_objects(file_path, path):
+    """Iterate over the objects of the array at `path` without decoding them whole.
+
+    Yields (reader, keys) for every object: `keys` iterates over its keys,
+    and the value of each key must be read with reader.read_value() or
+    copied with copy_value() before asking for the next key. Used to split a
+    large response (like an _msearch body) into files one value at a time.
+    """
+    _, objects, reader = _stream_array(file_path, path, _StreamReader.objects)
+    for keys in objects:
+        yield reader, keys
+
+
+def _dumps(value):
+    return json.dumps(value, ensure_ascii=False, separators=(',', ':'))
+
+
+def copy_value(reader, write):
+    """Copy the value at the reader as compact JSON through `write`.
+
+    Objects are copied member by member and arrays element by element, so
+    only one array element is decoded at a time.
+    """
+    char = reader.peek()
+    if char == '{':
+        copy_object(reader, reader.members(), write)
+    elif char == '[':
+        write('[')
+        for i, value in enumerate(reader.values()):
+            write(',' + _dumps(value) if i else _dumps(value))
+        write(']')
+    else:
+        write(_dumps(reader.read_value()))
+
+
+def copy_object(reader, keys, write, skip=()):
+    """Copy the object whose `keys` are being read (see iter_objects) through `write`.
+
+    The members named in `skip` are left out; their decoded values are
+    returned, by key.
+    """
+    skipped = {}
+    write('{')
+    first = True
+    for key in keys:
+        if key in skip:
+            skipped[key] = reader.read_value()
+            continue
+        write(_dumps(key) + ':' if first else ',' + _dumps(key) + ':')
+        copy_value(reader, write)
+        first = False
+    write('}')
+    return skipped
+
+
+def resolve_data_file(file_path):
+    """Return the data file an analysis should read for `file_path`.
+
+    A paged export (data/<name>.ndjson, written by `request_data.py --paged`)
+    is preferred over the plain data/<name>.txt response when it is at least
+    as recent, since it holds every hit instead of the first page only.
+    """
+    paged_path = os.path.splitext(file_path)[0] + '.ndjson'
+    if not os.path.exists(paged_path):
+        return file_path
+    if not os.path.exists(file_path) or os.path.getmtime(paged_path) >= os.path.getmtime(file_path):
+        return paged_path
+    return file_path
+
+
+def _iter_ndjson_hits(file):
+    with file:
+        for line in file:
+            if line.strip():
+                yield _loads(line)
+
+
+def _iter_hits(hits):
+    # filter_path leaves out an empty hits array altogether
+    try:
+        yield from hits
+    except KeyError:
+        return
+
+
+def _timed_decode(elements, file_path, seconds):
+    # Decoding runs while the caller consumes the elements; report it as the
+    # 'decode' stage of the current span (see metrics.timed)
+    name = None if metrics.current() else os.path.splitext(os.path.basename(file_path))[0]
+    return metrics.timed(elements, 'decode', seconds=seconds, nbytes=os.path.getsize(file_path), name=name)
+
+
+def read_search_output(file_path):
+    """Open a saved search response and return (data, hits).
+
+    `data` is the response without its hits (took, timed_out, hits.total,
+    ...) and `hits` iterates over the hits. The hits are decoded one at a
+    time (one line at a time for a paged .ndjson export), so the whole result
+    is never held in memory.
+    """
+    start = time.perf_counter()
+    if file_path.endswith('.ndjson'):
+        file = open(file_path, 'r', encoding='utf-8')
+        data = _loads(file.readline())
+        hits = _iter_ndjson_hits(file)
+    else:
+        data, hits = split_json(file_path, HITS_PATH)
+        hits = _iter_hits(hits)
+    return data, _timed_decode(hits, file_path, time.perf_counter() - start)
+
+
+def read_aggregation_output(file_path, name='municipalities'):
+    """Open a saved aggregation response and return (data, buckets).
+
+    `data` is the response without the buckets of aggregation `name`, and
+    `buckets` decodes them one at a time (see split_json). Iterating
+    `buckets` raises KeyError when the response has no such aggregation
+    (e.g. an error response).
+    """
+    start = time.perf_counter()
+    data, buckets = split_json(file_path, ['aggregations', name, 'buckets'])
+    return data, _timed_decode(buckets, file_path, time.perf_counter() - start)
@@ -0,0 +1,124 @@
+import numpy as np
+import pandas as pd
+
+
+def parse_path(path):
+    """Split a path spec like 'municipalities > unit_usage > building_areas' into its aggregation names."""
+    return [level.strip() for level in path.split('>')]
+
+
+def _to_array(values, categorical=False):
+    if categorical:
+        return pd.Categorical(values)
+    # pandas infers the dtype from the values, like it does for a list of row dicts
+    return pd.Series(values, dtype=None if values else object).to_numpy()
+
+
+def frame_from_columns(columns, categorical=()):
+    """Build a DataFrame in one step from a dict of column name -> list of values.
+
+    The columns named in `categorical` (municipality, usage, label codes, ...)
+    become pandas categoricals: one small integer code per row instead of a
+    Python object, which also makes grouping on them cheaper.
+    """
+    return pd.DataFrame({name: _to_array(values, name in categorical) for name, values in columns.items()})
+
+
+class Columns:
+    """Rows collected as one list per column, for parsers that cannot use flatten_buckets."""
+
+    def __init__(self, names, categorical=()):
+        self.columns = {name: [] for name in names}
+        self.categorical = categorical
+        self._lists = list(self.columns.values())
+
+    def append(self, *row):
+        for values, value in zip(self._lists, row):
+            values.append(value)
+
+    def to_frame(self):
+        return frame_from_columns(self.columns, self.categorical)
+
+
+class _BucketColumns:
+    """Column arrays of the flattened rows.
+
+    The key of a parent level is the same for all the rows below it, so
+    those columns are kept as (key, number of rows) runs and expanded with
+    numpy at the end, instead of one Python object per row.
+    """
+
+    __slots__ = ('parent_keys', 'repeats', 'keys', 'counts')
+
+    def __init__(self, depth):
+        self.parent_keys = [[] for _ in range(depth - 1)]
+        self.repeats = []
+        self.keys = []
+        self.counts = []
+
+    def add(self, prefix, keys, counts):
+        if not keys:
+            # Keys without rows must not take part in the dtype inference
+            return
+        for column, key in zip(self.parent_keys, prefix):
+            column.append(key)
+        self.repeats.append(len(keys))
+        self.keys.extend(keys)
+        self.counts.extend(counts)
+
+    def to_arrays(self, categorical):
+        repeats = np.array(self.repeats, dtype=np.int64)
+        arrays = []
+        for column, is_categorical in zip(self.parent_keys, categorical):
+            run_keys = _to_array(column, is_categorical)
+            if is_categorical:
+                arrays.append(pd.Categorical.from_codes(np.repeat(run_keys.codes, repeats), dtype=run_keys.dtype))
+            else:
+                arrays.append(np.repeat(run_keys, repeats))
+        arrays.append(_to_array(self.keys, categorical[-1]))
+        arrays.append(np.array(self.counts, dtype=np.int64 if not self.counts else None))
+        return arrays
+
+
+def flatten_buckets(buckets, path, key_columns, count_column='count', empty=None, other=None, categorical=()):
+    """Flatten nested terms/histogram buckets into a DataFrame with one row per leaf bucket.
+
+    `buckets` are the buckets of the first aggregation of `path` (e.g. from
+    es_reader.read_aggregation_output), and every following name in `path`
+    is the sub-aggregation one level down. `key_columns` names the column
+    that gets the bucket keys of each level, and `count_column` the leaf
+    doc_count.
+
+    With `empty`, a parent without leaf buckets still gets a row, keyed
+    `empty`, with the parent's doc_count. With `other`, the part of a
+    parent's doc_count not covered by its leaf buckets gets a row keyed
+    `other` after them. Key columns named in `categorical` are built as
+    pandas categoricals (see frame_from_columns).
+    """
+    levels = parse_path(path)
+    if len(key_columns) != len(levels):
+        raise ValueError(f"{len(levels)} levels in '{path}' but {len(key_columns)} key columns")
+
+    columns = _BucketColumns(len(levels))
+
+    def walk(bucket_list, depth, prefix, parent):
+        if depth + 1 < len(levels):
+            sub_level = levels[depth + 1]
+            for bucket in bucket_list:
+                walk(bucket[sub_level]['buckets'], depth + 1, prefix + (bucket['key'],), bucket)
+            return
+
+        keys = [bucket['key'] for bucket in bucket_list]
+        counts = [bucket['doc_count'] for bucket in bucket_list]
+        if parent is not None:
+            if not keys and empty is not None:
+                keys, counts = [empty], [parent['doc_count']]
+            elif other is not None and parent['doc_count'] > sum(counts):
+                keys.append(other)
+                counts.append(parent['doc_count'] - sum(counts))
+        columns.add(prefix, keys, counts)
+
+    walk(buckets, 0, (), None)
+
+    arrays = columns.to_arrays([name in categorical for name in key_columns])
+    return pd.DataFrame(dict(zip(key_columns + [count_column], arrays)))
@@ -1,46 +1,25 @@
-import json
 import pandas as pd
-from collections import defaultdict
 import os
 import logging
+from es_reader import read_aggregation_output
+from report_writer import ReportWriter
+from table_cache import cached_table
+from flatten_aggs import flatten_buckets
 
 logging.basicConfig(filename='/app/logs/heating_matrix.log', level=logging.INFO, 
                     format='%(asctime)s - %(levelname)s - %(message)s')
 
+@cached_table
 def parse_elasticsearch_output(file_path):
-    with open(file_path, 'r') as file:
-        data = json.load(file)
+    data, buckets = read_aggregation_output(file_path)
     
-    results = []
-    
-    for municipality in data['aggregations']['municipalities']['buckets']:
-        municipality_code = municipality['key']
-        
-        for installation in municipality['heatingInstallations']['buckets']:
-            installation_code = installation['key']
-            
-            medium_counts = defaultdict(int)
-            for medium in installation['heatingMediums']['buckets']:
-                medium_code = medium['key']
-                count = medium['doc_count']
-                medium_counts[medium_code] = count
-            
-            # If there are no heating mediums, we still want to count the installations
-            if not medium_counts:
-                medium_counts[''] = installation['doc_count']
-            
-            for medium_code, count in medium_counts.items():
-                results.append({
-                    'municipality_code': municipality_code,
-                    'installation_code': installation_code,
-                    'medium_code': medium_code,
-                    'count': count
-                })
-    
-    return pd.DataFrame(results)
+    # If there are no heating mediums, we still want to count the installations
+    return flatten_buckets(buckets, 'municipalities > heatingInstallations > heatingMediums',
+                           ['municipality_code', 'installation_code', 'medium_code'], empty='',
+                           categorical=['municipality_code', 'installation_code', 'medium_code'])
 
 
-if __name__ == "__main__":
+def main():
     try:
         input_file = os.environ.get('INPUT_FILE', 'heating_matrix.txt')
         output_file = os.environ.get('OUTPUT_FILE', 'heating_matrix.xlsx')
@@ -59,9 +38,9 @@ if __name__ == "__main__":
 
         # Calculate summary statistics
         total_installations = df['count'].sum()
-        installations_by_type = df.groupby('installation_code')['count'].sum().sort_values(ascending=False)
-        mediums_by_type = df.groupby('medium_code')['count'].sum().sort_values(ascending=False)
-        top_5_combinations = df.groupby(['installation_code', 'medium_code'])['count'].sum().sort_values(ascending=False).head()
+        installations_by_type = df.groupby('installation_code', observed=True)['count'].sum().sort_values(ascending=False)
+        mediums_by_type = df.groupby('medium_code', observed=True)['count'].sum().sort_values(ascending=False)
+        top_5_combinations = df.groupby(['installation_code', 'medium_code'], observed=True)['count'].sum().sort_values(ascending=False).head()
 
         logging.info(f"Summary statistics calculated: Total Installations={total_installations}")
         logging.info(f"Top 5 installation types:\n{installations_by_type.head().to_string()}")
@@ -70,8 +49,8 @@ if __name__ == "__main__":
 
         # Save to Excel
         output_path = f"/app/output/{output_file}"
-        with pd.ExcelWriter(output_path, engine='openpyxl') as writer:
-            df.to_excel(writer, sheet_name='Detailed Data', index=False)
+        with ReportWriter(output_path) as writer:
+            writer.write_sheet(df, 'Detailed Data')
             
             # Create a summary sheet
             summary_df = pd.DataFrame({
@@ -84,7 +63,7 @@ if __name__ == "__main__":
                          mediums_by_type.tolist() +
                          [f"{combo[0]},{combo[1]}: {count}" for combo, count in top_5_combinations.items()]
             })
-            summary_df.to_excel(writer, sheet_name='Summary', index=False)
+            writer.write_sheet(summary_df, 'Summary')
 
         logging.info(f"Results saved to {output_path}")
 
@@ -92,4 +71,7 @@ if __name__ == "__main__":
         logging.error(f"An error occurred: {str(e)}")
         raise
 
-    logging.info("Script completed successfully")
\ No newline at end of file
+    logging.info("Script completed successfully")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,166 @@
+import json
+import os
+import re
+import threading
+import time
+import traceback
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+
+# Number of jobs run at the same time; later submissions wait in the queue
+JOB_WORKERS = int(os.environ.get('JOB_WORKERS', 2))
+# Finished jobs are reported for this many seconds
+JOB_TTL = float(os.environ.get('JOB_TTL', 24 * 3600))
+JOB_DIR = os.path.join('logs', 'jobs')
+
+JOB_ID_PATTERN = re.compile(r'^[0-9a-f]{32}$')
+
+_executor = None
+_executor_lock = threading.Lock()
+# Queued and running jobs of this process, by the key they were submitted with
+_active = {}
+_active_lock = threading.Lock()
+
+
+def _now():
+    return datetime.now(timezone.utc).isoformat()
+
+
+def get_job_path(job_id):
+    return os.path.join(JOB_DIR, f"{job_id}.json")
+
+
+class Job:
+    """State of one background run.
+
+    Every change is written to logs/jobs/<id>.json, so the status endpoints
+    answer from any gunicorn worker, not only the one running the job.
+    """
+
+    def __init__(self, kind, name):
+        self.id = uuid.uuid4().hex
+        self.state = {
+            'id': self.id,
+            'kind': kind,
+            'name': name,
+            'status': 'queued',
+            'submitted_at': _now(),
+            'started_at': None,
+            'finished_at': None,
+            'progress': {'done': 0, 'total': None},
+            'stages': {},
+            'result': None,
+            'error': None,
+        }
+        self._lock = threading.Lock()
+        self.save()
+
+    def set_total(self, total):
+        with self._lock:
+            self.state['progress']['total'] = total
+        self.save()
+
+    def add_stage(self, name, status, seconds, error=None):
+        """Record a finished stage (a fetch or an analysis) and count it as progress."""
+        with self._lock:
+            self.state['stages'][name] = {'status': status, 'seconds': seconds, 'error': error}
+            self.state['progress']['done'] += 1
+        self.save()
+
+    def update(self, **fields):
+        with self._lock:
+            self.state.update(fields)
+        self.save()
+
+    def save(self):
+        os.makedirs(JOB_DIR, exist_ok=True)
+        path = get_job_path(self.id)
+        tmp_path = f"{path}.{threading.get_ident()}.part"
+        with self._lock:
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                json.dump(self.state, f, indent=2)
+            os.replace(tmp_path, path)
+
+
+def _get_executor():
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(max_workers=JOB_WORKERS, thread_name_prefix='job')
+        return _executor
+
+
+def _run(job, func, key):
+    job.update(status='running', started_at=_now())
+    start = time.perf_counter()
+    try:
+        result = func(job)
+        status = 'failed' if result.get('error') else 'succeeded'
+        error = result.get('error')
+    except Exception:
+        result, status, error = None, 'failed', traceback.format_exc()
+    finally:
+        if key is not None:
+            with _active_lock:
+                _active.pop(key, None)
+    result = dict(result or {}, seconds=round(time.perf_counter() - start, 3))
+    job.update(status=status, finished_at=_now(), result=result, error=error)
+
+
+def submit(kind, name, func, key=None):
+    """Queue `func(job)` on the job pool and return the Job right away.
+
+    `func` reports progress through the job and returns a result dict;
+    a result with an 'error' entry, or an exception, marks the job failed.
+    While a job submitted with the same `key` is queued or running, that job
+    is returned instead of starting an identical one. That only covers this
+    process; across gunicorn workers, the fetches and analyses of the job
+    wait for each other through file locks (see single_flight.file_lock).
+    """
+    with _active_lock:
+        if key is not None and key in _active:
+            return _active[key]
+        prune_jobs()
+        job = Job(kind, name)
+        if key is not None:
+            _active[key] = job
+    _get_executor().submit(_run, job, func, key)
+    return job
+
+
+def get_job(job_id):
+    """Return the saved state of a job, or None for an unknown id."""
+    if not JOB_ID_PATTERN.match(job_id) or not os.path.exists(get_job_path(job_id)):
+        return None
+    with open(get_job_path(job_id), 'r', encoding='utf-8') as f:
+        return json.load(f)
+
+
+def list_jobs(limit=50):
+    """Return the most recently submitted jobs, newest first."""
+    if not os.path.isdir(JOB_DIR):
+        return []
+    jobs = []
+    for file in os.listdir(JOB_DIR):
+        if file.endswith('.json'):
+            job = get_job(os.path.splitext(file)[0])
+            if job:
+                jobs.append(job)
+    jobs.sort(key=lambda job: job['submitted_at'], reverse=True)
+    return jobs[:limit]
+
+
+def prune_jobs(ttl=None):
+    """Delete the state of jobs that were submitted more than `ttl` seconds ago."""
+    ttl = JOB_TTL if ttl is None else ttl
+    if not os.path.isdir(JOB_DIR):
+        return
+    cutoff = time.time() - ttl
+    for file in os.listdir(JOB_DIR):
+        path = os.path.join(JOB_DIR, file)
+        try:
+            if os.path.getmtime(path) < cutoff:
+                os.remove(path)
+        except OSError:
+            pass
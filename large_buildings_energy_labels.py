@@ -1,36 +1,28 @@
-import json
 import pandas as pd
 import os
 import logging
+from es_reader import read_aggregation_output
+from report_writer import ReportWriter
+from table_cache import cached_table
+from flatten_aggs import flatten_buckets
 
 logging.basicConfig(filename='/app/logs/large_buildings_energy_labels.log', level=logging.INFO, 
                     format='%(asctime)s - %(levelname)s - %(message)s')
 
 EXCLUDED_USAGE_CODES = [110, 120, 121, 122, 130, 131, 132, 140, 150, 160, 190, 510, 90]
 
+@cached_table
 def parse_elasticsearch_output(file_path):
-    with open(file_path, 'r') as file:
-        data = json.load(file)
+    data, buckets = read_aggregation_output(file_path)
     
     total_hits = data['hits']['total']['value']
     logging.info(f"Total large buildings (1000+ m²) with energy labels, excluding certain usage codes: {total_hits}")
 
-    results = []
-    for municipality in data['aggregations']['municipalities']['buckets']:
-        municipality_code = municipality['key']
-        for usage in municipality['unit_usage']['buckets']:
-            unit_usage = usage['key']
-            for label in usage['energy_label']['buckets']:
-                results.append({
-                    'municipality_code': municipality_code,
-                    'unit_usage': unit_usage,
-                    'energy_label': label['key'],
-                    'count': label['doc_count']
-                })
-    
-    return pd.DataFrame(results)
+    return flatten_buckets(buckets, 'municipalities > unit_usage > energy_label',
+                           ['municipality_code', 'unit_usage', 'energy_label'],
+                           categorical=['municipality_code', 'unit_usage', 'energy_label'])
 
-if __name__ == "__main__":
+def main():
     try:
         input_file = os.environ.get('INPUT_FILE', 'large_buildings_energy_labels.txt')
         output_file = os.environ.get('OUTPUT_FILE', 'large_buildings_energy_labels.xlsx')
@@ -45,10 +37,10 @@ if __name__ == "__main__":
 
         # Calculate summary statistics
         total_buildings = df['count'].sum()
-        buildings_by_municipality = df.groupby('municipality_code')['count'].sum().sort_values(ascending=False)
-        buildings_by_usage = df.groupby('unit_usage')['count'].sum().sort_values(ascending=False)
-        buildings_by_label = df.groupby('energy_label')['count'].sum().sort_values(ascending=False)
-        top_combinations = df.groupby(['municipality_code', 'unit_usage', 'energy_label'])['count'].sum().sort_values(ascending=False).head(10)
+        buildings_by_municipality = df.groupby('municipality_code', observed=True)['count'].sum().sort_values(ascending=False)
+        buildings_by_usage = df.groupby('unit_usage', observed=True)['count'].sum().sort_values(ascending=False)
+        buildings_by_label = df.groupby('energy_label', observed=True)['count'].sum().sort_values(ascending=False)
+        top_combinations = df.groupby(['municipality_code', 'unit_usage', 'energy_label'], observed=True)['count'].sum().sort_values(ascending=False).head(10)
 
         # Prepare summary data
         summary_data = [
@@ -66,9 +58,9 @@ if __name__ == "__main__":
 
         # Save to Excel
         output_path = f"/app/output/{output_file}"
-        with pd.ExcelWriter(output_path, engine='openpyxl') as writer:
-            df.to_excel(writer, sheet_name='Detailed Data', index=False)
-            summary_df.to_excel(writer, sheet_name='Summary', index=False)
+        with ReportWriter(output_path) as writer:
+            writer.write_sheet(df, 'Detailed Data')
+            writer.write_sheet(summary_df, 'Summary')
 
         logging.info(f"Results saved to {output_path}")
 
@@ -77,4 +69,7 @@ if __name__ == "__main__":
         raise
 
     logging.info("Script completed successfully")
-    logging.info(f"Note: This analysis excludes unit usage codes {EXCLUDED_USAGE_CODES} and only includes buildings 1000 m² or larger.")
\ No newline at end of file
+    logging.info(f"Note: This analysis excludes unit usage codes {EXCLUDED_USAGE_CODES} and only includes buildings 1000 m² or larger.")
+
+if __name__ == "__main__":
+    main()
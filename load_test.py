@@ -0,0 +1,221 @@
+import argparse
+import ast
+import fnmatch
+import json
+import os
+import random
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import requests
+
+LOAD_TEST_URL = os.environ.get('LOAD_TEST_URL', 'http://127.0.0.1:5000')
+# Seconds to wait for one response, and between polls of a background job
+REQUEST_TIMEOUT = float(os.environ.get('LOAD_TEST_TIMEOUT', 600))
+JOB_POLL_INTERVAL = 0.2
+
+# Routes that can be driven: name -> (method, path); {script} and {query} are
+# filled in at random for every request
+ROUTES = {
+    'run': ('GET', '/run/{script}'),
+    'run_analysis': ('GET', '/run_analysis/{script}'),
+    'run_query': ('GET', '/run_query/{query}'),
+    'job': ('POST', '/jobs/run/{script}'),
+    'download': ('GET', '/download/{script}'),
+    'download_all': ('GET', '/download_all'),
+    'metrics': ('GET', '/metrics'),
+}
+DEFAULT_MIX = 'run_analysis:2,download:4,job:1,metrics:1'
+
+
+def get_scripts(patterns=None):
+    """The analysis scripts listed in app.py's SCRIPTS, read without importing the app."""
+    with open('app.py', 'r', encoding='utf-8') as f:
+        tree = ast.parse(f.read())
+    scripts = next(ast.literal_eval(node.value) for node in tree.body
+                   if isinstance(node, ast.Assign) and any(getattr(t, 'id', None) == 'SCRIPTS' for t in node.targets))
+    scripts = [script for script in scripts if script != 'request_data.py']
+    if patterns:
+        scripts = [script for script in scripts if any(fnmatch.fnmatch(script, p) for p in patterns)]
+    return scripts
+
+
+def parse_mix(mix):
+    """'run_analysis:2,download:4' -> {'run_analysis': 2.0, 'download': 4.0}"""
+    weights = {}
+    for part in mix.split(','):
+        name, _, weight = part.strip().partition(':')
+        if name not in ROUTES:
+            raise ValueError(f"Unknown route {name!r}, expected some of {sorted(ROUTES)}")
+        weights[name] = float(weight or 1)
+    return weights
+
+
+class Recorder:
+    """Outcomes of the requests made, by route."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.samples = {}
+
+    def add(self, route, seconds, first_byte, nbytes, error):
+        with self._lock:
+            self.samples.setdefault(route, []).append((seconds, first_byte, nbytes, error))
+
+    def summarize(self, elapsed):
+        summary = {}
+        everything = []
+        for route, samples in sorted(self.samples.items()):
+            summary[route] = _summarize(samples, elapsed)
+            everything += samples
+        if everything:
+            summary['total'] = _summarize(everything, elapsed)
+        return summary
+
+
+def _summarize(samples, elapsed):
+    seconds = np.array([sample[0] for sample in samples])
+    p50, p90, p95, p99 = np.percentile(seconds, [50, 90, 95, 99])
+    errors = {}
+    for sample in samples:
+        if sample[3]:
+            errors[sample[3]] = errors.get(sample[3], 0) + 1
+    return {
+        'requests': len(samples),
+        'errors': sum(errors.values()),
+        'error_kinds': errors,
+        'requests_per_second': len(samples) / elapsed if elapsed else 0.0,
+        'bytes_per_second': sum(sample[2] for sample in samples) / elapsed if elapsed else 0.0,
+        'p50': float(p50), 'p90': float(p90), 'p95': float(p95), 'p99': float(p99),
+        'max': float(seconds.max()),
+        'first_byte_p50': float(np.median([sample[1] for sample in samples])),
+    }
+
+
+def _wait_for_job(session, base_url, body, deadline):
+    status_url = base_url + json.loads(body)['status_url']
+    while True:
+        job = session.get(status_url, timeout=REQUEST_TIMEOUT).json()
+        if job.get('status') in ('succeeded', 'failed'):
+            return None if job['status'] == 'succeeded' else 'job failed'
+        if time.monotonic() > deadline:
+            return 'job timeout'
+        time.sleep(JOB_POLL_INTERVAL)
+
+
+def request_once(session, base_url, route, scripts, queries, rng):
+    """Make one request of `route`; returns (seconds, seconds to the first byte, bytes, error or None).
+
+    The body is read to the end, so streamed downloads are timed until their
+    last byte. A job is timed until it has finished.
+    """
+    method, path = ROUTES[route]
+    path = path.format(script=rng.choice(scripts), query=rng.choice(queries))
+    start = time.monotonic()
+    first_byte = None
+    nbytes = 0
+    body = []
+    try:
+        with session.request(method, base_url + path, stream=True, timeout=REQUEST_TIMEOUT) as response:
+            for chunk in response.iter_content(chunk_size=64 * 1024):
+                if first_byte is None:
+                    first_byte = time.monotonic() - start
+                nbytes += len(chunk)
+                if route == 'job':
+                    body.append(chunk)
+            error = None if response.ok else f"HTTP {response.status_code}"
+        if error is None and route == 'job':
+            error = _wait_for_job(session, base_url, b''.join(body), start + REQUEST_TIMEOUT)
+    except (requests.RequestException, ValueError) as e:
+        # ValueError: a job route answering with something other than JSON
+        error = type(e).__name__
+    seconds = time.monotonic() - start
+    return seconds, seconds if first_byte is None else first_byte, nbytes, error
+
+
+def run_load(base_url, weights, scripts, queries, concurrency=4, total=None, duration=None, seed=0):
+    """Drive the app with `concurrency` clients until `total` requests were made or `duration` seconds passed.
+
+    Every client picks its next route at random by `weights`. Returns the
+    summary by route (see Recorder.summarize) and the elapsed seconds.
+    """
+    recorder = Recorder()
+    routes, route_weights = zip(*weights.items())
+    counter = iter(range(total)) if total else None
+    counter_lock = threading.Lock()
+    start = time.monotonic()
+
+    def client(i):
+        rng = random.Random(f"{seed}:{i}")
+        with requests.Session() as session:
+            while True:
+                if duration and time.monotonic() - start >= duration:
+                    return
+                if counter is not None:
+                    with counter_lock:
+                        if next(counter, None) is None:
+                            return
+                route = rng.choices(routes, route_weights)[0]
+                recorder.add(route, *request_once(session, base_url, route, scripts, queries, rng))
+
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        for future in [executor.submit(client, i) for i in range(concurrency)]:
+            future.result()
+    elapsed = time.monotonic() - start
+    return recorder.summarize(elapsed), elapsed
+
+
+def format_summary(summary):
+    lines = [f"{'route':<14} {'requests':>8} {'errors':>6} {'req/s':>7} {'MB/s':>7} {'p50 ms':>8} {'p90 ms':>8} "
+             f"{'p95 ms':>8} {'p99 ms':>8} {'max ms':>8} {'ttfb ms':>8}"]
+    for route, s in summary.items():
+        lines.append(f"{route:<14} {s['requests']:>8} {s['errors']:>6} {s['requests_per_second']:>7.2f} "
+                     f"{s['bytes_per_second'] / 2 ** 20:>7.2f} {s['p50'] * 1000:>8.0f} {s['p90'] * 1000:>8.0f} "
+                     f"{s['p95'] * 1000:>8.0f} {s['p99'] * 1000:>8.0f} {s['max'] * 1000:>8.0f} "
+                     f"{s['first_byte_p50'] * 1000:>8.0f}")
+    for route, s in summary.items():
+        if route != 'total' and s['error_kinds']:
+            kinds = ', '.join(f"{kind} x{count}" for kind, count in sorted(s['error_kinds'].items()))
+            lines.append(f"Errors of {route}: {kinds}")
+    return '\n'.join(lines)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Drive the app.py routes with concurrent clients and report latency.')
+    parser.add_argument('--url', default=LOAD_TEST_URL, help=f'Base URL of the app (default: {LOAD_TEST_URL})')
+    parser.add_argument('--concurrency', type=int, default=4, help='Number of concurrent clients (default: 4)')
+    parser.add_argument('--requests', type=int, help='Stop after this many requests in total')
+    parser.add_argument('--duration', type=float, help='Stop after this many seconds (default: 60 without --requests)')
+    parser.add_argument('--mix', default=DEFAULT_MIX,
+                        help=f'Routes and their weights, from {", ".join(ROUTES)} (default: {DEFAULT_MIX})')
+    parser.add_argument('--scripts', nargs='*', help="Only use the scripts matching these patterns, e.g. 'address_*'")
+    parser.add_argument('--seed', type=int, default=0, help='Random seed of the route and script choices (default: 0)')
+    parser.add_argument('--json', help='Also write the summary to this file')
+    args = parser.parse_args()
+
+    try:
+        weights = parse_mix(args.mix)
+    except ValueError as e:
+        parser.error(str(e))
+    scripts = get_scripts(args.scripts)
+    if not scripts:
+        parser.error('No scripts match')
+    queries = sorted(f for f in os.listdir('query') if f.endswith('.json'))
+    duration = args.duration if args.duration or args.requests else 60
+
+    print(f"Driving {args.url} with {args.concurrency} clients "
+          f"({f'{args.requests} requests' if args.requests else f'{duration:g} seconds'}, mix {args.mix})")
+    summary, elapsed = run_load(args.url.rstrip('/'), weights, scripts, queries, args.concurrency,
+                                total=args.requests, duration=duration, seed=args.seed)
+    print(f"Finished in {elapsed:.1f}s")
+    print(format_summary(summary))
+
+    if args.json:
+        with open(args.json, 'w', encoding='utf-8') as f:
+            json.dump({'url': args.url, 'concurrency': args.concurrency, 'mix': weights,
+                       'elapsed': elapsed, 'routes': summary}, f, indent=2)
+    if not summary:
+        sys.exit(1)
@@ -0,0 +1,411 @@
+import atexit
+import functools
+import inspect
+import json
+import logging
+import os
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+
+from single_flight import file_lock
+
+try:
+    import resource
+except ImportError:  # not available on Windows; peak RSS is reported as 0
+    resource = None
+
+METRICS_DIR = os.environ.get('METRICS_DIR', os.path.join('logs', 'metrics'))
+# Files of processes that recorded nothing for this many seconds are folded
+# into METRICS_DIR/expired.json, so the totals never go down
+METRICS_TTL = float(os.environ.get('METRICS_TTL', 7 * 24 * 3600))
+EXPIRED_FILE = 'expired.json'
+# Observations are kept in memory and written to METRICS_DIR at most every this
+# many seconds, at exit and whenever /metrics is rendered
+METRICS_FLUSH_INTERVAL = float(os.environ.get('METRICS_FLUSH_INTERVAL', 5))
+# Set to a file to also log every span as a JSON line (the scripts' own logs stay free of them)
+SPAN_LOG_FILE = os.environ.get('SPAN_LOG_FILE')
+PREFIX = 'es_analysis_stage'
+BUCKETS = (0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600)
+
+# Series of this process, by (stage, name); flushed to METRICS_DIR/<pid>-<random>.json
+_series = {}
+_lock = threading.Lock()
+_process_file = None
+_local = threading.local()
+_flush_lock = threading.Lock()
+_last_flush = 0.0
+
+_span_log = logging.getLogger('metrics.spans')
+_span_log.propagate = False
+if SPAN_LOG_FILE:
+    _span_log.setLevel(logging.INFO)
+    _span_log.addHandler(logging.FileHandler(SPAN_LOG_FILE))
+
+
+def _get_process_file():
+    """File of this process's series, named when the process first writes it."""
+    global _process_file
+    if _process_file is None or not os.path.basename(_process_file).startswith(f"{os.getpid()}-"):
+        _process_file = os.path.join(METRICS_DIR, f"{os.getpid()}-{uuid.uuid4().hex[:8]}.json")
+    return _process_file
+
+
+def _after_fork():
+    # A forked process (a gunicorn worker with --preload, a pool worker)
+    # starts its own series and file instead of counting the parent's again
+    global _lock, _flush_lock, _last_flush, _process_file
+    _series.clear()
+    _lock = threading.Lock()
+    _flush_lock = threading.Lock()
+    _last_flush = 0.0
+    _process_file = None
+
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_after_fork)
+
+
+def get_peak_rss():
+    """Highest resident set size of this process so far, in bytes."""
+    if resource is None:
+        return 0
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def _new_series():
+    return {
+        'count': 0, 'sum': 0.0, 'buckets': [0] * len(BUCKETS),
+        'rows': 0, 'bytes': 0, 'errors': 0,
+        'peak_rss': 0, 'last_seconds': 0.0, 'last_at': 0.0,
+    }
+
+
+def _flush_locked():
+    global _last_flush
+    _last_flush = time.monotonic()
+    with _lock:
+        if not _series:
+            return
+        entries = [[stage, name, dict(series, buckets=list(series['buckets']))]
+                   for (stage, name), series in _series.items()]
+    try:
+        _write_json(_get_process_file(), entries)
+    except OSError as e:
+        logging.warning(f"Could not save metrics: {e}")
+
+
+def _write_json(path, obj):
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.part"
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(obj, f)
+    os.replace(tmp_path, path)
+
+
+def flush():
+    """Write this process's series to METRICS_DIR now."""
+    with _flush_lock:
+        _flush_locked()
+
+
+def _maybe_flush():
+    # A flush already under way in another thread covers this observation soon enough
+    if time.monotonic() - _last_flush < METRICS_FLUSH_INTERVAL or not _flush_lock.acquire(blocking=False):
+        return
+    try:
+        _flush_locked()
+    finally:
+        _flush_lock.release()
+
+
+atexit.register(flush)
+
+
+def record(stage, name, seconds, rows=0, nbytes=0, error=False):
+    """Add one observation of `stage` (fetch, decode, flatten, transform, write, ...) for `name`."""
+    peak_rss = get_peak_rss()
+    with _lock:
+        series = _series.setdefault((stage, name), _new_series())
+        series['count'] += 1
+        series['sum'] += seconds
+        for i, bound in enumerate(BUCKETS):
+            if seconds <= bound:
+                series['buckets'][i] += 1
+        series['rows'] += rows
+        series['bytes'] += nbytes
+        series['errors'] += int(error)
+        series['peak_rss'] = max(series['peak_rss'], peak_rss)
+        series['last_seconds'] = seconds
+        series['last_at'] = time.time()
+    _maybe_flush()
+
+    if SPAN_LOG_FILE:
+        _span_log.info(json.dumps({
+            'time': time.time(), 'pid': os.getpid(), 'stage': stage, 'name': name, 'seconds': round(seconds, 6),
+            'rows': rows, 'bytes': nbytes, 'peak_rss': peak_rss, 'error': error,
+        }))
+
+
+class Span:
+    __slots__ = ('stage', 'name', 'rows', 'nbytes', 'child_seconds')
+
+    def __init__(self, stage, name):
+        self.stage = stage
+        self.name = name
+        self.rows = 0
+        self.nbytes = 0
+        self.child_seconds = 0.0
+
+    def add(self, rows=0, nbytes=0):
+        self.rows += rows
+        self.nbytes += nbytes
+
+
+def _stack():
+    if not hasattr(_local, 'stack'):
+        _local.stack = []
+    return _local.stack
+
+
+def current():
+    """The innermost open span of this thread, or None."""
+    stack = _stack()
+    return stack[-1] if stack else None
+
+
+@contextmanager
+def span(stage, name=None, rows=0, nbytes=0):
+    """Time the block as `stage` of `name` (by default the name of the enclosing span).
+
+    A span records its own time: time spent in spans opened inside it, or
+    charged to another stage with add_time, is left out, so the stages of a
+    run add up to its duration instead of overlapping. Rows and bytes can be
+    added with the yielded Span's add().
+    """
+    parent = current()
+    if name is None:
+        name = parent.name if parent else ''
+    s = Span(stage, name)
+    s.add(rows, nbytes)
+    stack = _stack()
+    stack.append(s)
+    error = False
+    start = time.perf_counter()
+    try:
+        yield s
+    except BaseException:
+        error = True
+        raise
+    finally:
+        seconds = time.perf_counter() - start
+        stack.pop()
+        if parent is not None:
+            parent.child_seconds += seconds
+        record(stage, name, max(seconds - s.child_seconds, 0.0), s.rows, s.nbytes, error)
+
+
+def stage(stage_name):
+    """Decorator timing every call of a function as a span of `stage_name`, named after its script."""
+    def decorate(func):
+        name = os.path.splitext(os.path.basename(inspect.getfile(func)))[0]
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with span(stage_name, name) as s:
+                result = func(*args, **kwargs)
+                if hasattr(result, '__len__'):
+                    s.add(rows=len(result))
+            return result
+        return wrapper
+    return decorate
+
+
+def add_time(stage, seconds, rows=0, nbytes=0, name=None):
+    """Record `seconds` of work done inside the current span as `stage`, taking it out of the span.
+
+    For work that cannot be wrapped in its own span, like decoding that is
+    interleaved with the flattening that consumes it. `name` defaults to the
+    current span's name.
+    """
+    parent = current()
+    if parent is not None:
+        parent.child_seconds += seconds
+    if name is None:
+        name = parent.name if parent else ''
+    record(stage, name, seconds, rows, nbytes)
+
+
+def timed(iterable, stage, seconds=0.0, nbytes=0, name=None):
+    """Iterate over `iterable`, charging the time spent producing its items to `stage` (see add_time).
+
+    `seconds` is added for work done before iterating (e.g. opening the file).
+    """
+    iterator = iter(iterable)
+    total = seconds
+    try:
+        while True:
+            start = time.perf_counter()
+            try:
+                item = next(iterator)
+            except StopIteration:
+                return
+            finally:
+                total += time.perf_counter() - start
+            yield item
+    finally:
+        add_time(stage, total, nbytes=nbytes, name=name)
+
+
+def totals():
+    """Seconds, rows and bytes recorded by this process so far, by stage."""
+    result = {}
+    with _lock:
+        for (stage, _), series in _series.items():
+            total = result.setdefault(stage, {'seconds': 0.0, 'rows': 0, 'bytes': 0})
+            total['seconds'] += series['sum']
+            total['rows'] += series['rows']
+            total['bytes'] += series['bytes']
+    return result
+
+
+def _merge(merged, entries):
+    for stage, name, series in entries:
+        total = merged.setdefault((stage, name), _new_series())
+        for field in ('count', 'sum', 'rows', 'bytes', 'errors'):
+            total[field] += series[field]
+        total['buckets'] = [a + b for a, b in zip(total['buckets'], series['buckets'])]
+        total['peak_rss'] = max(total['peak_rss'], series['peak_rss'])
+        if series['last_at'] > total['last_at']:
+            total['last_seconds'] = series['last_seconds']
+            total['last_at'] = series['last_at']
+
+
+def _read_json(path, default):
+    try:
+        with open(path, 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return default
+
+
+def _fold_expired(expired, files):
+    """Add the series of the expired process `files` to `expired` and remove the files.
+
+    The folded file names stay listed in EXPIRED_FILE until the files are
+    gone, so a file is never counted twice, even when removing it failed.
+    """
+    folded = set(expired['folded'])
+    merged = {}
+    _merge(merged, expired['series'])
+    for file in files:
+        if file in folded:
+            continue
+        try:
+            _merge(merged, _read_json(os.path.join(METRICS_DIR, file), []))
+        except (OSError, ValueError):
+            continue
+        folded.add(file)
+    remaining = set(os.listdir(METRICS_DIR))
+    expired = {
+        'folded': sorted(file for file in folded if file in remaining),
+        'series': [[stage, name, series] for (stage, name), series in sorted(merged.items())],
+    }
+    _write_json(os.path.join(METRICS_DIR, EXPIRED_FILE), expired)
+    for file in files:
+        try:
+            os.remove(os.path.join(METRICS_DIR, file))
+        except OSError:
+            pass
+    return expired
+
+
+def _load_all():
+    """Merge the series saved by every process, and those of expired processes."""
+    merged = {}
+    if not os.path.isdir(METRICS_DIR):
+        return merged
+    cutoff = time.time() - METRICS_TTL
+    own_file = os.path.basename(_get_process_file())
+    # Other processes fold files into EXPIRED_FILE under the same lock, so no
+    # file is missed or counted twice while they do
+    with file_lock('metrics-expired'):
+        try:
+            expired = _read_json(os.path.join(METRICS_DIR, EXPIRED_FILE), {'folded': [], 'series': []})
+        except (OSError, ValueError) as e:
+            logging.warning(f"Could not read the expired metrics, leaving the expired files as they are: {e}")
+            expired = None
+
+        files = []
+        expired_files = []
+        for file in os.listdir(METRICS_DIR):
+            if not file.endswith('.json') or file == EXPIRED_FILE:
+                continue
+            try:
+                is_expired = file != own_file and os.path.getmtime(os.path.join(METRICS_DIR, file)) < cutoff
+            except OSError:
+                continue
+            if is_expired and expired is not None:
+                expired_files.append(file)
+            else:
+                files.append(file)
+        if expired_files:
+            try:
+                expired = _fold_expired(expired, expired_files)
+            except OSError as e:
+                logging.warning(f"Could not fold the expired metrics files: {e}")
+                files += expired_files
+
+        folded = set()
+        if expired is not None:
+            _merge(merged, expired['series'])
+            folded = set(expired['folded'])
+        for file in files:
+            if file in folded:
+                continue
+            try:
+                _merge(merged, _read_json(os.path.join(METRICS_DIR, file), []))
+            except (OSError, ValueError):
+                continue
+    return merged
+
+
+def _labels(stage, name, **extra):
+    labels = {'stage': stage, 'name': name, **extra}
+    escaped = (str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+               for value in labels.values())
+    return '{' + ','.join(f'{key}="{value}"' for key, value in zip(labels, escaped)) + '}'
+
+
+def render():
+    """All processes' metrics in the Prometheus text exposition format.
+
+    This process's series are current; other processes' lag by up to
+    METRICS_FLUSH_INTERVAL seconds.
+    """
+    flush()
+    merged = sorted(_load_all().items())
+    lines = [
+        f"# HELP {PREFIX}_seconds Time spent in a pipeline stage (excluding nested stages).",
+        f"# TYPE {PREFIX}_seconds histogram",
+    ]
+    for (stage, name), series in merged:
+        for bound, count in zip(BUCKETS, series['buckets']):
+            lines.append(f"{PREFIX}_seconds_bucket{_labels(stage, name, le=bound)} {count}")
+        lines.append(f"{PREFIX}_seconds_bucket{_labels(stage, name, le='+Inf')} {series['count']}")
+        lines.append(f"{PREFIX}_seconds_sum{_labels(stage, name)} {series['sum']}")
+        lines.append(f"{PREFIX}_seconds_count{_labels(stage, name)} {series['count']}")
+
+    for metric, field, kind, help_text in (
+        ('rows_total', 'rows', 'counter', 'Rows produced by a pipeline stage.'),
+        ('bytes_total', 'bytes', 'counter', 'Bytes read or written by a pipeline stage.'),
+        ('errors_total', 'errors', 'counter', 'Pipeline stage runs that raised an error.'),
+        ('peak_rss_bytes', 'peak_rss', 'gauge', 'Highest process RSS seen at the end of a pipeline stage.'),
+        ('last_seconds', 'last_seconds', 'gauge', 'Duration of the latest run of a pipeline stage.'),
+    ):
+        lines.append(f"# HELP {PREFIX}_{metric} {help_text}")
+        lines.append(f"# TYPE {PREFIX}_{metric} {kind}")
+        for (stage, name), series in merged:
+            lines.append(f"{PREFIX}_{metric}{_labels(stage, name)} {series[field]}")
+    return '\n'.join(lines) + '\n'
@@ -0,0 +1,400 @@
+import argparse
+import gzip
+import hashlib
+import json
+import os
+import random
+import sys
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlsplit
+
+import composite_aggs
+import synthetic_es
+from single_flight import SingleFlight
+
+MOCK_ES_HOST = os.environ.get('MOCK_ES_HOST', '127.0.0.1')
+MOCK_ES_PORT = int(os.environ.get('MOCK_ES_PORT', 9200))
+# Synthetic responses are written here once and served from disk
+MOCK_ES_DIR = os.environ.get('MOCK_ES_DIR', os.path.join('data', '.mock_es'))
+# Bodies are sent this many bytes at a time (and throttled per chunk when slow)
+SEND_CHUNK_SIZE = 64 * 1024
+
+# Injected faults; every rate is the share of requests (0 to 1) it applies to.
+# They can be changed while the server runs with PUT /_mock/faults.
+DEFAULT_FAULTS = {
+    'latency': 0.0,            # seconds to wait before answering
+    'jitter': 0.0,             # up to this many extra seconds, at random
+    'error_rate': 0.0,         # answered with error_status and an Elasticsearch error body
+    'error_status': 503,
+    'slow_rate': 0.0,          # body sent at bytes_per_second
+    'bytes_per_second': 256 * 1024,
+    'truncate_rate': 0.0,      # connection closed halfway through the body
+}
+
+# Keys request_data.py adds to (or drops from) a query for paged exports and composite fetches
+PAGED_KEYS = {'size', 'sort', 'pit', 'search_after', 'track_total_hits', 'from', 'aggs', 'aggregations'}
+COMPOSITE_KEYS = {'aggs', 'aggregations', 'track_total_hits'}
+
+
+def _canonical(payload, drop=()):
+    return json.dumps({k: v for k, v in payload.items() if k not in drop}, sort_keys=True)
+
+
+def _aggs(payload):
+    return payload.get('aggs') or payload.get('aggregations') or {}
+
+
+class ResponseStore:
+    """Finds the query file a request body came from and the response to replay for it.
+
+    With `recorded_dir` (e.g. a copy of a data/ folder fetched from the
+    real cluster), the <name>.txt saved there by request_data.py is
+    replayed when there is one; otherwise a synthetic response is
+    generated with synthetic_es, written to MOCK_ES_DIR once and replayed
+    from there.
+    """
+
+    def __init__(self, query_dir='query', recorded_dir=None, sizes=None, seed=synthetic_es.DEFAULT_SEED,
+                 output_dir=MOCK_ES_DIR):
+        self.recorded_dir = recorded_dir
+        self.sizes = sizes
+        self.seed = seed
+        self.output_dir = output_dir
+        self.queries = {}
+        # The pipeline aggregation variants (request_data.PIPELINE_AGGS) are known as <name>.pipeline
+        for directory, suffix in ((query_dir, ''), (os.path.join(query_dir, 'pipeline'), '.pipeline')):
+            if not os.path.isdir(directory):
+                continue
+            for file in sorted(os.listdir(directory)):
+                if file.endswith('.json'):
+                    with open(os.path.join(directory, file), 'r', encoding='utf-8') as f:
+                        self.queries[os.path.splitext(file)[0] + suffix] = json.load(f)
+        self._by_body = {_canonical(payload): name for name, payload in self.queries.items()}
+        self._by_paged_body = {}
+        for name, payload in self.queries.items():
+            if payload.get('size', 10):
+                self._by_paged_body.setdefault(_canonical(payload, PAGED_KEYS), name)
+        self._generating = SingleFlight()
+        self._hits = {}
+        self._hits_lock = threading.Lock()
+
+    def find(self, body):
+        """Name of the query file a plain search, paged search or composite fetch was made from."""
+        name = self._by_body.get(_canonical(body))
+        if name is not None:
+            return name
+        if 'pit' in body:
+            return self._by_paged_body.get(_canonical(body, PAGED_KEYS))
+        agg = next((agg for agg in _aggs(body).values() if 'composite' in agg), None)
+        if agg is not None:
+            for name, payload in self.queries.items():
+                aggregation = composite_aggs.from_aggs(_aggs(payload), agg['composite']['size'])
+                if (aggregation is not None
+                        and aggregation.request['composite']['sources'] == agg['composite']['sources']
+                        and aggregation.request.get('aggs') == agg.get('aggs')
+                        and _canonical(payload, COMPOSITE_KEYS) == _canonical(body, COMPOSITE_KEYS)):
+                    return name
+        return None
+
+    def get_path(self, name):
+        """Path of the response file of query `name`, generating it the first time."""
+        if self.recorded_dir:
+            recorded_path = os.path.join(self.recorded_dir, f"{name}.txt")
+            if os.path.exists(recorded_path):
+                return recorded_path
+        path = os.path.join(self.output_dir, f"{name}.txt")
+        if not os.path.exists(path):
+            self._generating.do(name, self._generate, name, path)
+        return path
+
+    def _generate(self, name, path):
+        if os.path.exists(path):
+            return
+        os.makedirs(self.output_dir, exist_ok=True)
+        generator = synthetic_es.ResponseGenerator(name, self.sizes, self.seed)
+        tmp_path = f"{path}.{threading.get_ident()}.part"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            for piece in generator.iter_response(self.queries[name]):
+                f.write(piece)
+        os.replace(tmp_path, path)
+
+    def load(self, name):
+        with open(self.get_path(name), 'r', encoding='utf-8') as f:
+            return json.load(f)
+
+    def get_hits(self, name):
+        """All hits of query `name`, for paging through them (decoded once and kept)."""
+        if self.recorded_dir and os.path.exists(os.path.join(self.recorded_dir, f"{name}.ndjson")):
+            path = os.path.join(self.recorded_dir, f"{name}.ndjson")
+        else:
+            path = self.get_path(name)
+        key = (path, os.path.getmtime(path))
+        with self._hits_lock:
+            if key in self._hits:
+                return self._hits[key]
+
+        if path.endswith('.ndjson'):
+            with open(path, 'r', encoding='utf-8') as f:
+                envelope = json.loads(f.readline())
+                hits = [json.loads(line) for line in f if line.strip()]
+        else:
+            envelope = self.load(name)
+            hits = envelope.get('hits', {}).pop('hits', [])
+        envelope.pop('aggregations', None)
+        with self._hits_lock:
+            self._hits[key] = (envelope, hits)
+        return envelope, hits
+
+    def get_composite_page(self, name, body):
+        """A page of composite buckets with the counts of the nested aggregations of query `name`."""
+        agg_name, agg = next((k, v) for k, v in _aggs(body).items() if 'composite' in v)
+        composite = agg['composite']
+        levels = [next(iter(source)) for source in composite['sources']]
+        response = self.load(name)
+        buckets = []
+        _flatten_composite(response['aggregations'][levels[0]], levels, 0, {}, buckets)
+        buckets.sort(key=lambda b: tuple((b['key'][level] is not None, b['key'][level]) for level in levels))
+
+        after = composite.get('after')
+        if after is not None:
+            after_key = tuple((after[level] is not None, after[level]) for level in levels)
+            buckets = [b for b in buckets
+                       if tuple((b['key'][level] is not None, b['key'][level]) for level in levels) > after_key]
+        page = buckets[:composite['size']]
+        result = {'buckets': page}
+        if page:
+            result['after_key'] = page[-1]['key']
+        response.pop('aggregations')
+        response['aggregations'] = {agg_name: result}
+        return response
+
+
+def _flatten_composite(aggregation, levels, depth, key, buckets):
+    # One composite bucket per leaf bucket, plus a missing (None) bucket for
+    # the documents of a parent that none of its child buckets hold
+    for bucket in aggregation['buckets']:
+        value = bucket['key']
+        if bucket.get('key_as_string') in ('true', 'false'):
+            # Composite keys of boolean fields are true/false; dates stay epoch millis
+            # since the composite sources are sent without a format
+            value = bucket['key_as_string'] == 'true'
+        bucket_key = {**key, levels[depth]: value}
+        if depth + 1 < len(levels):
+            child = bucket[levels[depth + 1]]
+            _flatten_composite(child, levels, depth + 1, bucket_key, buckets)
+            missing = bucket['doc_count'] - sum(b['doc_count'] for b in child['buckets'])
+            if missing > 0:
+                buckets.append({'key': {**bucket_key, **{level: None for level in levels[depth + 1:]}},
+                                'doc_count': missing})
+        else:
+            buckets.append({'key': bucket_key, 'doc_count': bucket['doc_count'],
+                            **{k: v for k, v in bucket.items() if k not in ('key', 'key_as_string', 'doc_count')}})
+
+
+class MockServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, store, faults=None, compress=True, seed=None, verbose=False):
+        super().__init__(address, MockHandler)
+        self.store = store
+        self.faults = dict(DEFAULT_FAULTS)
+        self.faults_lock = threading.Lock()
+        self.set_faults(faults or {})
+        self.compress = compress
+        self.random = random.Random(seed)
+        self.verbose = verbose
+
+    def get_faults(self):
+        with self.faults_lock:
+            return dict(self.faults)
+
+    def set_faults(self, changes):
+        unknown = set(changes) - set(DEFAULT_FAULTS)
+        if unknown:
+            raise ValueError(f"Unknown faults {sorted(unknown)}, expected some of {sorted(DEFAULT_FAULTS)}")
+        with self.faults_lock:
+            self.faults.update({k: type(DEFAULT_FAULTS[k])(v) for k, v in changes.items()})
+            return dict(self.faults)
+
+    def roll(self, rate):
+        with self.faults_lock:
+            return rate > 0 and self.random.random() < rate
+
+    def uniform(self, high):
+        with self.faults_lock:
+            return self.random.uniform(0, high) if high > 0 else 0.0
+
+
+class MockHandler(BaseHTTPRequestHandler):
+    # Keep-alive, like Elasticsearch, so the pooled session is exercised too
+    protocol_version = 'HTTP/1.1'
+    server_version = 'mock-es'
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            sys.stderr.write(f"{self.address_string()} - {format % args}\n")
+
+    def _read_body(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        return self.rfile.read(length) if length else b''
+
+    def _send(self, status, data, content_type='application/json', faults=None):
+        """Send `data` (bytes), applying the slow-body and truncation faults."""
+        faults = faults or {}
+        if self.server.compress and 'gzip' in self.headers.get('Accept-Encoding', ''):
+            data = gzip.compress(data, compresslevel=1)
+            encoding = 'gzip'
+        else:
+            encoding = None
+
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        if encoding:
+            self.send_header('Content-Encoding', encoding)
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+
+        end = len(data)
+        if self.server.roll(faults.get('truncate_rate', 0)):
+            end = len(data) // 2
+            self.close_connection = True
+        slow = self.server.roll(faults.get('slow_rate', 0))
+        for start in range(0, end, SEND_CHUNK_SIZE):
+            chunk = data[start:min(end, start + SEND_CHUNK_SIZE)]
+            self.wfile.write(chunk)
+            if slow:
+                self.wfile.flush()
+                time.sleep(len(chunk) / max(1.0, faults['bytes_per_second']))
+
+    def _send_json(self, status, obj, faults=None):
+        self._send(status, json.dumps(obj, ensure_ascii=False).encode('utf-8'), faults=faults)
+
+    def _send_error(self, status, error_type, reason):
+        self._send_json(status, {'error': {'root_cause': [{'type': error_type, 'reason': reason}],
+                                           'type': error_type, 'reason': reason}, 'status': status})
+
+    def _inject_faults(self):
+        """Wait out the injected latency; returns the faults, or None when an error was sent instead."""
+        faults = self.server.get_faults()
+        delay = faults['latency'] + self.server.uniform(faults['jitter'])
+        if delay:
+            time.sleep(delay)
+        if self.server.roll(faults['error_rate']):
+            status = int(faults['error_status'])
+            self._send_error(status, 'mock_injected_error', f"Injected {status} by the mock server")
+            return None
+        return faults
+
+    def do_GET(self):
+        path = urlsplit(self.path).path
+        if path == '/_mock/faults':
+            return self._send_json(200, self.server.get_faults())
+        if path in ('', '/'):
+            return self._send_json(200, {'name': 'mock-es', 'cluster_name': 'mock',
+                                         'version': {'number': '8.0.0'}, 'tagline': 'You Know, for Search'})
+        return self._send_error(404, 'resource_not_found_exception', f"No handler for GET {path}")
+
+    def do_PUT(self):
+        path = urlsplit(self.path).path
+        if path != '/_mock/faults':
+            return self._send_error(404, 'resource_not_found_exception', f"No handler for PUT {path}")
+        try:
+            return self._send_json(200, self.server.set_faults(json.loads(self._read_body() or b'{}')))
+        except ValueError as e:
+            return self._send_error(400, 'illegal_argument_exception', str(e))
+
+    def do_DELETE(self):
+        self._read_body()
+        if urlsplit(self.path).path.endswith('/_pit'):
+            return self._send_json(200, {'succeeded': True, 'num_freed': 1})
+        return self._send_error(404, 'resource_not_found_exception', f"No handler for DELETE {self.path}")
+
+    def do_POST(self):
+        path = urlsplit(self.path).path
+        raw = self._read_body()
+        faults = self._inject_faults()
+        if faults is None:
+            return
+        try:
+            if path.endswith('/_pit'):
+                return self._send_json(200, {'id': uuid.uuid4().hex}, faults)
+            if path.endswith('/_msearch'):
+                return self._msearch(raw, faults)
+            if path.endswith('/_search'):
+                return self._search(json.loads(raw or b'{}'), faults)
+        except (ValueError, KeyError) as e:
+            return self._send_error(400, 'parsing_exception', f"{type(e).__name__}: {e}")
+        return self._send_error(404, 'resource_not_found_exception', f"No handler for POST {path}")
+
+    def _search(self, body, faults):
+        store = self.server.store
+        name = store.find(body)
+        if name is None:
+            # A custom query: answer with a response generated for it on the spot
+            name = hashlib.sha256(_canonical(body).encode('utf-8')).hexdigest()[:12]
+            text = ''.join(synthetic_es.ResponseGenerator(name, store.sizes, store.seed).iter_response(body))
+            return self._send(200, text.encode('utf-8'), faults=faults)
+        if 'pit' in body:
+            return self._search_page(name, body, faults)
+        if any('composite' in agg for agg in _aggs(body).values()):
+            return self._send_json(200, store.get_composite_page(name, body), faults)
+        with open(store.get_path(name), 'rb') as f:
+            return self._send(200, f.read(), faults=faults)
+
+    def _search_page(self, name, body, faults):
+        envelope, hits = self.server.store.get_hits(name)
+        start = body['search_after'][0] + 1 if body.get('search_after') else 0
+        size = body.get('size', 10)
+        page = [{**hit, 'sort': [i]} for i, hit in enumerate(hits[start:start + size], start)]
+        response = {**envelope, 'pit_id': body['pit']['id']}
+        response['hits'] = {**envelope.get('hits', {}), 'hits': page}
+        return self._send_json(200, response, faults)
+
+    def _msearch(self, raw, faults):
+        lines = [line for line in raw.decode('utf-8').split('\n') if line.strip()]
+        responses = []
+        for body_line in lines[1::2]:
+            body = json.loads(body_line)
+            name = self.server.store.find(body)
+            if name is None:
+                responses.append({'error': {'type': 'mock_unknown_query', 'reason': 'Not a query file'}, 'status': 400})
+            else:
+                responses.append({**self.server.store.load(name), 'status': 200})
+        return self._send_json(200, {'took': 1, 'responses': responses}, faults)
+
+
+def serve(host=MOCK_ES_HOST, port=MOCK_ES_PORT, **kwargs):
+    """Start a mock server in a background thread and return it (server.shutdown() stops it)."""
+    server = MockServer((host, port), **kwargs)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Serve recorded or synthetic responses to the query files like Elasticsearch.')
+    parser.add_argument('--host', default=MOCK_ES_HOST, help=f'Address to listen on (default: {MOCK_ES_HOST})')
+    parser.add_argument('--port', type=int, default=MOCK_ES_PORT, help=f'Port to listen on (default: {MOCK_ES_PORT})')
+    parser.add_argument('--recorded-dir',
+                        help='Replay the responses saved in this folder (a copy of data/) when it has one, '
+                             'instead of synthetic ones')
+    parser.add_argument('--no-gzip', action='store_true', help='Never compress responses')
+    parser.add_argument('--verbose', action='store_true', help='Log every request')
+    for fault, default in DEFAULT_FAULTS.items():
+        parser.add_argument(f"--{fault.replace('_', '-')}", type=float, default=default, dest=fault,
+                            help=f'Injected fault (default: {default})')
+    synthetic_es.add_size_arguments(parser)
+    args = parser.parse_args()
+
+    store = ResponseStore(recorded_dir=args.recorded_dir,
+                          sizes=synthetic_es.get_sizes(args), seed=args.seed)
+    server = MockServer((args.host, args.port), store, faults={fault: getattr(args, fault) for fault in DEFAULT_FAULTS},
+                        compress=not args.no_gzip, seed=args.seed, verbose=args.verbose)
+    print(f"Mock Elasticsearch listening on http://{args.host}:{args.port}, "
+          f"set ELASTICSEARCH_URL=http://{args.host}:{args.port}/mock/_search")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
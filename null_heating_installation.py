@@ -1,7 +1,10 @@
-import json
 import pandas as pd
 import os
 import logging
+from es_reader import read_aggregation_output
+from report_writer import ReportWriter
+from table_cache import cached_table
+from flatten_aggs import Columns
 
 log_dir = '/app/logs'
 log_file = os.path.join(log_dir, 'null_heating_installation.log')
@@ -12,63 +15,42 @@ if not os.path.exists(log_dir):
 logging.basicConfig(filename=log_file, level=logging.INFO, 
                     format='%(asctime)s - %(levelname)s - %(message)s')
 
+@cached_table
 def parse_elasticsearch_output(file_path):
-    with open(file_path, 'r') as file:
-        data = json.load(file)
+    data, buckets = read_aggregation_output(file_path)
     
     total_hits = data['hits']['total']['value']
     logging.info(f"Total buildings with null heating installation: {total_hits}")
 
-    results = []
-    for municipality in data['aggregations']['municipalities']['buckets']:
+    columns = Columns(['municipality_code', 'unit_usage', 'heating_medium', 'count'],
+                      categorical=['municipality_code', 'unit_usage', 'heating_medium'])
+    for municipality in buckets:
         municipality_code = municipality['key']
         municipality_count = municipality['doc_count']
 
         units_usage_total = sum(usage['doc_count'] for usage in municipality['units_usage']['buckets'])
         
         if municipality_count > units_usage_total:
-            results.append({
-                'municipality_code': municipality_code,
-                'unit_usage': 'No specific usage',
-                'heating_medium': 'No medium',
-                'count': municipality_count - units_usage_total
-            })
+            columns.append(municipality_code, 'No specific usage', 'No medium', municipality_count - units_usage_total)
 
         for usage in municipality['units_usage']['buckets']:
             usage_code = usage['key']
             usage_count = usage['doc_count']
 
             if not usage['heatingMediums']['buckets']:
-                results.append({
-                    'municipality_code': municipality_code,
-                    'unit_usage': usage_code,
-                    'heating_medium': 'No medium',
-                    'count': usage_count
-                })
+                columns.append(municipality_code, usage_code, 'No medium', usage_count)
             else:
                 heating_mediums_total = sum(medium['doc_count'] for medium in usage['heatingMediums']['buckets'])
                 
                 if usage_count > heating_mediums_total:
-                    results.append({
-                        'municipality_code': municipality_code,
-                        'unit_usage': usage_code,
-                        'heating_medium': 'No specific medium',
-                        'count': usage_count - heating_mediums_total
-                    })
+                    columns.append(municipality_code, usage_code, 'No specific medium', usage_count - heating_mediums_total)
 
                 for medium in usage['heatingMediums']['buckets']:
-                    medium_code = medium['key']
-                    count = medium['doc_count']
-                    results.append({
-                        'municipality_code': municipality_code,
-                        'unit_usage': usage_code,
-                        'heating_medium': medium_code,
-                        'count': count
-                    })
+                    columns.append(municipality_code, usage_code, medium['key'], medium['doc_count'])
 
-    return pd.DataFrame(results)
+    return columns.to_frame()
 
-if __name__ == "__main__":
+def main():
     try:
         input_file = os.environ.get('INPUT_FILE', 'null_heating_installation.txt')
         output_file = os.environ.get('OUTPUT_FILE', 'null_heating_installation.xlsx')
@@ -83,9 +65,9 @@ if __name__ == "__main__":
 
         # Calculate summary statistics
         total_buildings = df['count'].sum()
-        buildings_by_usage = df.groupby('unit_usage')['count'].sum().sort_values(ascending=False)
-        buildings_by_medium = df.groupby('heating_medium')['count'].sum().sort_values(ascending=False)
-        top_5_combinations = df.groupby(['unit_usage', 'heating_medium'])['count'].sum().sort_values(ascending=False).head()
+        buildings_by_usage = df.groupby('unit_usage', observed=True)['count'].sum().sort_values(ascending=False)
+        buildings_by_medium = df.groupby('heating_medium', observed=True)['count'].sum().sort_values(ascending=False)
+        top_5_combinations = df.groupby(['unit_usage', 'heating_medium'], observed=True)['count'].sum().sort_values(ascending=False).head()
 
         # Prepare summary data
         summary_data = [
@@ -99,9 +81,9 @@ if __name__ == "__main__":
 
         # Save to Excel
         output_path = f"/app/output/{output_file}"
-        with pd.ExcelWriter(output_path, engine='openpyxl') as writer:
-            df.to_excel(writer, sheet_name='Detailed Data', index=False)
-            summary_df.to_excel(writer, sheet_name='Summary', index=False)
+        with ReportWriter(output_path) as writer:
+            writer.write_sheet(df, 'Detailed Data')
+            writer.write_sheet(summary_df, 'Summary')
 
         logging.info(f"Results saved to {output_path}")
 
@@ -109,4 +91,7 @@ if __name__ == "__main__":
         logging.error(f"Error: {str(e)}")
         raise
 
-    logging.info("Script completed successfully")
\ No newline at end of file
+    logging.info("Script completed successfully")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,113 @@
+import logging
+import multiprocessing
+import os
+import time
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, ThreadPoolExecutor, wait
+
+import analysis_runner
+import metrics
+import request_data
+
+# Number of analysis scripts run at the same time by Run All
+RUN_ALL_WORKERS = int(os.environ.get('RUN_ALL_WORKERS', os.cpu_count() or 1))
+
+
+def get_script_queries(script_name, script_queries):
+    """Return the query files a script reads; by default the one named like the script."""
+    if script_name in script_queries:
+        return script_queries[script_name]
+    return [f"{os.path.splitext(script_name)[0]}.json"]
+
+
+def build_graph(scripts, script_queries):
+    """Map every analysis script to the query fetches it depends on."""
+    return {script: get_script_queries(script, script_queries) for script in scripts}
+
+
+def _init_worker():
+    # Give the worker's root logger a handler, so the scripts' basicConfig calls
+    # do not pin it to the first script's log file; analysis_runner adds the
+    # per-run log file handler
+    logging.basicConfig(level=logging.INFO, handlers=[logging.NullHandler()])
+
+
+def _fetch(query_file):
+    start = time.perf_counter()
+    try:
+        request_data.process_query_file(query_file)
+        error = None
+    except Exception as e:
+        error = str(e)
+    return error, time.perf_counter() - start
+
+
+def _analyse(script_name):
+    start = time.perf_counter()
+    error = analysis_runner.run_script(script_name)
+    # Publish the run's stages to /metrics now rather than at the next interval
+    metrics.flush()
+    return error, time.perf_counter() - start
+
+
+def run_pipeline(scripts, script_queries, workers=None, on_node=None):
+    """Fetch the queries of `scripts` and run each script as soon as its data is in.
+
+    Fetches run on a thread pool sharing the Elasticsearch session; analyses
+    run on a process pool of `workers` processes (RUN_ALL_WORKERS by default),
+    so independent scripts use all cores. A script whose fetch failed is
+    skipped. Returns a dict node -> {'type', 'status', 'seconds', 'error'} for
+    every fetch (keyed by query file) and analysis (keyed by script);
+    `on_node(name, node)` is called as each of them finishes.
+    """
+    graph = build_graph(scripts, script_queries)
+    waiting = {script: set(query_files) for script, query_files in graph.items()}
+    query_files = sorted({qf for qfs in graph.values() for qf in qfs})
+    nodes = {}
+
+    def finish(name, node):
+        nodes[name] = node
+        if on_node:
+            on_node(name, node)
+
+    # spawn keeps the workers clear of locks held by the web server's threads
+    context = multiprocessing.get_context('spawn')
+    with ThreadPoolExecutor(max_workers=request_data.DEFAULT_WORKERS) as fetch_pool, \
+            ProcessPoolExecutor(max_workers=workers or RUN_ALL_WORKERS, mp_context=context,
+                                initializer=_init_worker) as analysis_pool:
+        futures = {fetch_pool.submit(_fetch, qf): ('fetch', qf) for qf in query_files}
+
+        while futures:
+            done, _ = wait(futures, return_when=FIRST_COMPLETED)
+            for future in done:
+                node_type, name = futures.pop(future)
+                try:
+                    error, seconds = future.result()
+                except Exception as e:
+                    error, seconds = str(e), None
+                finish(name, {
+                    'type': node_type,
+                    'status': 'failed' if error else 'success',
+                    'seconds': round(seconds, 3) if seconds is not None else None,
+                    'error': error,
+                })
+                if node_type != 'fetch':
+                    continue
+
+                for script in list(waiting):
+                    pending = waiting[script]
+                    if name not in pending:
+                        continue
+                    if error:
+                        del waiting[script]
+                        finish(script, {'type': 'analysis', 'status': 'skipped', 'seconds': None,
+                                        'error': f"Fetching {name} failed"})
+                        continue
+                    pending.discard(name)
+                    if not pending:
+                        del waiting[script]
+                        try:
+                            futures[analysis_pool.submit(_analyse, script)] = ('analysis', script)
+                        except Exception as e:
+                            finish(script, {'type': 'analysis', 'status': 'failed', 'seconds': None, 'error': str(e)})
+
+    return nodes
@@ -0,0 +1,96 @@
+import hashlib
+import json
+import os
+import re
+from datetime import datetime, timezone
+
+# Fetched results are reused for this many seconds (0 disables the cache)
+CACHE_TTL = float(os.environ.get('CACHE_TTL', 3600))
+
+# took and hits.total come before the hits and aggregations in a search
+# response, so they can be read from the start of the saved file
+SUMMARY_BYTES = 64 * 1024
+TOOK_PATTERN = re.compile(r'"took"\s*:\s*(\d+)')
+TOTAL_PATTERN = re.compile(r'"total"\s*:\s*\{\s*"value"\s*:\s*(\d+)')
+# Error responses start with their top-level "error" key
+ERROR_PATTERN = re.compile(r'\s*\{\s*"error"\s*:')
+
+
+def get_cache_key(payload, url, mode):
+    """Hash of the query body, the Elasticsearch URL and the fetch mode."""
+    canonical = json.dumps(payload, sort_keys=True, separators=(',', ':'), ensure_ascii=False)
+    return hashlib.sha256(f"{url}\n{mode}\n{canonical}".encode('utf-8')).hexdigest()
+
+
+def get_meta_path(query_name):
+    return os.path.join('data', os.path.splitext(query_name)[0] + '.meta.json')
+
+
+def get_fresh_result(query_name, key, ttl=None, since=None):
+    """Return the cached data file for `query_name`, or None when it must be refetched.
+
+    The entry is only used when it was fetched with the same cache key (so an
+    edited query file or another cluster always refetches) less than `ttl`
+    seconds ago. With `since` (a time.time() value) it must instead have
+    been fetched after that moment, whatever the TTL.
+    """
+    ttl = CACHE_TTL if ttl is None else ttl
+    meta_path = get_meta_path(query_name)
+    if (ttl <= 0 and since is None) or not os.path.exists(meta_path):
+        return None
+
+    try:
+        with open(meta_path, 'r', encoding='utf-8') as f:
+            meta = json.load(f)
+        fetched_at = datetime.fromisoformat(meta['fetched_at'])
+        output_path = os.path.join('data', meta['output_file'])
+    except (ValueError, KeyError, TypeError):
+        # Written by an older version or edited by hand
+        return None
+
+    if since is not None:
+        stale = fetched_at.timestamp() < since
+    else:
+        stale = (datetime.now(timezone.utc) - fetched_at).total_seconds() > ttl
+    if meta.get('key') != key or stale or not os.path.exists(output_path):
+        return None
+    # Error bodies cached before they were checked for
+    if is_error_response(output_path):
+        return None
+    return output_path
+
+
+def is_error_response(output_path):
+    """Whether a saved response is an Elasticsearch error instead of a result."""
+    with open(output_path, 'r', encoding='utf-8', errors='replace') as f:
+        return ERROR_PATTERN.match(f.read(256)) is not None
+
+
+def read_response_summary(output_path):
+    with open(output_path, 'r', encoding='utf-8', errors='replace') as f:
+        head = f.read(SUMMARY_BYTES)
+    took = TOOK_PATTERN.search(head)
+    total = TOTAL_PATTERN.search(head)
+    return {
+        'took': int(took.group(1)) if took else None,
+        'hits': int(total.group(1)) if total else None,
+    }
+
+
+def save_entry(query_name, key, output_path, mode):
+    """Record the metadata of a fetched result next to it as data/<name>.meta.json."""
+    meta = {
+        'key': key,
+        'mode': mode,
+        'output_file': os.path.basename(output_path),
+        'fetched_at': datetime.now(timezone.utc).isoformat(),
+        'bytes': os.path.getsize(output_path),
+    }
+    meta.update(read_response_summary(output_path))
+
+    meta_path = get_meta_path(query_name)
+    tmp_path = f"{meta_path}.part"
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(meta, f, indent=2)
+    os.replace(tmp_path, meta_path)
+    return meta
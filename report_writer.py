@@ -0,0 +1,266 @@
+import logging
+import math
+import os
+import re
+import time
+from itertools import islice
+
+import pandas as pd
+
+import metrics
+
+try:
+    import xlsxwriter
+except ImportError:  # openpyxl's write-only mode is used instead
+    xlsxwriter = None
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:  # parquet output is skipped without pyarrow
+    pa = None
+    pq = None
+
+from openpyxl import Workbook
+from openpyxl.cell import WriteOnlyCell
+from openpyxl.styles import Alignment, Border, Font, Side
+
+# Excel's limits; longer sheets continue on '<sheet name> (2)', '(3)', ...
+MAX_SHEET_ROWS = 1048576
+MAX_SHEET_NAME_LENGTH = 31
+
+# Rows are converted to Python values this many at a time
+ROW_CHUNK_SIZE = 10000
+
+FORMATS = ('xlsx', 'csv', 'parquet', 'ndjson')
+MIMETYPES = {
+    'xlsx': 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet',
+    'csv': 'text/csv',
+    'parquet': 'application/vnd.apache.parquet',
+    'ndjson': 'application/x-ndjson',
+}
+# Formats every report is written in, e.g. OUTPUT_FORMATS=xlsx,csv,parquet
+OUTPUT_FORMATS = [f.strip().lower() for f in os.environ.get('OUTPUT_FORMATS', 'xlsx').split(',') if f.strip()]
+
+
+def get_sheet_slug(sheet_name):
+    """File name part for a sheet: 'Summary Statistics' -> 'summary_statistics'."""
+    return re.sub(r'[^0-9a-z]+', '_', sheet_name.lower()).strip('_')
+
+
+def get_table_path(path, fmt, sheet_name=None):
+    """Path of a report table in a flat format.
+
+    The first sheet of a report goes to <name>.<fmt> next to <name>.xlsx,
+    every other sheet to <name>.<sheet slug>.<fmt>. The first sheet can be
+    asked for by name too: its <name>.<sheet slug>.<fmt> is a link to
+    <name>.<fmt> (see link_table).
+    """
+    stem = os.path.splitext(path)[0]
+    if sheet_name is None:
+        return f"{stem}.{fmt}"
+    return f"{stem}.{get_sheet_slug(sheet_name)}.{fmt}"
+
+
+def link_table(table_path, link_path):
+    """Make `link_path` a relative symlink to `table_path`, replacing an older file or link."""
+    if os.path.lexists(link_path):
+        os.remove(link_path)
+    os.symlink(os.path.basename(table_path), link_path)
+
+
+def get_sheet_names(sheet_name, parts):
+    """Names of the `parts` sheets a table is split over, all within Excel's 31 characters."""
+    if parts == 1:
+        return [sheet_name[:MAX_SHEET_NAME_LENGTH]]
+    names = []
+    for part in range(1, parts + 1):
+        suffix = '' if part == 1 else f" ({part})"
+        names.append(sheet_name[:MAX_SHEET_NAME_LENGTH - len(suffix)].rstrip() + suffix)
+    return names
+
+
+def _cell_values(series):
+    """The values of a column as Python objects, None for missing values (left blank, like to_excel)."""
+    if pd.api.types.is_float_dtype(series.dtype):
+        # to_excel writes infinities as the text 'inf'
+        return [None if value != value else (str(value) if math.isinf(value) else value)
+                for value in series.tolist()]
+    values = series.astype(object)
+    return values.where(series.notna(), None).tolist()
+
+
+def iter_rows(df):
+    """Yield the rows of `df` as tuples, converting ROW_CHUNK_SIZE rows at a time."""
+    for start in range(0, len(df), ROW_CHUNK_SIZE):
+        chunk = df.iloc[start:start + ROW_CHUNK_SIZE]
+        yield from zip(*(_cell_values(chunk.iloc[:, i]) for i in range(chunk.shape[1])))
+
+
+class _XlsxWriterBook:
+    def __init__(self, path):
+        self.workbook = xlsxwriter.Workbook(path, {
+            'constant_memory': True,
+            'strings_to_urls': False,
+            'default_date_format': 'yyyy-mm-dd hh:mm:ss',
+        })
+        self.header_format = self.workbook.add_format({
+            'bold': True, 'border': 1, 'align': 'center', 'valign': 'top',
+        })
+        self.sheet = None
+        self.row = 0
+
+    def add_sheet(self, name, header):
+        self.sheet = self.workbook.add_worksheet(name)
+        self.sheet.write_row(0, 0, header, self.header_format)
+        self.row = 1
+
+    def append(self, values):
+        self.sheet.write_row(self.row, 0, values)
+        self.row += 1
+
+    def close(self):
+        self.workbook.close()
+
+
+class _OpenpyxlBook:
+    def __init__(self, path):
+        self.path = path
+        self.workbook = Workbook(write_only=True)
+        self.sheet = None
+
+    def add_sheet(self, name, header):
+        self.sheet = self.workbook.create_sheet(name)
+        thin = Side(style='thin')
+        cells = []
+        for value in header:
+            cell = WriteOnlyCell(self.sheet, value=value)
+            cell.font = Font(bold=True)
+            cell.border = Border(left=thin, right=thin, top=thin, bottom=thin)
+            cell.alignment = Alignment(horizontal='center', vertical='top')
+            cells.append(cell)
+        self.sheet.append(cells)
+
+    def append(self, values):
+        self.sheet.append(values)
+
+    def close(self):
+        self.workbook.save(self.path)
+
+
+def _write_csv(df, path):
+    df.to_csv(path, index=False)
+
+
+def _write_ndjson(df, path):
+    with open(path, 'w', encoding='utf-8') as f:
+        for start in range(0, len(df), ROW_CHUNK_SIZE):
+            lines = df.iloc[start:start + ROW_CHUNK_SIZE].to_json(
+                orient='records', lines=True, force_ascii=False, date_format='iso')
+            f.write(lines if lines.endswith('\n') else lines + '\n')
+
+
+def _write_parquet(df, path):
+    try:
+        table = pa.Table.from_pandas(df, preserve_index=False)
+    except (pa.ArrowTypeError, pa.ArrowInvalid):
+        # Columns mixing numbers and text (like 'N/A' defaults) are stored as text
+        df = df.copy()
+        for column in df.columns[df.dtypes == object]:
+            df[column] = df[column].map(lambda value: value if value is None or value != value else str(value))
+        table = pa.Table.from_pandas(df, preserve_index=False)
+    pq.write_table(table, path)
+
+
+_TABLE_WRITERS = {
+    'csv': _write_csv,
+    'ndjson': _write_ndjson,
+    'parquet': _write_parquet,
+}
+
+
+class ReportWriter:
+    """Write DataFrames to the sheets of an xlsx report, streaming row by row.
+
+    Replaces `pd.ExcelWriter(path, engine='openpyxl')` + `df.to_excel(writer,
+    sheet_name=..., index=False)`, which keeps the whole workbook in memory.
+    Rows go straight to the file with xlsxwriter's constant_memory mode, or
+    openpyxl's write-only mode when xlsxwriter is not installed. A table with
+    more rows than fit on one sheet is continued on '<sheet name> (2)', ...,
+    each with the header row.
+
+        with ReportWriter(output_path) as writer:
+            writer.write_sheet(df, 'Detailed Data')
+            writer.write_sheet(summary_df, 'Summary')
+
+    `formats` (OUTPUT_FORMATS by default) can add csv, parquet and ndjson
+    copies of every sheet, or leave out xlsx; see get_table_path for their
+    file names.
+    """
+
+    def __init__(self, path, formats=None):
+        formats = OUTPUT_FORMATS if formats is None else formats
+        unknown = set(formats) - set(FORMATS)
+        if unknown:
+            raise ValueError(f"Unknown output formats {sorted(unknown)}, expected some of {FORMATS}")
+        if 'parquet' in formats and pq is None:
+            logging.warning("pyarrow is not installed, parquet output is skipped")
+            formats = [fmt for fmt in formats if fmt != 'parquet']
+
+        self.path = path
+        self.formats = formats
+        self._book = None
+        if 'xlsx' in formats:
+            self._book = _XlsxWriterBook(path) if xlsxwriter is not None else _OpenpyxlBook(path)
+        self._sheets = 0
+        self._rows = 0
+        self._seconds = 0.0
+        self._paths = set()
+
+    def write_sheet(self, df, sheet_name, index=False):
+        start = time.perf_counter()
+        if index:
+            df = df.reset_index()
+        for fmt in self.formats:
+            if fmt != 'xlsx':
+                table_path = get_table_path(self.path, fmt, sheet_name if self._sheets else None)
+                _TABLE_WRITERS[fmt](df, table_path)
+                self._paths.add(table_path)
+                if not self._sheets:
+                    link_table(table_path, get_table_path(self.path, fmt, sheet_name))
+        self._sheets += 1
+
+        if self._book is not None:
+            self._write_xlsx_sheet(df, sheet_name)
+        self._rows += len(df)
+        self._seconds += time.perf_counter() - start
+
+    def _write_xlsx_sheet(self, df, sheet_name):
+        header = list(df.columns)
+        rows_per_sheet = MAX_SHEET_ROWS - 1
+        parts = max(1, math.ceil(len(df) / rows_per_sheet))
+
+        rows = iter_rows(df)
+        for name in get_sheet_names(sheet_name, parts):
+            self._book.add_sheet(name, header)
+            for values in islice(rows, rows_per_sheet):
+                self._book.append(values)
+
+    def close(self):
+        start = time.perf_counter()
+        if self._book is not None:
+            self._book.close()
+            self._paths.add(self.path)
+        self._seconds += time.perf_counter() - start
+
+        # Sheets are written in between the script's own work, so the time
+        # spent writing is summed up and reported once as the 'write' stage
+        name = None if metrics.current() else os.path.splitext(os.path.basename(self.path))[0]
+        nbytes = sum(os.path.getsize(path) for path in self._paths if os.path.exists(path))
+        metrics.add_time('write', self._seconds, rows=self._rows, nbytes=nbytes, name=name)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
@@ -1,38 +1,572 @@
 import requests
+import hashlib
 import json
 import os
+import sys
 import argparse
 import time
+import threading
+from urllib.parse import urlsplit, urlunsplit
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from requests.adapters import HTTPAdapter
 from dotenv import load_dotenv
+import composite_aggs
+import es_reader
+import query_cache
+import metrics
+from single_flight import SingleFlight, file_lock
 load_dotenv()
 
-def process_query(query_name, payload):
-    url = os.environ.get('ELASTICSEARCH_URL')
-    headers = {
-        'Content-Type': 'application/json'
-    }
+# Number of queries fetched at the same time when processing the whole query folder
+DEFAULT_WORKERS = int(os.environ.get('REQUEST_WORKERS', 4))
+
+# Connection pool and timeouts (seconds) of the shared Elasticsearch session
+POOL_SIZE = int(os.environ.get('ES_POOL_SIZE', max(10, DEFAULT_WORKERS)))
+CONNECT_TIMEOUT = float(os.environ.get('ES_CONNECT_TIMEOUT', 10))
+READ_TIMEOUT = float(os.environ.get('ES_READ_TIMEOUT', 300))
+
+# Responses are streamed to disk in chunks of this many bytes; set PRETTY_JSON=1
+# to re-indent them instead (debugging only, it decodes the whole response)
+CHUNK_SIZE = int(os.environ.get('RESPONSE_CHUNK_SIZE', 1024 * 1024))
+PRETTY_JSON = os.environ.get('PRETTY_JSON', '').lower() in ('1', 'true', 'yes')
+
+# Hit queries can be exported in full with point-in-time + search_after paging
+# (PAGED_EXPORTS=1 or --paged); each page holds PAGE_SIZE hits
+PAGED_EXPORTS = os.environ.get('PAGED_EXPORTS', '').lower() in ('1', 'true', 'yes')
+PAGE_SIZE = int(os.environ.get('PAGE_SIZE', 10000))
+PIT_KEEP_ALIVE = os.environ.get('PIT_KEEP_ALIVE', '5m')
+
+# Aggregation queries can be fetched as paged composite aggregations instead of
+# size-limited nested terms (COMPOSITE_AGGS=1 or --composite)
+COMPOSITE_AGGS = os.environ.get('COMPOSITE_AGGS', '').lower() in ('1', 'true', 'yes')
+COMPOSITE_SIZE = int(os.environ.get('COMPOSITE_SIZE', 5000))
+
+# Queries with a variant in query/pipeline/ that computes its ratios with
+# pipeline aggregations (bucket_script, filter) use it instead (PIPELINE_AGGS=1 or --pipeline-aggs)
+PIPELINE_AGGS = os.environ.get('PIPELINE_AGGS', '').lower() in ('1', 'true', 'yes')
+PIPELINE_QUERY_DIR = os.path.join('query', 'pipeline')
+
+# Plain searches of a full refresh can be packed into _msearch requests of
+# MSEARCH_BATCH_SIZE queries each (MSEARCH=1 or --msearch)
+MSEARCH = os.environ.get('MSEARCH', '').lower() in ('1', 'true', 'yes')
+MSEARCH_BATCH_SIZE = int(os.environ.get('MSEARCH_BATCH_SIZE', 10))
 
-    # Make the API request
-    response = requests.request("POST", url, headers=headers, data=json.dumps(payload))
+# Responses are trimmed with filter_path to what the analysis scripts read:
+# hits.total and the _source of each hit for the address queries, and the
+# aggregation buckets for the others (set FILTER_RESPONSES=0 to keep everything).
+# The aggregations are kept as a whole, since filter_path drops empty bucket
+# lists the parsers index into.
+FILTER_RESPONSES = os.environ.get('FILTER_RESPONSES', '1').lower() in ('1', 'true', 'yes')
+HITS_FILTER_PATH = 'took,timed_out,error,hits.total,hits.hits._source'
+AGGS_FILTER_PATH = 'took,timed_out,error,hits.total,aggregations'
+PAGED_FILTER_PATH = 'pit_id,took,timed_out,error,hits.total,hits.hits._id,hits.hits._source,hits.hits.sort'
 
+# Queries whose data is read differently from the defaults above
+FILTER_PATHS = {
+    'total_units.json': 'took,timed_out,error,hits.total,aggregations.municipalities.buckets.key,aggregations.municipalities.buckets.doc_count',
+}
+
+_session = None
+_session_lock = threading.Lock()
+# Fetches in progress, by cache key
+_fetches = SingleFlight()
+
+def create_session(pool_size):
+    session = requests.Session()
+    # Ask Elasticsearch for compressed responses; they are decompressed while streaming
+    session.headers['Accept-Encoding'] = 'gzip'
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+def get_session():
+    """Return the long-lived pooled session shared by every fetch in this process.
+
+    Connections are kept alive between queries, so the CLI and the Flask
+    routes only pay TCP/TLS setup once per pooled connection.
+    """
+    global _session
+    with _session_lock:
+        if _session is None:
+            _session = create_session(POOL_SIZE)
+        return _session
+
+def get_output_path(query_name):
     # Generate the output filename based on the query name
     if query_name == 'custom_query':
         output_file = f"{query_name}_{int(time.time())}.txt"  # Add timestamp to avoid overwriting
     else:
         output_file = os.path.splitext(query_name)[0] + '.txt'
-    output_path = os.path.join('data', output_file)
+    os.makedirs('data', exist_ok=True)
+    return os.path.join('data', output_file)
+
+def write_response(response, output_path, pretty=False):
+    """Write a streamed response body to `output_path`.
+
+    By default the raw body is copied to disk in chunks, so the response is
+    never held in memory as Python objects. With `pretty` the body is decoded
+    and re-indented instead, which is easier to read but much slower on large
+    responses. The file is written under a temporary name and moved into
+    place once complete, so readers never see a partial file.
+    """
+    tmp_path = f"{output_path}.part"
+    try:
+        with response:
+            if pretty:
+                with open(tmp_path, 'w', encoding='utf-8') as f:
+                    json.dump(response.json(), f, indent=2, ensure_ascii=False)
+            else:
+                with open(tmp_path, 'wb') as f:
+                    for chunk in response.iter_content(chunk_size=CHUNK_SIZE):
+                        f.write(chunk)
+        os.replace(tmp_path, output_path)
+    finally:
+        # A body cut off halfway leaves nothing behind
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+def get_filter_path(query_name, payload):
+    """Return the filter_path for a plain search of `query_name`, or None to keep the whole response."""
+    # Custom queries are downloaded as is
+    if not FILTER_RESPONSES or query_name == 'custom_query':
+        return None
+    if query_name in FILTER_PATHS:
+        return FILTER_PATHS[query_name]
+    return HITS_FILTER_PATH if is_hits_query(payload) else AGGS_FILTER_PATH
+
+def process_query(query_name, payload, session=None, pretty=None):
+    url = os.environ.get('ELASTICSEARCH_URL')
+    headers = {
+        'Content-Type': 'application/json'
+    }
+    if pretty is None:
+        pretty = PRETTY_JSON
+
+    # Make the API request over the pooled keep-alive connection, streaming the body
+    http = session if session is not None else get_session()
+    filter_path = get_filter_path(query_name, payload)
+    params = {'filter_path': filter_path} if filter_path else None
+    response = http.request("POST", url, headers=headers, data=json.dumps(payload), params=params,
+                            timeout=(CONNECT_TIMEOUT, READ_TIMEOUT), stream=True)
+    # An error (503, 429, search_phase_execution_exception, ...) must not replace the data file
+    if not response.ok:
+        with response:
+            raise requests.HTTPError(f"{response.status_code} {response.reason}: {get_error_reason(response)}",
+                                     response=response)
 
     # Write the response to the file
-    with open(output_path, 'w', encoding='utf-8') as f:
-        json.dump(response.json(), f, indent=2, ensure_ascii=False)
+    output_path = get_output_path(query_name)
+    write_response(response, output_path, pretty=pretty)
 
     print(f"Data for {query_name} has been saved to {output_path}")
+    return output_path
+
+def get_error_reason(response):
+    """The type and reason of an Elasticsearch error response, or the start of its body."""
+    try:
+        error = response.json().get('error')
+    except ValueError:
+        return response.text[:500]
+    if isinstance(error, dict):
+        return f"{error.get('type')}: {error.get('reason')}"
+    return str(error)[:500]
+
+def get_search_urls(url):
+    """Split ELASTICSEARCH_URL (<host>/<index>/_search) into the cluster and index URLs."""
+    parts = urlsplit(url)
+    index_path = parts.path.rstrip('/')
+    if index_path.endswith('/_search'):
+        index_path = index_path[:-len('/_search')]
+    base_url = urlunsplit((parts.scheme, parts.netloc, '', '', ''))
+    index_url = urlunsplit((parts.scheme, parts.netloc, index_path, '', ''))
+    return base_url, index_url
+
+def is_hits_query(payload):
+    # Elasticsearch returns 10 hits when the query does not set a size
+    return payload.get('size', 10) > 0
+
+def process_query_paged(query_name, payload, session=None, page_size=None):
+    """Export every hit of a query to data/<name>.ndjson using PIT + search_after.
+
+    The first line of the file is the response envelope of the first page
+    (took, timed_out, hits.total, ...) without its hits; every following line
+    is one hit. Pages are written as they arrive, so only one page is held in
+    memory at a time. Aggregations are dropped, since only the hits are exported.
+    """
+    base_url, index_url = get_search_urls(os.environ.get('ELASTICSEARCH_URL'))
+    http = session if session is not None else get_session()
+    timeout = (CONNECT_TIMEOUT, READ_TIMEOUT)
+    page_size = page_size or PAGE_SIZE
+
+    body = {k: v for k, v in payload.items() if k not in ('aggs', 'aggregations', 'from')}
+    body['size'] = page_size
+    # _shard_doc is the cheapest tiebreaker and is added implicitly to any custom sort
+    body.setdefault('sort', ['_shard_doc'])
+
+    params = {'filter_path': PAGED_FILTER_PATH} if FILTER_RESPONSES else None
+
+    output_path = os.path.splitext(get_output_path(query_name))[0] + '.ndjson'
+    tmp_path = f"{output_path}.part"
+
+    response = http.post(f"{index_url}/_pit", params={'keep_alive': PIT_KEEP_ALIVE}, timeout=timeout)
+    response.raise_for_status()
+    pit_id = response.json()['id']
+
+    exported = 0
+    try:
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            while True:
+                body['pit'] = {'id': pit_id, 'keep_alive': PIT_KEEP_ALIVE}
+                response = http.post(f"{base_url}/_search", json=body, params=params, timeout=timeout)
+                response.raise_for_status()
+                page = response.json()
+                pit_id = page.pop('pit_id', pit_id)
+                # filter_path leaves out an empty hits list
+                hits = page.get('hits', {}).pop('hits', [])
+
+                if exported == 0:
+                    f.write(json.dumps(page, ensure_ascii=False) + '\n')
+                    # The total is only needed once
+                    body['track_total_hits'] = False
+                elif page.get('timed_out'):
+                    print(f"Page after {exported} hits of {query_name} timed out, results may be partial", file=sys.stderr)
+
+                for hit in hits:
+                    search_after = hit.pop('sort', None)
+                    f.write(json.dumps(hit, ensure_ascii=False) + '\n')
+                exported += len(hits)
+
+                if len(hits) < page_size:
+                    break
+                body['search_after'] = search_after
+        os.replace(tmp_path, output_path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        # The PIT expires after PIT_KEEP_ALIVE anyway; a failed close must not
+        # replace the error of the page loop
+        try:
+            http.delete(f"{base_url}/_pit", json={'id': pit_id}, timeout=timeout)
+        except requests.RequestException as e:
+            print(f"Could not close the point in time of {query_name}: {e}", file=sys.stderr)
+
+    print(f"{exported} hits for {query_name} have been saved to {output_path}")
+    return output_path
+
+def process_query_composite(query_name, payload, composite, session=None, pretty=None):
+    """Fetch an aggregation query as a composite aggregation, following after_key.
+
+    Every page is folded into one bucket tree, which is written to
+    data/<name>.txt in the same nested shape as the original aggregations, so
+    the parsers read it unchanged. Bucket counts are exact, since the terms
+    sizes no longer apply.
+    """
+    url = os.environ.get('ELASTICSEARCH_URL')
+    http = session if session is not None else get_session()
+    if pretty is None:
+        pretty = PRETTY_JSON
+
+    body = {k: v for k, v in payload.items() if k not in ('aggs', 'aggregations')}
+    body['aggs'] = {composite.name: composite.request}
+
+    envelope = None
+    took = 0
+    pages = 0
+    while True:
+        response = http.post(url, json=body, timeout=(CONNECT_TIMEOUT, READ_TIMEOUT))
+        response.raise_for_status()
+        page = response.json()
+        result = page.pop('aggregations')[composite.name]
+        composite.add_page(result['buckets'])
+        took += page.get('took', 0)
+        pages += 1
+
+        if envelope is None:
+            envelope = page
+            # The total is only needed once
+            body['track_total_hits'] = False
+        elif page.get('timed_out'):
+            envelope['timed_out'] = True
+
+        after_key = result.get('after_key')
+        if not after_key or len(result['buckets']) < composite.request['composite']['size']:
+            break
+        composite.set_after(after_key)
+
+    envelope['took'] = took
+    envelope['aggregations'] = composite.to_aggregations()
+
+    output_path = get_output_path(query_name)
+    tmp_path = f"{output_path}.part"
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(envelope, f, indent=2 if pretty else None, ensure_ascii=False)
+    os.replace(tmp_path, output_path)
+
+    print(f"Data for {query_name} has been saved to {output_path} ({pages} composite pages)")
+    return output_path
+
+def get_fetch_mode(query_name, payload, paged=None, composite=None):
+    """Return (mode, composite aggregation) for a query: 'paged', 'composite' or 'search'."""
+    if paged is None:
+        paged = PAGED_EXPORTS
+    if composite is None:
+        composite = COMPOSITE_AGGS
+
+    if paged and is_hits_query(payload):
+        return 'paged', None
+    if composite and not is_hits_query(payload):
+        aggregation = composite_aggs.from_aggs(payload.get('aggs', payload.get('aggregations', {})), COMPOSITE_SIZE)
+        if aggregation is not None:
+            return 'composite', aggregation
+        print(f"Aggregations of {query_name} cannot be paged as a composite aggregation, fetching them as is")
+    return 'search', None
+
+def get_cache_key(query_name, payload, mode):
+    # A differently filtered response is a different result
+    if mode == 'search':
+        mode = f"{mode}:{get_filter_path(query_name, payload)}"
+    return query_cache.get_cache_key(payload, os.environ.get('ELASTICSEARCH_URL'), mode)
+
+def fetch_query(query_name, payload, session=None, pretty=None, paged=None, composite=None, force=False):
+    """Fetch a query with the requested mode, falling back to a plain search.
+
+    Unless `force` is set, a result fetched within CACHE_TTL seconds for the
+    same query body, Elasticsearch URL and mode is reused instead of
+    querying the cluster again.
+    """
+    mode, aggregation = get_fetch_mode(query_name, payload, paged=paged, composite=composite)
+
+    # Custom queries get a new file on every run, so they are never cached
+    cacheable = query_name != 'custom_query'
+    if cacheable:
+        key = get_cache_key(query_name, payload, mode)
+        cached_path = None if force else query_cache.get_fresh_result(query_name, key)
+        if cached_path is not None:
+            print(f"Data for {query_name} is up to date in {cached_path}, skipping fetch")
+            return cached_path
+
+        # Callers asking for the same result while it is being fetched wait
+        # for that fetch instead of writing the same data file a second time
+        return _fetches.do((query_name, key), _fetch_and_save, query_name, payload, mode, aggregation, key, session, pretty,
+                           time.time())
+    return _fetch(query_name, payload, mode, aggregation, session, pretty)
+
+def _fetch(query_name, payload, mode, aggregation, session, pretty):
+    with metrics.span('fetch', os.path.splitext(query_name)[0]) as span:
+        if mode == 'paged':
+            output_path = process_query_paged(query_name, payload, session=session)
+        elif mode == 'composite':
+            output_path = process_query_composite(query_name, payload, aggregation, session=session, pretty=pretty)
+        else:
+            output_path = process_query(query_name, payload, session=session, pretty=pretty)
+        span.add(nbytes=os.path.getsize(output_path))
+    return output_path
+
+def _fetch_and_save(query_name, payload, mode, aggregation, key, session, pretty, requested_at):
+    # Other processes writing data/<name> wait here; the same result fetched
+    # by one of them while this call waited is used as is
+    with file_lock(f"fetch-{query_name}"):
+        cached_path = query_cache.get_fresh_result(query_name, key, since=requested_at)
+        if cached_path is not None:
+            print(f"Data for {query_name} was just fetched by another process, reusing {cached_path}")
+            return cached_path
+        return _fetch_and_save_locked(query_name, payload, mode, aggregation, key, session, pretty)
+
+def _fetch_and_save_locked(query_name, payload, mode, aggregation, key, session, pretty):
+    output_path = _fetch(query_name, payload, mode, aggregation, session, pretty)
+    # Only successful results are cached, so an error is fetched again on the next run
+    if query_cache.is_error_response(output_path):
+        raise RuntimeError(f"Elasticsearch returned an error for {query_name}, see {output_path}")
+    query_cache.save_entry(query_name, key, output_path, mode)
+    return output_path
+
+def get_query_path(query_file, pipeline=None):
+    """Path of a query file: its query/pipeline/ variant with `pipeline` (default: PIPELINE_AGGS) when there is one."""
+    if pipeline is None:
+        pipeline = PIPELINE_AGGS
+    pipeline_path = os.path.join(PIPELINE_QUERY_DIR, query_file)
+    if pipeline and os.path.exists(pipeline_path):
+        return pipeline_path
+    return os.path.join('query', query_file)
+
+def load_query(query_file, pipeline=None):
+    with open(get_query_path(query_file, pipeline), 'r') as f:
+        return json.load(f)
+
+def process_query_file(query_file, session=None, pretty=None, paged=None, composite=None, force=False, pipeline=None):
+    payload = load_query(query_file, pipeline)
+    return fetch_query(query_file, payload, session=session, pretty=pretty, paged=paged, composite=composite, force=force)
+
+def get_input_fingerprint(query_files, paged=None, composite=None, pipeline=None):
+    """Hash of the cache keys of `query_files`: equal fingerprints mean the same input data."""
+    keys = []
+    for query_file in sorted(query_files):
+        payload = load_query(query_file, pipeline)
+        mode, _ = get_fetch_mode(query_file, payload, paged=paged, composite=composite)
+        keys.append(get_cache_key(query_file, payload, mode))
+    return hashlib.sha256('\n'.join(keys).encode('utf-8')).hexdigest()
+
+def process_query_batch(queries, session=None, pretty=None):
+    """Fetch several plain searches with one _msearch request.
+
+    `queries` is a list of (query name, payload). Each response is written to
+    its own data/<name>.txt exactly as a single _search would have returned
+    it, and its cache entry is saved. The combined body goes to disk first,
+    and the responses are copied out of it without decoding any of them whole. Returns a dict of query name -> output
+    path, or the exception for queries that failed.
+    """
+    _, index_url = get_search_urls(os.environ.get('ELASTICSEARCH_URL'))
+    http = session if session is not None else get_session()
+    if pretty is None:
+        pretty = PRETTY_JSON
+
+    # An empty header searches the index of ELASTICSEARCH_URL
+    lines = []
+    for _, payload in queries:
+        lines.append('{}')
+        lines.append(json.dumps(payload, ensure_ascii=False))
+    body = ('\n'.join(lines) + '\n').encode('utf-8')
+
+    # Batches are grouped by filter_path, so the first query's applies to all of them
+    filter_path = get_filter_path(*queries[0])
+    params = None
+    if filter_path:
+        params = {'filter_path': ','.join(f"responses.{path}" for path in filter_path.split(','))}
+
+    # The combined body is streamed to disk like a single response, and each
+    # response is copied from there to its data file, one value at a time
+    os.makedirs('data', exist_ok=True)
+    batch_path = os.path.join('data', f".msearch-{os.getpid()}-{threading.get_ident()}.part")
+    results = {}
+    try:
+        with metrics.span('fetch', 'msearch') as span:
+            response = http.post(f"{index_url}/_msearch", data=body, headers={'Content-Type': 'application/x-ndjson'},
+                                 params=params, timeout=(CONNECT_TIMEOUT, READ_TIMEOUT), stream=True)
+            if not response.ok:
+                with response:
+                    raise requests.HTTPError(f"{response.status_code} {response.reason}: {get_error_reason(response)}",
+                                             response=response)
+            write_response(response, batch_path)
+            span.add(nbytes=os.path.getsize(batch_path))
+
+        responses = es_reader.iter_objects(batch_path, ['responses'])
+        for (query_name, payload), (reader, keys) in zip(queries, responses):
+            output_path = get_output_path(query_name)
+            tmp_path = f"{output_path}.part"
+            with file_lock(f"fetch-{query_name}"):
+                try:
+                    with open(tmp_path, 'w', encoding='utf-8') as f:
+                        if pretty:
+                            result = {key: reader.read_value() for key in keys}
+                            skipped = {key: result.pop(key) for key in ('status', 'error') if key in result}
+                            json.dump(result, f, indent=2, ensure_ascii=False)
+                        else:
+                            skipped = es_reader.copy_object(reader, keys, f.write, skip=('status', 'error'))
+
+                    status = skipped.get('status', 200)
+                    if 'error' in skipped or status >= 300:
+                        results[query_name] = RuntimeError(
+                            json.dumps(skipped.get('error', f"HTTP {status}"), ensure_ascii=False))
+                        continue
+                    os.replace(tmp_path, output_path)
+                    query_cache.save_entry(query_name, get_cache_key(query_name, payload, 'search'), output_path, 'search')
+                finally:
+                    if os.path.exists(tmp_path):
+                        os.remove(tmp_path)
+
+            print(f"Data for {query_name} has been saved to {output_path}")
+            results[query_name] = output_path
+        responses.close()
+    finally:
+        if os.path.exists(batch_path):
+            os.remove(batch_path)
+    return results
+
+def process_all_queries(query_files, workers=DEFAULT_WORKERS, session=None, pretty=None, paged=None, composite=None,
+                        force=False, msearch=None, pipeline=None):
+    """Fetch the given query files concurrently, at most `workers` at a time.
+
+    All requests share one connection pool (the shared session unless another
+    is given), and each data file is written as soon as its response arrives.
+    With `msearch`, plain searches that are not cached are sent in _msearch
+    batches of MSEARCH_BATCH_SIZE instead of one request each.
+    Returns a dict of query file -> error message for the queries that failed,
+    including those Elasticsearch answered with an error status.
+    """
+    workers = max(1, workers)
+    failed = {}
+    if session is None:
+        # Fall back to a dedicated pool when more workers than pooled connections are requested
+        session = get_session() if workers <= POOL_SIZE else create_session(workers)
+    if msearch is None:
+        msearch = MSEARCH
+
+    single_files = list(query_files)
+    batches = []
+    if msearch:
+        single_files = []
+        pending = []
+        for query_file in query_files:
+            payload = load_query(query_file, pipeline)
+            mode, _ = get_fetch_mode(query_file, payload, paged=paged, composite=composite)
+            if mode != 'search':
+                single_files.append(query_file)
+            elif not force and query_cache.get_fresh_result(query_file, get_cache_key(query_file, payload, mode)):
+                print(f"Data for {query_file} is up to date, skipping fetch")
+            else:
+                pending.append((query_file, payload))
+        # Queries in one batch share a filter_path
+        groups = {}
+        for query_file, payload in pending:
+            groups.setdefault(get_filter_path(query_file, payload), []).append((query_file, payload))
+        for group in groups.values():
+            batches += [group[i:i + MSEARCH_BATCH_SIZE] for i in range(0, len(group), MSEARCH_BATCH_SIZE)]
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = {executor.submit(process_query_file, query_file, session, pretty, paged, composite, force, pipeline):
+                   [query_file]
+                   for query_file in single_files}
+        futures.update({executor.submit(process_query_batch, batch, session, pretty): [name for name, _ in batch]
+                        for batch in batches})
+        for future in as_completed(futures):
+            try:
+                result = future.result()
+            except Exception as e:
+                result = {query_file: e for query_file in futures[future]}
+            if not isinstance(result, dict):
+                continue
+            for query_file, error in result.items():
+                if isinstance(error, Exception):
+                    failed[query_file] = str(error)
+                    print(f"Query file {query_file} failed: {error}", file=sys.stderr)
+
+    return failed
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description='Process queries to fetch data.')
     parser.add_argument('--query-file', help='Specific query file to process')
     parser.add_argument('--custom-query', help='Custom KQL query string in JSON format')
+    parser.add_argument('--workers', type=int, default=DEFAULT_WORKERS,
+                        help=f'Number of queries to fetch concurrently (default: {DEFAULT_WORKERS})')
+    parser.add_argument('--pretty', action='store_true', default=PRETTY_JSON,
+                        help='Pretty-print the saved responses instead of streaming the raw body (slower, for debugging)')
+    parser.add_argument('--paged', action='store_true', default=PAGED_EXPORTS,
+                        help='Export all hits of hit queries to data/<name>.ndjson using point-in-time paging')
+    parser.add_argument('--composite', action='store_true', default=COMPOSITE_AGGS,
+                        help='Fetch nested terms/histogram aggregations as paged composite aggregations (exact bucket counts)')
+    # A command line run is a full refresh; the web interface reuses fresh results
+    cache_group = parser.add_mutually_exclusive_group()
+    cache_group.add_argument('--cached', action='store_true',
+                             help=f'Reuse results fetched less than CACHE_TTL ({query_cache.CACHE_TTL:g}s) ago instead of refetching them')
+    cache_group.add_argument('--force', action='store_true',
+                             help='Refetch every query, even when its cached result is fresh (the default)')
+    parser.add_argument('--msearch', action='store_true', default=MSEARCH,
+                        help=f'Send plain searches in _msearch batches of {MSEARCH_BATCH_SIZE} when fetching the whole query folder')
+    parser.add_argument('--pipeline-aggs', action='store_true', default=PIPELINE_AGGS,
+                        help=f'Fetch the {PIPELINE_QUERY_DIR}/ variant of a query when there is one (ratios computed by Elasticsearch)')
     args = parser.parse_args()
+    force = not args.cached
 
     # Create 'data' folder if it doesn't exist
     if not os.path.exists('data'):
@@ -48,7 +582,7 @@ if __name__ == "__main__":
         # Process the custom query
         query_name = 'custom_query'
         payload = json.loads(args.custom_query)
-        process_query(query_name, payload)
+        process_query(query_name, payload, pretty=args.pretty)
     elif args.query_file:
         # Process the specified query file
         query_file = args.query_file
@@ -58,7 +592,7 @@ if __name__ == "__main__":
         with open(query_file, 'r') as f:
             payload = json.load(f)
         query_name = os.path.basename(query_file)
-        process_query(query_name, payload)
+        fetch_query(query_name, payload, pretty=args.pretty, paged=args.paged, composite=args.composite, force=force)
     else:
         # List all JSON files in the query folder
         query_files = [f for f in os.listdir('query') if f.endswith('.json')]
@@ -67,13 +601,14 @@ if __name__ == "__main__":
             print("No JSON files found in the 'query' folder. Please add query files.")
             exit()
 
-        # Process each query file
-        for query_file in query_files:
-            print(f"Processing query file: {query_file}")
-
-            with open(os.path.join('query', query_file), 'r') as f:
-                payload = json.load(f)
+        # Process the query files concurrently
+        print(f"Processing {len(query_files)} query files with {args.workers} workers")
+        failed = process_all_queries(query_files, workers=args.workers, pretty=args.pretty, paged=args.paged,
+                                     composite=args.composite, force=force, msearch=args.msearch,
+                                     pipeline=args.pipeline_aggs)
 
-            process_query(query_file, payload)
+        if failed:
+            print(f"{len(failed)} of {len(query_files)} queries failed: {', '.join(sorted(failed))}")
+            sys.exit(1)
 
         print("All queries have been processed.")
@@ -0,0 +1,86 @@
+import os
+import re
+import threading
+from contextlib import contextmanager
+
+try:
+    import fcntl
+except ImportError:  # not available on Windows; file_lock then only holds within one process
+    fcntl = None
+
+# Lock files shared by all processes of the app (e.g. gunicorn workers)
+LOCK_DIR = os.path.join('logs', 'locks')
+
+
+class _Call:
+    __slots__ = ('done', 'result', 'error')
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight:
+    """Run at most one call per key at a time; concurrent callers share its result.
+
+    The first caller of `do` for a key runs the function. Callers arriving
+    with the same key while it runs wait for it and get the same result (or
+    the same exception) instead of repeating the work. Once the call has
+    finished the key is free again, so later callers run it anew.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls = {}
+
+    def do(self, key, func, *args, **kwargs):
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = _Call()
+
+        if not leader:
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result
+
+        try:
+            call.result = func(*args, **kwargs)
+            return call.result
+        except BaseException as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
+
+
+_local_locks = {}
+_local_locks_lock = threading.Lock()
+
+
+@contextmanager
+def file_lock(name):
+    """Hold an exclusive lock named `name` across processes, through flock on LOCK_DIR/<name>.lock.
+
+    SingleFlight only sees the callers of one process; with several gunicorn
+    workers, identical requests must also wait for each other before
+    writing the same data or output file.
+    """
+    if fcntl is None:
+        with _local_locks_lock:
+            lock = _local_locks.setdefault(name, threading.Lock())
+        with lock:
+            yield
+        return
+    os.makedirs(LOCK_DIR, exist_ok=True)
+    with open(os.path.join(LOCK_DIR, re.sub(r'[^\w.-]', '_', name) + '.lock'), 'a') as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
@@ -1,57 +1,38 @@
-import json
 import pandas as pd
-from collections import defaultdict
 import os
 import logging
+from es_reader import read_aggregation_output
+from report_writer import ReportWriter
+from table_cache import cached_table
+from flatten_aggs import flatten_buckets
 
 logging.basicConfig(filename='/app/logs/supplementary_heating.log', level=logging.INFO, 
                     format='%(asctime)s - %(levelname)s - %(message)s')
 
+@cached_table
 def parse_elasticsearch_output(file_path):
-    with open(file_path, 'r') as file:
-        data = json.load(file)
+    data, buckets = read_aggregation_output(file_path)
     
     total_hits = data['hits']['total']['value']
     logging.info(f"Total hits from Elasticsearch: {total_hits}")
 
-    results = []
-    total_processed = 0
-
-    for municipality in data['aggregations']['municipalities']['buckets']:
-        municipality_code = municipality['key']
-        municipality_count = municipality['doc_count']
-        total_processed += municipality_count
-
-        for installation in municipality['heatingInstallations']['buckets']:
-            installation_code = installation['key']
-            installation_count = installation['doc_count']
-
-            supplementary_count = 0
-            for medium in installation['supplementary_heating']['buckets']:
-                medium_code = medium['key']
-                count = medium['doc_count']
-                supplementary_count += count
-                results.append({
-                    'municipality_code': municipality_code,
-                    'installation_code': installation_code,
-                    'medium_code': medium_code,
-                    'count': count
-                })
-
-            # Add a row for buildings without supplementary heating
-            if supplementary_count < installation_count:
-                results.append({
-                    'municipality_code': municipality_code,
-                    'installation_code': installation_code,
-                    'medium_code': 'No supplementary',
-                    'count': installation_count - supplementary_count
-                })
-
-    logging.info(f"Total processed: {total_processed}")
-    return pd.DataFrame(results)
+    municipality_counts = []
 
+    def count_municipalities(buckets):
+        for municipality in buckets:
+            municipality_counts.append(municipality['doc_count'])
+            yield municipality
 
-if __name__ == "__main__":
+    # Buildings without supplementary heating get a 'No supplementary' row
+    df = flatten_buckets(count_municipalities(buckets), 'municipalities > heatingInstallations > supplementary_heating',
+                         ['municipality_code', 'installation_code', 'medium_code'], other='No supplementary',
+                         categorical=['municipality_code', 'installation_code', 'medium_code'])
+
+    logging.info(f"Total processed: {sum(municipality_counts)}")
+    return df
+
+
+def main():
     try:
         input_file = os.environ.get('INPUT_FILE', 'supplementary_heating.txt')
         output_file = os.environ.get('OUTPUT_FILE', 'supplementary_heating.xlsx')
@@ -70,9 +51,9 @@ if __name__ == "__main__":
 
         # Calculate summary statistics
         total_supplementary = df['count'].sum()
-        supplementary_by_type = df.groupby('medium_code')['count'].sum().sort_values(ascending=False)
-        top_5_combinations = df.groupby(['installation_code', 'medium_code'])['count'].sum().sort_values(ascending=False).head()
-        municipalities_with_most = df.groupby('municipality_code')['count'].sum().sort_values(ascending=False).head()
+        supplementary_by_type = df.groupby('medium_code', observed=True)['count'].sum().sort_values(ascending=False)
+        top_5_combinations = df.groupby(['installation_code', 'medium_code'], observed=True)['count'].sum().sort_values(ascending=False).head()
+        municipalities_with_most = df.groupby('municipality_code', observed=True)['count'].sum().sort_values(ascending=False).head()
 
         logging.info(f"Summary statistics calculated: Total Supplementary Heating={total_supplementary}")
         logging.info(f"Top 5 supplementary heating types:\n{supplementary_by_type.head().to_string()}")
@@ -81,8 +62,8 @@ if __name__ == "__main__":
 
         # Save to Excel
         output_path = f"/app/output/{output_file}"
-        with pd.ExcelWriter(output_path, engine='openpyxl') as writer:
-            df.to_excel(writer, sheet_name='Detailed Data', index=False)
+        with ReportWriter(output_path) as writer:
+            writer.write_sheet(df, 'Detailed Data')
             
             # Create a summary sheet
             summary_df = pd.DataFrame({
@@ -93,7 +74,7 @@ if __name__ == "__main__":
                          supplementary_by_type.tolist() +
                          [f"{combo[0]},{combo[1]}: {count}" for combo, count in top_5_combinations.items()]
             })
-            summary_df.to_excel(writer, sheet_name='Summary', index=False)
+            writer.write_sheet(summary_df, 'Summary')
 
         logging.info(f"Results saved to {output_path}")
 
@@ -101,4 +82,7 @@ if __name__ == "__main__":
         logging.error(f"An error occurred: {str(e)}")
         raise
 
-    logging.info("Script completed successfully")
\ No newline at end of file
+    logging.info("Script completed successfully")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,328 @@
+import argparse
+import ast
+import json
+import operator
+import os
+import random
+from datetime import datetime, timezone
+
+# Cardinalities of the generated data: municipality, unit usage and other terms
+# buckets, histogram/date_histogram buckets, and hits of the address queries.
+# Terms buckets are still cut off at each aggregation's size, like Elasticsearch does.
+DEFAULT_SIZES = {
+    'municipalities': 98,
+    'usages': 30,
+    'buckets': 20,
+    'hits': 20000,
+}
+DEFAULT_SEED = 0
+
+USAGE_CODES = [110, 120, 121, 122, 130, 131, 132, 140, 150, 160, 185, 190, 210, 220, 230, 290,
+               310, 320, 330, 390, 410, 420, 430, 440, 490, 510, 520, 530, 540, 590]
+ENERGY_LABELS = ['A2020', 'A2015', 'A2010', 'B', 'C', 'D', 'E', 'F', 'G']
+HEATING_INSTALLATIONS = [1, 2, 3, 5, 6, 7, 8, 9, 99]
+HEATING_MEDIUMS = [1, 2, 3, 4, 6, 7, 8, 9, 99]
+SUPPLEMENTARY_HEATING = [0, 1, 2, 3, 4, 5, 6, 7, 10, 11, 12, 80, 90, 99]
+STREETS = ['Vestergade', 'Østergade', 'Nørregade', 'Søndergade', 'Kirkevej', 'Skovvej', 'Strandvejen', 'Møllevej']
+CITIES = ['Aarhus C', 'Odense C', 'Aalborg', 'Esbjerg', 'Randers', 'Kolding', 'Horsens', 'Vejle']
+
+# Lowest histogram key of a field, when the query gives no extended_bounds
+HISTOGRAM_START = {
+    'bbr_building.byg026_year_of_construction': 1850,
+}
+# Hits are written this many at a time
+HITS_CHUNK_SIZE = 1000
+# Operators of the bucket_script scripts that can be evaluated (plain arithmetic on params.<name>)
+SCRIPT_OPERATORS = {ast.Add: operator.add, ast.Sub: operator.sub, ast.Mult: operator.mul, ast.Div: operator.truediv}
+
+
+def _extend(values, n, start):
+    """The first `n` of `values`, continued with made-up codes from `start` when there are too few."""
+    return values[:n] + list(range(start, start + max(0, n - len(values))))
+
+
+def get_keys(field, n):
+    """The first `n` bucket keys of a terms aggregation on `field`."""
+    if field == 'dawa_municipality.code':
+        return list(range(101, 101 + 2 * n, 2))
+    if field == 'bbr_unit.enh020_units_usage':
+        return _extend(USAGE_CODES, n, 900)
+    if field == 'emoweb_energy_label.current_energy_label':
+        return ENERGY_LABELS[:n]
+    if field == 'bbr_building.byg056_heating_installation':
+        return _extend(HEATING_INSTALLATIONS, n, 100)
+    if field == 'bbr_building.byg057_heating_medium':
+        return _extend(HEATING_MEDIUMS, n, 100)
+    if field == 'bbr_building.byg058_supplementary_heating':
+        return _extend(SUPPLEMENTARY_HEATING, n, 100)
+    if field == 'bbr_building.byg026_year_of_construction':
+        return list(range(2024, 2024 - n, -1))
+    return [f"{field.rsplit('.', 1)[-1]}_{i}" for i in range(n)]
+
+
+def is_boolean_field(field):
+    return field == 'emoweb_energy_label.label_status'
+
+
+def evaluate_script(script, params):
+    """Value of a bucket_script script such as 'params.valid / params.total * 100', or None on division by zero."""
+    source = script['source'] if isinstance(script, dict) else script
+
+    def evaluate(node):
+        if isinstance(node, ast.BinOp) and type(node.op) in SCRIPT_OPERATORS:
+            return SCRIPT_OPERATORS[type(node.op)](evaluate(node.left), evaluate(node.right))
+        if isinstance(node, ast.UnaryOp) and isinstance(node.op, ast.USub):
+            return -evaluate(node.operand)
+        if isinstance(node, ast.Constant) and isinstance(node.value, (int, float)):
+            return node.value
+        if isinstance(node, ast.Attribute) and isinstance(node.value, ast.Name) and node.value.id == 'params':
+            return float(params[node.attr])
+        raise ValueError(f"Cannot evaluate bucket_script {source!r}")
+
+    try:
+        return evaluate(ast.parse(source, mode='eval').body)
+    except ZeroDivisionError:
+        return None
+
+
+def resolve_buckets_path(path, aggs, doc_count):
+    """Value of a buckets_path ('_count', 'filter_name>_count', 'metric.value') within one bucket."""
+    *names, metric = path.replace('.', '>').split('>')
+    if not names and metric == '_count':
+        return doc_count
+    for name in names[:-1]:
+        aggs = aggs[name]
+    agg = aggs[names[-1]] if names else aggs[metric]
+    return agg['doc_count'] if metric == '_count' else agg['value']
+
+
+class ResponseGenerator:
+    """Builds Elasticsearch responses shaped like a query, from seeded random numbers.
+
+    The aggregations of the query are walked level by level: terms get
+    `sizes['municipalities']` buckets on the municipality code,
+    `sizes['usages']` on the unit usage and `sizes['buckets']` on other
+    fields (all capped at the aggregation's size), histograms and
+    date_histograms get `sizes['buckets']` buckets, filters a doc_count, and
+    bucket_scripts the value of their (arithmetic) script.
+    Queries asking for hits get `sizes['hits']` of them (all in one response,
+    like a paged export), with the fields of their _source. The same query,
+    sizes and seed always give the same response.
+    """
+
+    def __init__(self, name, sizes=None, seed=DEFAULT_SEED):
+        self.sizes = {**DEFAULT_SIZES, **(sizes or {})}
+        self.random = random.Random(f"{seed}:{name}")
+
+    def _doc_count(self):
+        # Long-tailed like real counts: most buckets are small, a few are large
+        return min(100000, int(self.random.paretovariate(1.2) * 20))
+
+    def _cardinality(self, field, size):
+        if is_boolean_field(field):
+            n = 2
+        elif field == 'emoweb_energy_label.current_energy_label':
+            n = len(ENERGY_LABELS)
+        elif field == 'dawa_municipality.code':
+            n = self.sizes['municipalities']
+        elif field == 'bbr_unit.enh020_units_usage':
+            n = self.sizes['usages']
+        else:
+            n = self.sizes['buckets']
+        return min(n, size)
+
+    def _sub_aggregations(self, spec):
+        """The sub-aggregations of a bucket and its doc_count."""
+        sub_aggs = spec.get('aggs') or spec.get('aggregations') or {}
+        if not sub_aggs:
+            return {}, self._doc_count()
+        result = {name: self.aggregation(sub_spec) for name, sub_spec in sub_aggs.items()
+                  if 'bucket_script' not in sub_spec}
+        counts = [agg['doc_count'] if 'doc_count' in agg else sum(b['doc_count'] for b in agg['buckets'])
+                  for agg in result.values()]
+        # Documents without a value in the sub-aggregation make the parent a bit larger
+        total = max(counts) if counts else self._doc_count()
+        doc_count = total + self.random.randint(0, max(1, total // 10))
+        # Pipeline aggregations are computed from their sibling aggregations
+        for name, sub_spec in sub_aggs.items():
+            if 'bucket_script' in sub_spec:
+                bucket_script = sub_spec['bucket_script']
+                params = {param: resolve_buckets_path(path, result, doc_count)
+                          for param, path in bucket_script['buckets_path'].items()}
+                result[name] = {'value': evaluate_script(bucket_script['script'], params)}
+        return result, doc_count
+
+    def _bucket(self, key, spec, key_as_string=None):
+        sub_aggs, doc_count = self._sub_aggregations(spec)
+        bucket = {'key': key}
+        if key_as_string is not None:
+            bucket['key_as_string'] = key_as_string
+        bucket['doc_count'] = doc_count
+        bucket.update(sub_aggs)
+        return bucket
+
+    def _terms(self, spec):
+        terms = spec['terms']
+        field = terms.get('field', '')
+        n = self._cardinality(field, terms.get('size', 10))
+        if is_boolean_field(field):
+            buckets = [self._bucket(key, spec, text) for key, text in [(1, 'true'), (0, 'false')][:n]]
+        else:
+            buckets = [self._bucket(key, spec) for key in get_keys(field, n)]
+        # Elasticsearch's default terms order: most documents first, ties by key
+        buckets.sort(key=lambda bucket: (-bucket['doc_count'], bucket['key']))
+        return {'doc_count_error_upper_bound': 0, 'sum_other_doc_count': 0, 'buckets': buckets}
+
+    def _histogram(self, spec):
+        histogram = spec['histogram']
+        interval = histogram['interval']
+        bounds = histogram.get('extended_bounds')
+        n = self.sizes['buckets']
+        if bounds:
+            start = bounds['min'] - bounds['min'] % interval
+            n = min(n, int((bounds['max'] - start) // interval) + 1)
+        else:
+            start = HISTOGRAM_START.get(histogram.get('field'), 0)
+            start -= start % interval
+        return {'buckets': [self._bucket(start + i * interval, spec) for i in range(n)]}
+
+    def _date_histogram(self, spec):
+        # Yearly buckets up to the current year, oldest first
+        this_year = datetime.now(timezone.utc).year
+        buckets = []
+        for year in range(this_year - self.sizes['buckets'] + 1, this_year + 1):
+            date = datetime(year, 1, 1, tzinfo=timezone.utc)
+            buckets.append(self._bucket(int(date.timestamp() * 1000), spec, date.strftime('%Y-%m-%d')))
+        return {'buckets': buckets}
+
+    def _filter(self, spec):
+        sub_aggs, doc_count = self._sub_aggregations(spec)
+        return {'doc_count': doc_count, **sub_aggs}
+
+    def aggregation(self, spec):
+        if 'terms' in spec:
+            return self._terms(spec)
+        if 'histogram' in spec:
+            return self._histogram(spec)
+        if 'date_histogram' in spec:
+            return self._date_histogram(spec)
+        if 'filter' in spec:
+            return self._filter(spec)
+        raise ValueError(f"Cannot generate an aggregation of type {sorted(spec)}")
+
+    def source_value(self, field):
+        """A random value of a hit's _source field."""
+        r = self.random
+        if field == 'dar_address.address_designation':
+            return f"{r.choice(STREETS)} {r.randint(1, 250)}, {r.randint(1000, 9990)} {r.choice(CITIES)}"
+        if field in ('bbr_building.byg038_total_building_area', 'bbr_unit.enh026_unit_total_area'):
+            return int(r.lognormvariate(4.8, 0.9))
+        if field == 'bbr_building.byg026_year_of_construction':
+            return r.randint(1850, 2024)
+        if field == 'bbr_building.byg027_year_of_extension':
+            # Most buildings were never extended
+            return r.randint(1950, 2024) if r.random() < 0.3 else None
+        if field == 'emoweb_energy_label.valid_from':
+            return f"{r.randint(2010, 2024)}-{r.randint(1, 12):02d}-{r.randint(1, 28):02d}"
+        if is_boolean_field(field):
+            return r.random() < 0.7
+        return r.choice(get_keys(field, self.sizes['buckets']))
+
+    def hit(self, i, fields):
+        return {'_index': 'synthetic', '_id': str(i), '_score': 1.0,
+                '_source': {field: self.source_value(field) for field in fields}}
+
+    def iter_response(self, payload):
+        """Yield the JSON text of the response to `payload` in pieces.
+
+        The hits are generated and serialized HITS_CHUNK_SIZE at a time, so
+        responses with millions of hits never have to fit in memory.
+        """
+        aggs = payload.get('aggs') or payload.get('aggregations') or {}
+        aggregations = {name: self.aggregation(spec) for name, spec in aggs.items()}
+        n = self.sizes['hits'] if payload.get('size', 10) else 0
+        if aggregations and not n:
+            first = next(iter(aggregations.values()))
+            total = first.get('doc_count', sum(bucket['doc_count'] for bucket in first.get('buckets', [])))
+        else:
+            total = n
+
+        response = {
+            'took': 1, 'timed_out': False,
+            '_shards': {'total': 1, 'successful': 1, 'skipped': 0, 'failed': 0},
+            'hits': {'total': {'value': total, 'relation': 'eq'}, 'max_score': 1.0 if n else None, 'hits': []},
+        }
+        if aggregations:
+            response['aggregations'] = aggregations
+        text = json.dumps(response, ensure_ascii=False)
+        if not n:
+            yield text
+            return
+
+        # Everything up to the (empty) hits array, the hits, then the rest
+        head, tail = text.split('"hits": []', 1)
+        yield head + '"hits": ['
+        fields = payload.get('_source') or []
+        for start in range(0, n, HITS_CHUNK_SIZE):
+            hits = (json.dumps(self.hit(i, fields), ensure_ascii=False)
+                    for i in range(start, min(n, start + HITS_CHUNK_SIZE)))
+            yield (',' if start else '') + ','.join(hits)
+        yield ']' + tail
+
+
+def get_response_name(query_file):
+    return os.path.splitext(os.path.basename(query_file))[0]
+
+
+def iter_response(query_file, sizes=None, seed=DEFAULT_SEED, payload=None):
+    """Yield the synthetic response to a query file (see ResponseGenerator.iter_response)."""
+    if payload is None:
+        with open(query_file, 'r', encoding='utf-8') as f:
+            payload = json.load(f)
+    generator = ResponseGenerator(get_response_name(query_file), sizes, seed)
+    return generator.iter_response(payload)
+
+
+def write_response(query_file, output_path, sizes=None, seed=DEFAULT_SEED):
+    """Write the synthetic response to a query file where its data file would be; returns its size."""
+    tmp_path = f"{output_path}.part"
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        for piece in iter_response(query_file, sizes, seed):
+            f.write(piece)
+    os.replace(tmp_path, output_path)
+    return os.path.getsize(output_path)
+
+
+def write_responses(query_files, output_dir, sizes=None, seed=DEFAULT_SEED):
+    """Write data/<name>.txt-style synthetic responses of `query_files` to `output_dir`."""
+    os.makedirs(output_dir, exist_ok=True)
+    paths = {}
+    for query_file in query_files:
+        path = os.path.join(output_dir, get_response_name(query_file) + '.txt')
+        write_response(query_file, path, sizes, seed)
+        paths[query_file] = path
+    return paths
+
+
+def add_size_arguments(parser):
+    for name, default in DEFAULT_SIZES.items():
+        parser.add_argument(f'--{name}', type=int, default=default,
+                            help=f'Number of {name} to generate (default: {default})')
+    parser.add_argument('--seed', type=int, default=DEFAULT_SEED, help=f'Random seed (default: {DEFAULT_SEED})')
+
+
+def get_sizes(args):
+    return {name: getattr(args, name) for name in DEFAULT_SIZES}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Write synthetic Elasticsearch responses for the query files.')
+    parser.add_argument('query_files', nargs='*', help='Query files (default: every file in query/)')
+    parser.add_argument('--output-dir', default=os.path.join('data', 'synthetic'),
+                        help='Folder the responses are written to (default: data/synthetic)')
+    add_size_arguments(parser)
+    args = parser.parse_args()
+
+    query_files = args.query_files or sorted(os.path.join('query', f) for f in os.listdir('query') if f.endswith('.json'))
+    for query_file, path in write_responses(query_files, args.output_dir, get_sizes(args), args.seed).items():
+        print(f"{query_file} -> {path} ({os.path.getsize(path)} bytes)")
@@ -0,0 +1,159 @@
+import functools
+import hashlib
+import inspect
+import logging
+import os
+import threading
+
+import pandas as pd
+
+import es_reader
+import flatten_aggs
+import metrics
+
+try:
+    import pyarrow as pa
+    from pyarrow import feather
+except ImportError:  # the cache is skipped without pyarrow
+    pa = None
+    feather = None
+
+# Parsed tables are kept as Feather files next to the data they came from
+# (data/.tables/), or in TABLE_CACHE_DIR; set TABLE_CACHE=0 to always parse
+TABLE_CACHE = os.environ.get('TABLE_CACHE', '1').lower() in ('1', 'true', 'yes')
+TABLE_CACHE_DIR = os.environ.get('TABLE_CACHE_DIR')
+# Bump to drop every cached table
+CACHE_VERSION = '1'
+# The parsers decode and flatten with these, so their sources are part of the key
+SOURCE_MODULES = (es_reader, flatten_aggs)
+
+HASH_CHUNK_SIZE = 1024 * 1024
+
+_hashes = {}
+_hashes_lock = threading.Lock()
+
+
+def _hash_file(path):
+    """sha256 of a file, remembered for as long as its size and mtime stay the same."""
+    stat = os.stat(path)
+    memo_key = (os.path.abspath(path), stat.st_size, stat.st_mtime_ns)
+    with _hashes_lock:
+        if memo_key in _hashes:
+            return _hashes[memo_key]
+
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(HASH_CHUNK_SIZE), b''):
+            digest.update(chunk)
+
+    with _hashes_lock:
+        _hashes[memo_key] = digest.hexdigest()
+    return _hashes[memo_key]
+
+
+def get_table_key(file_path, parse):
+    """Hash of the data file, the parser's source file and the SOURCE_MODULES sources."""
+    parts = [CACHE_VERSION, _hash_file(file_path), _hash_file(inspect.getfile(parse))]
+    parts += [_hash_file(inspect.getfile(module)) for module in SOURCE_MODULES]
+    return hashlib.sha256('\n'.join(parts).encode('utf-8')).hexdigest()
+
+
+def get_table_dir(file_path):
+    return TABLE_CACHE_DIR or os.path.join(os.path.dirname(file_path), '.tables')
+
+
+def get_table_prefix(file_path, parse, args=(), kwargs=None):
+    """File name prefix shared by the tables of one parser call on one data file."""
+    call = f"{parse.__qualname__}\n{args!r}\n{sorted((kwargs or {}).items())!r}"
+    call_hash = hashlib.sha256(call.encode('utf-8')).hexdigest()[:12]
+    return f"{os.path.basename(file_path)}.{parse.__name__}.{call_hash}."
+
+
+def _write_table(df, table_path):
+    table = pa.Table.from_pandas(df)
+    tmp_path = f"{table_path}.{os.getpid()}.{threading.get_ident()}.part"
+    # Uncompressed, so reading it back can map the file instead of decoding it
+    try:
+        feather.write_feather(table, tmp_path, compression='uncompressed')
+        os.replace(tmp_path, table_path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+
+def _remove_stale_tables(table_dir, prefix, keep):
+    for file in os.listdir(table_dir):
+        if file.startswith(prefix) and file.endswith('.feather') and file != keep:
+            try:
+                os.remove(os.path.join(table_dir, file))
+            except OSError:
+                pass
+
+
+def _get_parser_name(parse):
+    try:
+        return os.path.splitext(os.path.basename(inspect.getfile(parse)))[0]
+    except TypeError:
+        return parse.__module__
+
+
+def _parse(file_path, parse, args, kwargs):
+    # The decoding inside the parser is reported on its own (see es_reader),
+    # so this is the time spent turning the decoded buckets into the frame
+    with metrics.span('flatten', _get_parser_name(parse)) as span:
+        df = parse(file_path, *args, **kwargs)
+        if isinstance(df, pd.DataFrame):
+            span.add(rows=len(df))
+    return df
+
+
+def load_table(file_path, parse, *args, **kwargs):
+    """Return `parse(file_path, *args, **kwargs)`, from the table cache when possible.
+
+    The first parse of a data file is saved as a Feather file keyed on the
+    hash of the data file, so later runs on the same data memory-map the
+    table instead of reading the JSON again. A refetched file (or an edited
+    parser, es_reader or flatten_aggs) gets a new key, and the outdated
+    table is removed. Results that are not DataFrames, or that Arrow cannot
+    store (like columns mixing numbers and text), are returned without being
+    cached.
+    """
+    if not TABLE_CACHE or feather is None or not os.path.exists(file_path):
+        return _parse(file_path, parse, args, kwargs)
+
+    table_dir = get_table_dir(file_path)
+    prefix = get_table_prefix(file_path, parse, args, kwargs)
+    try:
+        table_file = f"{prefix}{get_table_key(file_path, parse)[:32]}.feather"
+    except (OSError, TypeError):
+        # No source file to key the parser on
+        return _parse(file_path, parse, args, kwargs)
+    table_path = os.path.join(table_dir, table_file)
+
+    if os.path.exists(table_path):
+        try:
+            with metrics.span('decode', _get_parser_name(parse), nbytes=os.path.getsize(table_path)) as span:
+                df = feather.read_table(table_path, memory_map=True).to_pandas()
+                span.add(rows=len(df))
+            logging.info(f"Loaded parsed table of {file_path} from {table_path}")
+            return df
+        except Exception as e:
+            logging.warning(f"Could not read cached table {table_path}, parsing again: {e}")
+
+    df = _parse(file_path, parse, args, kwargs)
+    if isinstance(df, pd.DataFrame):
+        try:
+            os.makedirs(table_dir, exist_ok=True)
+            _write_table(df, table_path)
+            _remove_stale_tables(table_dir, prefix, table_file)
+        except Exception as e:
+            logging.warning(f"Could not cache the parsed table of {file_path}: {e}")
+    return df
+
+
+def cached_table(parse):
+    """Decorator for parsers taking the data file path first; see load_table."""
+    @functools.wraps(parse)
+    def wrapper(file_path, *args, **kwargs):
+        return load_table(file_path, parse, *args, **kwargs)
+    return wrapper
@@ -0,0 +1,23 @@
+import os
+import sys
+
+import pytest
+
+# The modules under test live at the top of the repository
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import metrics  # noqa: E402
+
+
+@pytest.fixture(autouse=True)
+def workdir(tmp_path, monkeypatch):
+    """Run every test in an empty directory, so data/, output/ and logs/ are its own.
+
+    metrics keeps its series in memory and writes them at exit; each test
+    gets fresh ones, written under the test's directory.
+    """
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(metrics, 'METRICS_DIR', str(tmp_path / 'logs' / 'metrics'))
+    monkeypatch.setattr(metrics, '_series', {})
+    monkeypatch.setattr(metrics, '_process_file', None)
+    return tmp_path
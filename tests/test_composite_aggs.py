@@ -0,0 +1,152 @@
+import pytest
+
+import composite_aggs
+
+TERMS_CHAIN = {
+    'municipalities': {
+        'terms': {'field': 'municipality', 'size': 100},
+        'aggs': {
+            'usages': {
+                'terms': {'field': 'usage', 'size': 10},
+                'aggs': {'area': {'sum': {'field': 'area'}}},
+            },
+        },
+    },
+}
+
+
+def bucket(doc_count, **key):
+    return {'key': key, 'doc_count': doc_count}
+
+
+def test_from_aggs_builds_composite_request():
+    composite = composite_aggs.from_aggs(TERMS_CHAIN, 500)
+    assert composite.name == 'municipalities'
+    assert composite.request == {
+        'composite': {
+            'size': 500,
+            'sources': [
+                {'municipalities': {'terms': {'field': 'municipality', 'missing_bucket': True}}},
+                {'usages': {'terms': {'field': 'usage', 'missing_bucket': True}}},
+            ],
+        },
+        'aggs': {'area': {'sum': {'field': 'area'}}},
+    }
+
+
+@pytest.mark.parametrize('aggs', [
+    {},
+    # Two aggregations side by side are not a single chain
+    {'a': {'terms': {'field': 'a'}}, 'b': {'terms': {'field': 'b'}}},
+    # Parameters a composite source cannot take
+    {'a': {'terms': {'field': 'a', 'order': {'_key': 'asc'}}}},
+    {'a': {'terms': {'field': 'a'}, 'meta': {}}},
+    {'a': {'range': {'field': 'a', 'ranges': [{'to': 10}]}}},
+    # Date formats key_as_string cannot be rebuilt from
+    {'a': {'date_histogram': {'field': 'd', 'calendar_interval': 'year', 'format': 'EEE'}}},
+])
+def test_from_aggs_rejects_what_it_cannot_convert(aggs):
+    assert composite_aggs.from_aggs(aggs, 100) is None
+
+
+def test_pages_fold_into_nested_terms():
+    composite = composite_aggs.from_aggs(TERMS_CHAIN, 2)
+    # The after_key pages split a municipality's buckets between them
+    composite.add_page([
+        {**bucket(3, municipalities='Aarhus', usages='110'), 'area': {'value': 30.0}},
+        {**bucket(5, municipalities='Aarhus', usages='120'), 'area': {'value': 50.0}},
+    ])
+    composite.set_after({'municipalities': 'Aarhus', 'usages': '120'})
+    assert composite.request['composite']['after'] == {'municipalities': 'Aarhus', 'usages': '120'}
+    composite.add_page([
+        # Missing child field: only counted in the municipality
+        bucket(2, municipalities='Aarhus', usages=None),
+        {**bucket(8, municipalities='Odense', usages='110'), 'area': {'value': 80.0}},
+    ])
+
+    municipalities = composite.to_aggregations()['municipalities']
+    assert municipalities['sum_other_doc_count'] == 0
+    assert [(b['key'], b['doc_count']) for b in municipalities['buckets']] == [('Aarhus', 10), ('Odense', 8)]
+    aarhus = municipalities['buckets'][0]['usages']['buckets']
+    assert aarhus == [
+        {'key': '120', 'doc_count': 5, 'area': {'value': 50.0}},
+        {'key': '110', 'doc_count': 3, 'area': {'value': 30.0}},
+    ]
+
+
+def test_terms_order_breaks_ties_by_key():
+    composite = composite_aggs.from_aggs({'a': {'terms': {'field': 'a'}}}, 10)
+    composite.add_page([bucket(1, a='c'), bucket(4, a='b'), bucket(1, a='a'), bucket(4, a='d')])
+    buckets = composite.to_aggregations()['a']['buckets']
+    assert [b['key'] for b in buckets] == ['b', 'd', 'a', 'c']
+
+
+def test_boolean_keys_render_like_terms():
+    composite = composite_aggs.from_aggs({'valid': {'terms': {'field': 'valid'}}}, 10)
+    composite.add_page([bucket(2, valid=True), bucket(1, valid=False)])
+    buckets = composite.to_aggregations()['valid']['buckets']
+    assert buckets == [
+        {'key': 1, 'key_as_string': 'true', 'doc_count': 2},
+        {'key': 0, 'key_as_string': 'false', 'doc_count': 1},
+    ]
+
+
+def test_histogram_gaps_are_filled():
+    aggs = {'years': {'histogram': {'field': 'year', 'interval': 10, 'extended_bounds': {'min': 1900, 'max': 1955}}}}
+    composite = composite_aggs.from_aggs(aggs, 10)
+    assert composite.request['composite']['sources'] == [
+        {'years': {'histogram': {'field': 'year', 'interval': 10, 'missing_bucket': True}}},
+    ]
+    composite.add_page([bucket(4, years=1920.0), bucket(1, years=1940.0)])
+
+    buckets = composite.to_aggregations()['years']['buckets']
+    assert [(b['key'], b['doc_count']) for b in buckets] == [
+        (1900.0, 0), (1910.0, 0), (1920.0, 4), (1930.0, 0), (1940.0, 1), (1950.0, 0),
+    ]
+
+
+def test_histogram_with_min_doc_count_keeps_gaps():
+    aggs = {'years': {'histogram': {'field': 'year', 'interval': 10, 'min_doc_count': 1}}}
+    composite = composite_aggs.from_aggs(aggs, 10)
+    composite.add_page([bucket(4, years=1920.0), bucket(1, years=1940.0)])
+    assert [b['key'] for b in composite.to_aggregations()['years']['buckets']] == [1920.0, 1940.0]
+
+
+def test_date_histogram_keys_and_key_as_string():
+    aggs = {
+        'years': {
+            'date_histogram': {'field': 'valid_from', 'calendar_interval': 'year', 'format': 'yyyy-MM'},
+            'aggs': {'labels': {'terms': {'field': 'label'}}},
+        },
+    }
+    composite = composite_aggs.from_aggs(aggs, 10)
+    # format is only used to rebuild key_as_string; the source is keyed by epoch millis
+    assert composite.request['composite']['sources'][0] == {
+        'years': {'date_histogram': {'field': 'valid_from', 'calendar_interval': 'year', 'missing_bucket': True}},
+    }
+    composite.add_page([
+        bucket(2, years=1262304000000, labels='A'),
+        bucket(1, years=946684800000, labels='C'),
+    ])
+
+    buckets = composite.to_aggregations()['years']['buckets']
+    assert [(b['key'], b['key_as_string']) for b in buckets] == [(946684800000, '2000-01'), (1262304000000, '2010-01')]
+    assert buckets[1]['labels']['buckets'] == [{'key': 'A', 'doc_count': 2}]
+
+
+def test_date_histogram_default_format():
+    composite = composite_aggs.from_aggs({'d': {'date_histogram': {'field': 'd', 'calendar_interval': 'day'}}}, 10)
+    composite.add_page([bucket(1, d=86400000)])
+    assert composite.to_aggregations()['d']['buckets'][0]['key_as_string'] == '1970-01-02T00:00:00.000Z'
+
+
+@pytest.mark.parametrize('date_format, expected', [
+    ('yyyy', '%Y'),
+    ('yyyy-MM-dd HH:mm:ss', '%Y-%m-%d %H:%M:%S'),
+    ('dd/MM/yyyy', '%d/%m/%Y'),
+    ('yyyy%', '%Y%%'),
+    ('epoch_millis', None),
+    ('yyyy-MM-dd EEE', None),
+])
+def test_to_strftime(date_format, expected):
+    assert composite_aggs.to_strftime(date_format) == expected
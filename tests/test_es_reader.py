@@ -0,0 +1,157 @@
+import json
+import os
+
+import pytest
+
+import es_reader
+
+RESPONSE = {
+    'took': 12,
+    'timed_out': False,
+    'hits': {
+        'total': {'value': 3, 'relation': 'eq'},
+        'hits': [
+            {'_id': '1', '_source': {'name': 'Ærøvej 1', 'area': 123.5, 'year': 1960}},
+            {'_id': '2', '_source': {'name': 'Ny "gade" 2', 'area': -0.25e-3, 'year': None}},
+            {'_id': '3', '_source': {'name': 'x' * 50, 'area': 1234567890123, 'tags': [1, [2, {}]]}},
+        ],
+    },
+    'aggregations': {'municipalities': {'buckets': [{'key': 'København', 'doc_count': 98765}]}},
+}
+
+
+def write_json(path, obj, indent=None):
+    with open(path, 'w', encoding='utf-8') as f:
+        json.dump(obj, f, ensure_ascii=False, indent=indent)
+    return str(path)
+
+
+@pytest.fixture
+def stream(monkeypatch):
+    """Always take the streaming path, not the whole-file decode."""
+    monkeypatch.setattr(es_reader, 'FAST_DECODE_MAX_BYTES', 0)
+
+
+@pytest.mark.parametrize('chunk_size', [1, 2, 3, 7, 64, 1024 * 1024])
+@pytest.mark.parametrize('indent', [None, 2])
+def test_split_json_at_every_chunk_boundary(stream, monkeypatch, tmp_path, chunk_size, indent):
+    # Small chunks split keys, strings and numbers between reads
+    monkeypatch.setattr(es_reader, 'READ_CHUNK_SIZE', chunk_size)
+    path = write_json(tmp_path / 'response.txt', RESPONSE, indent)
+
+    data, hits = es_reader.split_json(path, es_reader.HITS_PATH)
+    assert list(hits) == RESPONSE['hits']['hits']
+    # Members after the array are added once it has been read
+    expected = json.loads(json.dumps(RESPONSE))
+    expected['hits'].pop('hits')
+    assert data == expected
+
+
+def test_split_json_decodes_small_files_whole(monkeypatch, tmp_path):
+    path = write_json(tmp_path / 'response.txt', RESPONSE)
+    data, hits = es_reader.split_json(path, es_reader.HITS_PATH)
+    assert list(hits) == RESPONSE['hits']['hits']
+    assert 'hits' not in data['hits'] and data['took'] == 12
+
+
+@pytest.mark.parametrize('fast', [True, False])
+def test_split_json_missing_array_raises_key_error(monkeypatch, tmp_path, fast):
+    if not fast:
+        monkeypatch.setattr(es_reader, 'FAST_DECODE_MAX_BYTES', 0)
+    path = write_json(tmp_path / 'error.txt', {'error': {'type': 'index_not_found_exception'}, 'status': 404})
+
+    data, buckets = es_reader.split_json(path, ['aggregations', 'municipalities', 'buckets'])
+    assert data['status'] == 404
+    with pytest.raises(KeyError):
+        list(buckets)
+
+
+def test_split_json_document_that_is_not_an_object(stream, tmp_path):
+    path = write_json(tmp_path / 'list.txt', [1, 2])
+    data, hits = es_reader.split_json(path, es_reader.HITS_PATH)
+    assert data == [1, 2]
+    with pytest.raises(KeyError):
+        list(hits)
+
+
+def test_split_json_empty_array(stream, tmp_path):
+    path = write_json(tmp_path / 'empty.txt', {'hits': {'hits': [], 'max_score': None}})
+    data, hits = es_reader.split_json(path, es_reader.HITS_PATH)
+    assert list(hits) == []
+    assert data == {'hits': {'max_score': None}}
+
+
+def test_read_search_output_without_hits_array(tmp_path):
+    # filter_path drops an empty hits array from the response
+    path = write_json(tmp_path / 'response.txt', {'took': 1, 'hits': {'total': {'value': 0}}})
+    data, hits = es_reader.read_search_output(path)
+    assert list(hits) == []
+    assert data['took'] == 1
+
+
+def test_read_search_output_paged_export(tmp_path):
+    path = tmp_path / 'export.ndjson'
+    with open(path, 'w', encoding='utf-8') as f:
+        f.write(json.dumps({'took': 5, 'hits': {'total': {'value': 2}}}) + '\n')
+        for hit in RESPONSE['hits']['hits'][:2]:
+            f.write(json.dumps(hit) + '\n')
+        f.write('\n')
+
+    data, hits = es_reader.read_search_output(str(path))
+    assert data['took'] == 5
+    assert list(hits) == RESPONSE['hits']['hits'][:2]
+
+
+def test_resolve_data_file_prefers_recent_paged_export(tmp_path):
+    plain = write_json(tmp_path / 'addresses.txt', RESPONSE)
+    assert es_reader.resolve_data_file(plain) == plain
+
+    paged = tmp_path / 'addresses.ndjson'
+    paged.write_text('{}\n')
+    os.utime(plain, (1000, 1000))
+    os.utime(paged, (2000, 2000))
+    assert es_reader.resolve_data_file(plain) == str(paged)
+
+    os.utime(plain, (3000, 3000))
+    assert es_reader.resolve_data_file(plain) == plain
+
+
+@pytest.mark.parametrize('chunk_size', [1, 5, 1024 * 1024])
+def test_copy_object_splits_msearch_responses(monkeypatch, tmp_path, chunk_size):
+    monkeypatch.setattr(es_reader, 'READ_CHUNK_SIZE', chunk_size)
+    responses = [
+        dict(RESPONSE, status=200),
+        {'error': {'type': 'search_phase_execution_exception'}, 'status': 400},
+        {'took': 0, 'hits': {'hits': []}, 'status': 200},
+    ]
+    path = write_json(tmp_path / 'msearch.txt', {'took': 20, 'responses': responses}, indent=1)
+
+    copies = []
+    for reader, keys in es_reader.iter_objects(path, ['responses']):
+        parts = []
+        skipped = es_reader.copy_object(reader, keys, parts.append, skip=('status', 'error'))
+        copies.append((json.loads(''.join(parts)), skipped))
+
+    assert copies == [
+        (RESPONSE, {'status': 200}),
+        ({}, {'error': {'type': 'search_phase_execution_exception'}, 'status': 400}),
+        ({'took': 0, 'hits': {'hits': []}}, {'status': 200}),
+    ]
+
+
+def test_iter_objects_skips_unread_members(tmp_path):
+    path = write_json(tmp_path / 'msearch.txt', {'responses': [{'a': 1, 'b': [1, 2]}, {'a': 2}]})
+    firsts = []
+    for reader, keys in es_reader.iter_objects(path, ['responses']):
+        # Read only the first member; the rest of the object is skipped
+        next(keys)
+        firsts.append(reader.read_value())
+    assert firsts == [1, 2]
+
+
+def test_invalid_json_raises(stream, tmp_path):
+    path = tmp_path / 'broken.txt'
+    path.write_text('{"hits": {"hits": [{"_id": 1}, {"_id": ]}}')
+    data, hits = es_reader.split_json(str(path), es_reader.HITS_PATH)
+    with pytest.raises(ValueError):
+        list(hits)
@@ -0,0 +1,98 @@
+import pandas as pd
+import pandas.testing as tm
+import pytest
+
+import flatten_aggs
+
+BUCKETS = [
+    {'key': 'Aarhus', 'doc_count': 10, 'usages': {'buckets': [
+        {'key': 110, 'doc_count': 4, 'years': {'buckets': [
+            {'key': 1950.0, 'doc_count': 3},
+            {'key': 1960.0, 'doc_count': 1},
+        ]}},
+        {'key': 120, 'doc_count': 5, 'years': {'buckets': []}},
+    ]}},
+    {'key': 'Odense', 'doc_count': 2, 'usages': {'buckets': []}},
+    {'key': 'Vejle', 'doc_count': 7, 'usages': {'buckets': [
+        {'key': 110, 'doc_count': 7, 'years': {'buckets': [{'key': 2000.0, 'doc_count': 6}]}},
+    ]}},
+]
+PATH = 'municipalities > usages > years'
+KEY_COLUMNS = ['municipality', 'usage', 'year']
+
+
+def test_parse_path():
+    assert flatten_aggs.parse_path('municipalities >usages>  years') == ['municipalities', 'usages', 'years']
+
+
+def test_flatten_matches_rows_built_one_by_one():
+    df = flatten_aggs.flatten_buckets(BUCKETS, PATH, KEY_COLUMNS)
+    expected = pd.DataFrame([
+        {'municipality': 'Aarhus', 'usage': 110, 'year': 1950.0, 'count': 3},
+        {'municipality': 'Aarhus', 'usage': 110, 'year': 1960.0, 'count': 1},
+        {'municipality': 'Vejle', 'usage': 110, 'year': 2000.0, 'count': 6},
+    ])
+    tm.assert_frame_equal(df, expected)
+
+
+def test_empty_and_other_rows():
+    df = flatten_aggs.flatten_buckets(BUCKETS, PATH, KEY_COLUMNS, count_column='n', empty='none', other='other')
+    assert df.to_dict('records') == [
+        {'municipality': 'Aarhus', 'usage': 110, 'year': 1950.0, 'n': 3},
+        {'municipality': 'Aarhus', 'usage': 110, 'year': 1960.0, 'n': 1},
+        {'municipality': 'Aarhus', 'usage': 120, 'year': 'none', 'n': 5},
+        {'municipality': 'Vejle', 'usage': 110, 'year': 2000.0, 'n': 6},
+        {'municipality': 'Vejle', 'usage': 110, 'year': 'other', 'n': 1},
+    ]
+    # A municipality without usages has no leaf level to put an empty row on
+    assert 'Odense' not in set(df['municipality'])
+
+
+def test_categorical_run_length_keys():
+    # Many leaf rows per parent: the parent keys are repeated from runs
+    buckets = [
+        {'key': f"m{m}", 'doc_count': 100, 'labels': {'buckets': [
+            {'key': label, 'doc_count': m + i} for i, label in enumerate('ABCDEFG'[:m + 1])
+        ]}}
+        for m in range(5)
+    ]
+    df = flatten_aggs.flatten_buckets(buckets, 'm > labels', ['municipality', 'label'],
+                                      categorical=['municipality', 'label'])
+
+    assert isinstance(df['municipality'].dtype, pd.CategoricalDtype)
+    assert isinstance(df['label'].dtype, pd.CategoricalDtype)
+    assert df['count'].dtype == 'int64'
+    rows = [(m['key'], b['key'], b['doc_count']) for m in buckets for b in m['labels']['buckets']]
+    assert list(zip(df['municipality'].astype(str), df['label'].astype(str), df['count'])) == rows
+
+
+def test_single_level_and_no_buckets():
+    df = flatten_aggs.flatten_buckets([{'key': 'A', 'doc_count': 3}, {'key': 'B', 'doc_count': 1}],
+                                      'labels', ['label'], empty='none', other='other')
+    assert df.to_dict('records') == [{'label': 'A', 'count': 3}, {'label': 'B', 'count': 1}]
+
+    df = flatten_aggs.flatten_buckets([], PATH, KEY_COLUMNS)
+    assert list(df.columns) == KEY_COLUMNS + ['count'] and len(df) == 0
+
+
+def test_key_columns_must_match_the_path():
+    with pytest.raises(ValueError):
+        flatten_aggs.flatten_buckets(BUCKETS, PATH, ['municipality', 'usage'])
+
+
+def test_columns_build_the_same_frame_as_row_dicts():
+    columns = flatten_aggs.Columns(['municipality', 'area', 'label'], categorical=['label'])
+    rows = [('Aarhus', 120.5, 'A'), ('Odense', None, 'C'), ('Aarhus', 80.0, None)]
+    for row in rows:
+        columns.append(*row)
+    df = columns.to_frame()
+
+    expected = pd.DataFrame([dict(zip(['municipality', 'area', 'label'], row)) for row in rows])
+    expected['label'] = expected['label'].astype('category')
+    tm.assert_frame_equal(df, expected)
+
+
+def test_frame_from_columns_without_rows():
+    df = flatten_aggs.frame_from_columns({'municipality': [], 'count': []}, categorical=['municipality'])
+    assert list(df.columns) == ['municipality', 'count'] and len(df) == 0
+    assert isinstance(df['municipality'].dtype, pd.CategoricalDtype)
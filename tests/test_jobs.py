@@ -0,0 +1,88 @@
+import os
+import threading
+import time
+
+import jobs
+
+
+def wait_for(job_id, timeout=10):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        state = jobs.get_job(job_id)
+        if state['status'] in ('succeeded', 'failed'):
+            return state
+        time.sleep(0.01)
+    raise AssertionError(f"job {job_id} did not finish")
+
+
+def test_job_reports_progress_and_result():
+    def run(job):
+        job.set_total(2)
+        job.add_stage('fetch', 'succeeded', 0.5)
+        job.add_stage('analysis', 'succeeded', 1.5)
+        return {'output': 'report.xlsx'}
+
+    job = jobs.submit('analysis', 'energy_labels.py', run)
+    state = wait_for(job.id)
+
+    assert state['status'] == 'succeeded' and state['error'] is None
+    assert state['progress'] == {'done': 2, 'total': 2}
+    assert state['stages']['analysis'] == {'status': 'succeeded', 'seconds': 1.5, 'error': None}
+    assert state['result']['output'] == 'report.xlsx' and 'seconds' in state['result']
+    assert state['started_at'] and state['finished_at']
+
+
+def test_failed_jobs():
+    def raises(job):
+        raise RuntimeError('cluster down')
+
+    state = wait_for(jobs.submit('fetch', 'request_data.py', raises).id)
+    assert state['status'] == 'failed' and 'RuntimeError: cluster down' in state['error']
+
+    state = wait_for(jobs.submit('fetch', 'request_data.py', lambda job: {'error': 'timeout'}).id)
+    assert state['status'] == 'failed' and state['error'] == 'timeout'
+
+
+def test_identical_submissions_share_a_job():
+    release = threading.Event()
+    calls = []
+
+    def run(job):
+        calls.append(job.id)
+        release.wait(10)
+        return {}
+
+    first = jobs.submit('analysis', 'energy_labels.py', run, key=('analysis', 'energy_labels.py', 'abc'))
+    second = jobs.submit('analysis', 'energy_labels.py', run, key=('analysis', 'energy_labels.py', 'abc'))
+    other = jobs.submit('analysis', 'energy_labels.py', run, key=('analysis', 'energy_labels.py', 'def'))
+    assert second is first
+    assert other is not first
+
+    release.set()
+    wait_for(first.id)
+    wait_for(other.id)
+    assert sorted(calls) == sorted([first.id, other.id])
+
+    # Once finished, the same key runs again
+    third = jobs.submit('analysis', 'energy_labels.py', run, key=('analysis', 'energy_labels.py', 'abc'))
+    assert third is not first
+    wait_for(third.id)
+
+
+def test_get_job_rejects_unknown_ids():
+    assert jobs.get_job('0' * 32) is None
+    assert jobs.get_job('../../etc/passwd') is None
+
+
+def test_list_and_prune_jobs():
+    assert jobs.list_jobs() == []
+    ids = [wait_for(jobs.submit('analysis', f"script_{i}.py", lambda job: {}).id)['id'] for i in range(3)]
+
+    assert [job['id'] for job in jobs.list_jobs()] == ids[::-1]
+    assert [job['id'] for job in jobs.list_jobs(limit=1)] == ids[-1:]
+
+    os.utime(jobs.get_job_path(ids[0]), (0, 0))
+    jobs.prune_jobs()
+    assert [job['id'] for job in jobs.list_jobs()] == ids[:0:-1]
+    jobs.prune_jobs(ttl=-1)
+    assert jobs.list_jobs() == []
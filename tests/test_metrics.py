@@ -0,0 +1,197 @@
+import json
+import multiprocessing
+import os
+import time
+import types
+
+import pytest
+
+import metrics
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    """A perf_counter that only moves when the test advances it."""
+    now = [0.0]
+
+    def advance(seconds):
+        now[0] += seconds
+
+    monkeypatch.setattr(metrics, 'time', types.SimpleNamespace(
+        perf_counter=lambda: now[0], time=time.time, monotonic=time.monotonic))
+    return advance
+
+
+def parse(text):
+    """Samples of the Prometheus text format, by metric name with labels."""
+    samples = {}
+    for line in text.splitlines():
+        if line and not line.startswith('#'):
+            metric, value = line.rsplit(' ', 1)
+            samples[metric] = float(value)
+    return samples
+
+
+def save_process_file(file, *observations, mtime=None):
+    """Save series like another process would, from (stage, name, seconds, rows) observations."""
+    series = {}
+    for stage, name, seconds, rows in observations:
+        entry = series.setdefault((stage, name), metrics._new_series())
+        entry['count'] += 1
+        entry['sum'] += seconds
+        entry['rows'] += rows
+        entry['buckets'] = [count + (seconds <= bound) for count, bound in zip(entry['buckets'], metrics.BUCKETS)]
+        entry['last_seconds'] = seconds
+        entry['last_at'] = time.time()
+    path = os.path.join(metrics.METRICS_DIR, file)
+    os.makedirs(metrics.METRICS_DIR, exist_ok=True)
+    with open(path, 'w', encoding='utf-8') as f:
+        json.dump([[stage, name, entry] for (stage, name), entry in series.items()], f)
+    if mtime is not None:
+        os.utime(path, (mtime, mtime))
+    return path
+
+
+def test_nested_spans_record_their_own_time(clock):
+    with metrics.span('transform', 'energy_labels') as outer:
+        clock(1.0)
+        with metrics.span('flatten') as inner:
+            assert metrics.current() is inner
+            clock(2.0)
+            inner.add(rows=10)
+        clock(0.5)
+        outer.add(rows=3, nbytes=100)
+    assert metrics.current() is None
+
+    assert metrics.totals() == {
+        'flatten': {'seconds': 2.0, 'rows': 10, 'bytes': 0},
+        'transform': {'seconds': 1.5, 'rows': 3, 'bytes': 100},
+    }
+    # The inner span is named after the enclosing one
+    assert ('flatten', 'energy_labels') in metrics._series
+
+
+def test_failed_spans_count_as_errors(clock):
+    with pytest.raises(ValueError):
+        with metrics.span('fetch', 'addresses'):
+            clock(0.2)
+            raise ValueError('timeout')
+    series = metrics._series[('fetch', 'addresses')]
+    assert series['errors'] == 1 and series['count'] == 1 and series['sum'] == 0.2
+
+
+def test_timed_charges_iteration_to_its_stage(clock):
+    def decode():
+        for i in range(3):
+            clock(0.25)
+            yield i
+
+    with metrics.span('flatten', 'heating_matrix'):
+        # Opening the file, before iterating
+        clock(0.5)
+        for _ in metrics.timed(decode(), 'decode', seconds=0.5, nbytes=2048):
+            clock(1.0)
+
+    assert metrics.totals() == {
+        'decode': {'seconds': 1.25, 'rows': 0, 'bytes': 2048},
+        'flatten': {'seconds': 3.0, 'rows': 0, 'bytes': 0},
+    }
+    assert ('decode', 'heating_matrix') in metrics._series
+
+
+def test_stage_decorator_counts_rows(clock):
+    @metrics.stage('transform')
+    def analyse():
+        clock(0.1)
+        return [1, 2, 3]
+
+    assert analyse() == [1, 2, 3]
+    assert metrics._series[('transform', 'test_metrics')]['rows'] == 3
+
+
+def test_render_histogram(clock):
+    metrics.record('fetch', 'addresses', 0.03, rows=5)
+    metrics.record('fetch', 'addresses', 3.0, rows=7, nbytes=1000)
+    metrics.record('write', 'x "quoted"\nname', 700.0, error=True)
+
+    samples = parse(metrics.render())
+    fetch = 'stage="fetch",name="addresses"'
+    assert samples[f'es_analysis_stage_seconds_bucket{{{fetch},le="0.01"}}'] == 0
+    assert samples[f'es_analysis_stage_seconds_bucket{{{fetch},le="0.05"}}'] == 1
+    assert samples[f'es_analysis_stage_seconds_bucket{{{fetch},le="5"}}'] == 2
+    assert samples[f'es_analysis_stage_seconds_bucket{{{fetch},le="+Inf"}}'] == 2
+    assert samples[f'es_analysis_stage_seconds_sum{{{fetch}}}'] == pytest.approx(3.03)
+    assert samples[f'es_analysis_stage_seconds_count{{{fetch}}}'] == 2
+    assert samples[f'es_analysis_stage_rows_total{{{fetch}}}'] == 12
+    assert samples[f'es_analysis_stage_bytes_total{{{fetch}}}'] == 1000
+    assert samples[f'es_analysis_stage_last_seconds{{{fetch}}}'] == 3.0
+
+    write = 'stage="write",name="x \\"quoted\\"\\nname"'
+    assert samples[f'es_analysis_stage_seconds_bucket{{{write},le="600"}}'] == 0
+    assert samples[f'es_analysis_stage_seconds_bucket{{{write},le="+Inf"}}'] == 1
+    assert samples[f'es_analysis_stage_errors_total{{{write}}}'] == 1
+
+
+def test_render_merges_every_process(clock):
+    metrics.record('fetch', 'addresses', 1.0, rows=1)
+    save_process_file('999-aaaaaaaa.json', ('fetch', 'addresses', 2.0, 2), ('write', 'report', 0.5, 3))
+
+    samples = parse(metrics.render())
+    assert samples['es_analysis_stage_seconds_count{stage="fetch",name="addresses"}'] == 2
+    assert samples['es_analysis_stage_rows_total{stage="fetch",name="addresses"}'] == 3
+    assert samples['es_analysis_stage_rows_total{stage="write",name="report"}'] == 3
+    # This process's own series were saved as well
+    assert os.path.exists(metrics._get_process_file())
+
+
+def test_expired_files_are_folded_without_changing_the_totals(clock, monkeypatch):
+    old = time.time() - metrics.METRICS_TTL - 60
+    save_process_file('1-aaaaaaaa.json', ('fetch', 'addresses', 1.0, 10), mtime=old)
+    save_process_file('2-bbbbbbbb.json', ('fetch', 'addresses', 2.0, 20), mtime=old)
+    save_process_file('3-cccccccc.json', ('fetch', 'addresses', 4.0, 40))
+    rows = 'es_analysis_stage_rows_total{stage="fetch",name="addresses"}'
+
+    assert parse(metrics.render())[rows] == 70
+    assert sorted(os.listdir(metrics.METRICS_DIR)) == ['3-cccccccc.json', metrics.EXPIRED_FILE]
+    # Rendering again does not count the folded series twice
+    assert parse(metrics.render())[rows] == 70
+
+    # A file that could not be removed stays listed as folded
+    save_process_file('4-dddddddd.json', ('fetch', 'addresses', 8.0, 80), mtime=old)
+    with monkeypatch.context() as patch:
+        patch.setattr(metrics.os, 'remove', lambda path: None)
+        assert parse(metrics.render())[rows] == 150
+        assert parse(metrics.render())[rows] == 150
+    with open(os.path.join(metrics.METRICS_DIR, metrics.EXPIRED_FILE), encoding='utf-8') as f:
+        assert json.load(f)['folded'] == ['4-dddddddd.json']
+
+
+def test_process_file_is_named_after_the_pid():
+    path = metrics._get_process_file()
+    assert os.path.dirname(path) == metrics.METRICS_DIR
+    assert os.path.basename(path).startswith(f"{os.getpid()}-")
+    assert metrics._get_process_file() == path
+
+
+def _record_in_child(queue):
+    metrics.record('fetch', 'child', 1.0, rows=1)
+    metrics.flush()
+    queue.put((dict(metrics.totals()), metrics._get_process_file()))
+
+
+@pytest.mark.skipif(not hasattr(os, 'register_at_fork'), reason='needs os.register_at_fork')
+def test_forked_process_starts_its_own_series():
+    metrics.record('fetch', 'parent', 1.0, rows=1)
+    context = multiprocessing.get_context('fork')
+    queue = context.Queue()
+    process = context.Process(target=_record_in_child, args=(queue,))
+    process.start()
+    child_totals, child_file = queue.get(timeout=10)
+    process.join(10)
+
+    # The parent's series are not counted again by the child
+    assert child_totals == {'fetch': {'seconds': 1.0, 'rows': 1, 'bytes': 0}}
+    assert child_file != metrics._get_process_file()
+    samples = parse(metrics.render())
+    assert samples['es_analysis_stage_rows_total{stage="fetch",name="parent"}'] == 1
+    assert samples['es_analysis_stage_rows_total{stage="fetch",name="child"}'] == 1
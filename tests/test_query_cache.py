@@ -0,0 +1,104 @@
+import json
+import os
+import time
+from datetime import datetime, timedelta, timezone
+
+import pytest
+
+import query_cache
+
+QUERY = {'size': 0, 'aggs': {'m': {'terms': {'field': 'municipality'}}}}
+URL = 'http://localhost:9200/addresses/_search'
+
+
+@pytest.fixture
+def key():
+    return query_cache.get_cache_key(QUERY, URL, 'search')
+
+
+def save_result(body, name='addresses.txt'):
+    os.makedirs('data', exist_ok=True)
+    path = os.path.join('data', name)
+    with open(path, 'w', encoding='utf-8') as f:
+        f.write(body)
+    return path
+
+
+def set_fetched_at(query_name, fetched_at):
+    meta_path = query_cache.get_meta_path(query_name)
+    with open(meta_path, 'r', encoding='utf-8') as f:
+        meta = json.load(f)
+    meta['fetched_at'] = fetched_at.isoformat()
+    with open(meta_path, 'w', encoding='utf-8') as f:
+        json.dump(meta, f)
+
+
+def test_cache_key_depends_on_query_url_and_mode(key):
+    reordered = {'aggs': {'m': {'terms': {'field': 'municipality'}}}, 'size': 0}
+    assert query_cache.get_cache_key(reordered, URL, 'search') == key
+    assert query_cache.get_cache_key(dict(QUERY, size=1), URL, 'search') != key
+    assert query_cache.get_cache_key(QUERY, URL.replace('9200', '9201'), 'search') != key
+    assert query_cache.get_cache_key(QUERY, URL, 'composite') != key
+
+
+def test_save_entry_records_summary(key):
+    path = save_result('{"took":17,"timed_out":false,"hits":{"total":{"value":1234,"relation":"eq"},"hits":[]}}')
+    meta = query_cache.save_entry('addresses.json', key, path, 'search')
+
+    assert meta['took'] == 17 and meta['hits'] == 1234
+    assert meta['output_file'] == 'addresses.txt' and meta['bytes'] == os.path.getsize(path)
+    with open('data/addresses.meta.json', 'r', encoding='utf-8') as f:
+        assert json.load(f) == meta
+
+
+def test_fresh_result_within_ttl(key):
+    path = save_result('{"took":1,"hits":{"total":{"value":0}}}')
+    query_cache.save_entry('addresses.json', key, path, 'search')
+
+    assert query_cache.get_fresh_result('addresses.json', key, ttl=60) == path
+    # Another query body, cluster or mode
+    assert query_cache.get_fresh_result('addresses.json', 'other', ttl=60) is None
+    # A TTL of 0 disables the cache
+    assert query_cache.get_fresh_result('addresses.json', key, ttl=0) is None
+
+
+def test_result_expires_after_ttl(key):
+    path = save_result('{"took":1}')
+    query_cache.save_entry('addresses.json', key, path, 'search')
+    set_fetched_at('addresses.json', datetime.now(timezone.utc) - timedelta(seconds=120))
+
+    assert query_cache.get_fresh_result('addresses.json', key, ttl=60) is None
+    assert query_cache.get_fresh_result('addresses.json', key, ttl=600) == path
+
+
+def test_since_overrides_ttl(key):
+    path = save_result('{"took":1}')
+    before = time.time() - 1
+    query_cache.save_entry('addresses.json', key, path, 'search')
+
+    assert query_cache.get_fresh_result('addresses.json', key, ttl=0, since=before) == path
+    assert query_cache.get_fresh_result('addresses.json', key, ttl=3600, since=time.time() + 1) is None
+
+
+def test_missing_or_broken_entries_are_refetched(key):
+    assert query_cache.get_fresh_result('addresses.json', key, ttl=60) is None
+
+    path = save_result('{"took":1}')
+    query_cache.save_entry('addresses.json', key, path, 'search')
+    os.remove(path)
+    assert query_cache.get_fresh_result('addresses.json', key, ttl=60) is None
+
+    save_result('{"took":1}')
+    with open(query_cache.get_meta_path('addresses.json'), 'w', encoding='utf-8') as f:
+        f.write('{"key": "')
+    assert query_cache.get_fresh_result('addresses.json', key, ttl=60) is None
+
+
+def test_error_responses_are_never_fresh(key):
+    path = save_result(' {\n  "error" : {"type": "search_phase_execution_exception"}, "status": 400}')
+    assert query_cache.is_error_response(path)
+    query_cache.save_entry('addresses.json', key, path, 'search')
+    assert query_cache.get_fresh_result('addresses.json', key, ttl=60) is None
+
+    # A hit whose source has an "error" field is a result
+    assert not query_cache.is_error_response(save_result('{"took":1,"hits":{"hits":[{"error":1}]}}', 'other.txt'))
@@ -0,0 +1,156 @@
+import json
+import math
+import os
+
+import pandas as pd
+import pytest
+from openpyxl import load_workbook
+
+import report_writer
+
+BOOKS = ['xlsxwriter', 'openpyxl']
+
+
+@pytest.fixture(params=BOOKS)
+def book(request, monkeypatch):
+    """Run with xlsxwriter, and with openpyxl's write-only mode as when xlsxwriter is missing."""
+    if request.param == 'xlsxwriter' and report_writer.xlsxwriter is None:
+        pytest.skip('xlsxwriter is not installed')
+    if request.param == 'openpyxl':
+        monkeypatch.setattr(report_writer, 'xlsxwriter', None)
+    return request.param
+
+
+def read_sheets(path):
+    """Rows of every sheet, without trailing blank cells (openpyxl does not write those)."""
+    workbook = load_workbook(path, read_only=True)
+    sheets = {}
+    for sheet in workbook:
+        rows = [list(row) for row in sheet.iter_rows(values_only=True)]
+        for row in rows:
+            while row and row[-1] is None:
+                row.pop()
+        sheets[sheet.title] = rows
+    return sheets
+
+
+def test_excel_limits():
+    assert report_writer.MAX_SHEET_ROWS == 1048576
+    assert report_writer.MAX_SHEET_NAME_LENGTH == 31
+
+
+def test_writes_every_sheet(book):
+    df = pd.DataFrame({'municipality': ['Aarhus', 'Odense'], 'count': [3, 4]})
+    summary = pd.DataFrame({'total': [7]}, index=pd.Index(['all'], name='scope'))
+    with report_writer.ReportWriter('report.xlsx', formats=['xlsx']) as writer:
+        writer.write_sheet(df, 'Detailed Data')
+        writer.write_sheet(summary, 'Summary', index=True)
+
+    assert read_sheets('report.xlsx') == {
+        'Detailed Data': [['municipality', 'count'], ['Aarhus', 3], ['Odense', 4]],
+        'Summary': [['scope', 'total'], ['all', 7]],
+    }
+
+
+def test_long_tables_continue_on_numbered_sheets(book, monkeypatch):
+    # 4 rows per sheet: the header and 3 rows, read 2 rows at a time
+    monkeypatch.setattr(report_writer, 'MAX_SHEET_ROWS', 4)
+    monkeypatch.setattr(report_writer, 'ROW_CHUNK_SIZE', 2)
+    df = pd.DataFrame({'n': range(7)})
+    with report_writer.ReportWriter('report.xlsx', formats=['xlsx']) as writer:
+        writer.write_sheet(df, 'A sheet name that is far too long for Excel')
+        writer.write_sheet(df.head(3), 'Exactly full')
+        writer.write_sheet(df.head(0), 'Empty')
+
+    sheets = read_sheets('report.xlsx')
+    assert sheets == {
+        'A sheet name that is far too lo': [['n'], [0], [1], [2]],
+        'A sheet name that is far to (2)': [['n'], [3], [4], [5]],
+        'A sheet name that is far to (3)': [['n'], [6]],
+        'Exactly full': [['n'], [0], [1], [2]],
+        'Empty': [['n']],
+    }
+
+
+@pytest.mark.parametrize('parts, names', [
+    (1, ['x' * 31]),
+    (2, ['x' * 31, 'x' * 27 + ' (2)']),
+    (10, ['x' * 31] + ['x' * 27 + f" ({part})" for part in range(2, 10)] + ['x' * 26 + ' (10)']),
+])
+def test_get_sheet_names(parts, names):
+    assert report_writer.get_sheet_names('x' * 40, parts) == names
+
+
+def test_get_sheet_names_strip_before_the_suffix():
+    assert report_writer.get_sheet_names('x' * 26 + ' yyyy', 2) == ['x' * 26 + ' yyyy', 'x' * 26 + ' (2)']
+
+
+def test_cell_values(book):
+    df = pd.DataFrame({
+        'float': [1.5, math.nan, math.inf],
+        'int': pd.array([1, None, 3], dtype='Int64'),
+        'text': ['a', None, 'c'],
+        'category': pd.Categorical(['x', 'y', None]),
+    })
+    assert list(report_writer.iter_rows(df)) == [
+        (1.5, 1, 'a', 'x'),
+        (None, None, None, 'y'),
+        ('inf', 3, 'c', None),
+    ]
+    with report_writer.ReportWriter('report.xlsx', formats=['xlsx']) as writer:
+        writer.write_sheet(df, 'Values')
+    assert read_sheets('report.xlsx')['Values'][1:] == [
+        [1.5, 1, 'a', 'x'],
+        [None, None, None, 'y'],
+        ['inf', 3, 'c'],
+    ]
+
+
+def test_table_paths():
+    assert report_writer.get_sheet_slug('Summary Statistics (2)') == 'summary_statistics_2'
+    assert report_writer.get_table_path('output/report.xlsx', 'csv') == 'output/report.csv'
+    assert report_writer.get_table_path('output/report.xlsx', 'csv', 'Summary') == 'output/report.summary.csv'
+
+
+def test_flat_formats():
+    formats = ['xlsx', 'csv', 'ndjson'] + (['parquet'] if report_writer.pq is not None else [])
+    df = pd.DataFrame({'municipality': ['Aarhus', 'Ærø'], 'area': [1.5, None]})
+    summary = pd.DataFrame({'total': [2]})
+    with report_writer.ReportWriter('report.xlsx', formats=formats) as writer:
+        writer.write_sheet(df, 'Detailed Data')
+        writer.write_sheet(summary, 'Summary')
+
+    assert os.path.exists('report.xlsx')
+    pd.testing.assert_frame_equal(pd.read_csv('report.csv'), df)
+    pd.testing.assert_frame_equal(pd.read_csv('report.summary.csv'), summary)
+    with open('report.ndjson', encoding='utf-8') as f:
+        assert [json.loads(line) for line in f] == [
+            {'municipality': 'Aarhus', 'area': 1.5}, {'municipality': 'Ærø', 'area': None}]
+    if 'parquet' in formats:
+        pd.testing.assert_frame_equal(pd.read_parquet('report.parquet'), df)
+
+    # The first sheet can be asked for by name too
+    assert os.readlink('report.detailed_data.csv') == 'report.csv'
+    pd.testing.assert_frame_equal(pd.read_csv('report.detailed_data.csv'), df)
+
+
+def test_first_sheet_link_is_replaced():
+    for values in ([1], [2]):
+        with report_writer.ReportWriter('report.xlsx', formats=['csv']) as writer:
+            writer.write_sheet(pd.DataFrame({'n': values}), 'Data')
+    assert pd.read_csv('report.data.csv')['n'].tolist() == [2]
+    assert not os.path.exists('report.xlsx')
+
+
+@pytest.mark.skipif(report_writer.pq is None, reason='parquet output needs pyarrow')
+def test_parquet_stores_mixed_columns_as_text():
+    df = pd.DataFrame({'year': [1950, 'N/A', None]})
+    with report_writer.ReportWriter('report.xlsx', formats=['parquet']) as writer:
+        writer.write_sheet(df, 'Years')
+    years = pd.read_parquet('report.parquet')['year'].tolist()
+    assert years[:2] == ['1950', 'N/A'] and pd.isna(years[2])
+
+
+def test_unknown_format():
+    with pytest.raises(ValueError):
+        report_writer.ReportWriter('report.xlsx', formats=['xlsx', 'pdf'])
@@ -0,0 +1,112 @@
+import multiprocessing
+import os
+import threading
+import time
+
+import pytest
+
+import single_flight
+
+
+def run_threads(count, target):
+    threads = [threading.Thread(target=target) for _ in range(count)]
+    for thread in threads:
+        thread.start()
+    return threads
+
+
+def test_concurrent_callers_share_one_call():
+    flight = single_flight.SingleFlight()
+    started = threading.Event()
+    release = threading.Event()
+    calls = []
+    results = []
+
+    def work():
+        calls.append(1)
+        started.set()
+        release.wait(10)
+        return 'result'
+
+    leader = run_threads(1, lambda: results.append(flight.do('key', work)))
+    assert started.wait(10)
+    followers = run_threads(4, lambda: results.append(flight.do('key', work)))
+    time.sleep(0.05)
+    release.set()
+    for thread in leader + followers:
+        thread.join(10)
+
+    assert calls == [1]
+    assert results == ['result'] * 5
+
+
+def test_followers_get_the_leaders_exception():
+    flight = single_flight.SingleFlight()
+    started = threading.Event()
+    release = threading.Event()
+    errors = []
+
+    def work():
+        started.set()
+        release.wait(10)
+        raise ValueError('bad query')
+
+    def call():
+        try:
+            flight.do('key', work)
+        except ValueError as e:
+            errors.append(e)
+
+    threads = run_threads(1, call)
+    assert started.wait(10)
+    threads += run_threads(2, call)
+    time.sleep(0.05)
+    release.set()
+    for thread in threads:
+        thread.join(10)
+
+    assert len(errors) == 3 and len({id(e) for e in errors}) == 1
+
+
+def test_keys_are_independent_and_freed_after_the_call():
+    flight = single_flight.SingleFlight()
+    assert flight.do('a', lambda: 1) == 1
+    assert flight.do('b', lambda: 2) == 2
+    # Finished calls are not cached
+    assert flight.do('a', lambda x: x * 3, 5) == 15
+    with pytest.raises(KeyError):
+        flight.do('a', dict().__getitem__, 'missing')
+    assert flight.do('a', lambda: 'again') == 'again'
+
+
+def _hold_lock(name, path, seconds):
+    with single_flight.file_lock(name):
+        with open(path, 'a') as f:
+            f.write('start\n')
+        time.sleep(seconds)
+        with open(path, 'a') as f:
+            f.write('end\n')
+
+
+@pytest.mark.skipif(single_flight.fcntl is None, reason='file_lock only holds across processes with fcntl')
+def test_file_lock_excludes_other_processes(tmp_path):
+    log = str(tmp_path / 'log.txt')
+    context = multiprocessing.get_context('fork')
+    processes = [context.Process(target=_hold_lock, args=('data/addresses.txt', log, 0.1)) for _ in range(3)]
+    for process in processes:
+        process.start()
+    for process in processes:
+        process.join(10)
+
+    with open(log) as f:
+        assert f.read().split() == ['start', 'end'] * 3
+    assert os.listdir(single_flight.LOCK_DIR) == ['data_addresses.txt.lock']
+
+
+def test_file_lock_excludes_other_threads(tmp_path):
+    log = str(tmp_path / 'log.txt')
+    threads = run_threads(3, lambda: _hold_lock('report', log, 0.05))
+    for thread in threads:
+        thread.join(10)
+    with open(log) as f:
+        assert f.read().split() == ['start', 'end'] * 3
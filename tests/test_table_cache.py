@@ -0,0 +1,142 @@
+import importlib.util
+import json
+import os
+
+import pandas.testing as tm
+import pytest
+
+import table_cache
+
+pytestmark = pytest.mark.skipif(table_cache.feather is None, reason='the table cache needs pyarrow')
+
+PARSER_SOURCE = '''
+import json
+
+import pandas as pd
+
+calls = []
+
+
+def parse(file_path, column='value'):
+    calls.append(file_path)
+    with open(file_path, 'r', encoding='utf-8') as f:
+        return pd.DataFrame({column: json.load(f)})
+'''
+
+
+def load_parser(tmp_path, source=PARSER_SOURCE, name='parser_module'):
+    path = tmp_path / f"{name}.py"
+    path.write_text(source)
+    spec = importlib.util.spec_from_file_location(name, path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def write_data(values, path='data/values.txt'):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'w', encoding='utf-8') as f:
+        json.dump(values, f)
+    return path
+
+
+def cached_tables(path='data/values.txt'):
+    return sorted(os.listdir(table_cache.get_table_dir(path)))
+
+
+def test_second_load_reads_the_cached_table(tmp_path):
+    parser = load_parser(tmp_path)
+    path = write_data([1, 2, 3])
+
+    first = table_cache.load_table(path, parser.parse)
+    second = table_cache.load_table(path, parser.parse)
+    tm.assert_frame_equal(first, second)
+    assert parser.calls == [path]
+    assert len(cached_tables()) == 1 and cached_tables()[0].startswith('values.txt.parse.')
+
+
+def test_arguments_get_their_own_table(tmp_path):
+    parser = load_parser(tmp_path)
+    path = write_data([1, 2])
+
+    assert list(table_cache.load_table(path, parser.parse, column='a').columns) == ['a']
+    assert list(table_cache.load_table(path, parser.parse, column='b').columns) == ['b']
+    assert list(table_cache.load_table(path, parser.parse, column='a').columns) == ['a']
+    assert len(parser.calls) == 2 and len(cached_tables()) == 2
+
+
+def test_refetched_data_replaces_the_stale_table(tmp_path):
+    parser = load_parser(tmp_path)
+    path = write_data([1, 2])
+    table_cache.load_table(path, parser.parse)
+    old_tables = cached_tables()
+
+    write_data([1, 2, 3, 4])
+    df = table_cache.load_table(path, parser.parse)
+    assert df['value'].tolist() == [1, 2, 3, 4]
+    assert len(parser.calls) == 2
+    assert len(cached_tables()) == 1 and cached_tables() != old_tables
+
+
+def test_edited_parser_or_shared_modules_invalidate(tmp_path, monkeypatch):
+    parser = load_parser(tmp_path)
+    path = write_data([1, 2])
+    key = table_cache.get_table_key(path, parser.parse)
+
+    edited = load_parser(tmp_path, PARSER_SOURCE + '\n# parses the same, but is another version\n', 'edited')
+    assert table_cache.get_table_key(path, edited.parse) != key
+
+    with monkeypatch.context() as patch:
+        patch.setattr(table_cache, 'SOURCE_MODULES', (table_cache.es_reader,))
+        assert table_cache.get_table_key(path, parser.parse) != key
+
+    with monkeypatch.context() as patch:
+        patch.setattr(table_cache, 'CACHE_VERSION', 'next')
+        assert table_cache.get_table_key(path, parser.parse) != key
+
+    assert table_cache.get_table_key(path, parser.parse) == key
+
+
+def test_results_arrow_cannot_store_are_not_cached(tmp_path):
+    parser = load_parser(tmp_path)
+    path = write_data([1, 'two', 3.5])
+
+    df = table_cache.load_table(path, parser.parse)
+    assert df['value'].tolist() == [1, 'two', 3.5]
+    assert cached_tables() == []
+    table_cache.load_table(path, parser.parse)
+    assert len(parser.calls) == 2
+
+
+def test_unreadable_table_is_parsed_again(tmp_path):
+    parser = load_parser(tmp_path)
+    path = write_data([1, 2])
+    table_cache.load_table(path, parser.parse)
+    table_path = os.path.join(table_cache.get_table_dir(path), cached_tables()[0])
+    with open(table_path, 'wb') as f:
+        f.write(b'not a feather file')
+
+    assert table_cache.load_table(path, parser.parse)['value'].tolist() == [1, 2]
+    assert len(parser.calls) == 2
+
+
+def test_disabled_cache(tmp_path, monkeypatch):
+    monkeypatch.setattr(table_cache, 'TABLE_CACHE', False)
+    parser = load_parser(tmp_path)
+    path = write_data([1])
+
+    table_cache.load_table(path, parser.parse)
+    table_cache.load_table(path, parser.parse)
+    assert len(parser.calls) == 2
+    assert not os.path.exists(table_cache.get_table_dir(path))
+
+
+def test_cached_table_decorator(tmp_path):
+    parser = load_parser(tmp_path)
+    parse = table_cache.cached_table(parser.parse)
+    path = write_data([5])
+
+    assert parse.__name__ == 'parse'
+    assert parse(path)['value'].tolist() == [5]
+    assert parse(path)['value'].tolist() == [5]
+    assert parser.calls == [path]
@@ -0,0 +1,87 @@
+import io
+import os
+import zipfile
+
+import pytest
+
+import zip_stream
+
+
+def write_file(path, data):
+    with open(path, 'wb') as f:
+        f.write(data)
+    return str(path)
+
+
+@pytest.fixture
+def files(tmp_path):
+    return {
+        'report.csv': write_file(tmp_path / 'report.csv', b'municipality,count\n' + b'Aarhus,3\n' * 5000),
+        'report.xlsx': write_file(tmp_path / 'report.xlsx', os.urandom(300000)),
+        'empty.txt': write_file(tmp_path / 'empty.txt', b''),
+    }
+
+
+def test_archive_is_readable_by_zipfile(files, monkeypatch):
+    monkeypatch.setattr(zip_stream, 'ZIP_CHUNK_SIZE', 4096)
+    pieces = list(zip_stream.iter_zip([(path, name) for name, path in files.items()]))
+    # Compressed and yielded as the files are read, not in one piece at the end
+    assert len(pieces) > 10
+
+    with zipfile.ZipFile(io.BytesIO(b''.join(pieces))) as zf:
+        assert zf.testzip() is None
+        assert zf.namelist() == list(files)
+        for name, path in files.items():
+            with open(path, 'rb') as f:
+                assert zf.read(name) == f.read()
+        infos = {info.filename: info for info in zf.infolist()}
+
+    # Written without seeking: sizes and CRC follow each entry in a data descriptor
+    assert all(info.flag_bits & 0x08 for info in infos.values())
+    assert infos['report.csv'].compress_type == zipfile.ZIP_DEFLATED
+    assert infos['report.csv'].compress_size < infos['report.csv'].file_size
+    assert infos['report.xlsx'].compress_type == zipfile.ZIP_STORED
+
+
+def test_store_compressed_can_be_turned_off(files):
+    data = b''.join(zip_stream.iter_zip([(files['report.xlsx'], 'report.xlsx')], store_compressed=False))
+    with zipfile.ZipFile(io.BytesIO(data)) as zf:
+        assert zf.getinfo('report.xlsx').compress_type == zipfile.ZIP_DEFLATED
+
+
+@pytest.mark.parametrize('path, store_compressed, expected', [
+    ('output/report.XLSX', True, zipfile.ZIP_STORED),
+    ('output/report.parquet', True, zipfile.ZIP_STORED),
+    ('output/report.csv', True, zipfile.ZIP_DEFLATED),
+    ('output/report.xlsx', False, zipfile.ZIP_DEFLATED),
+])
+def test_get_compress_type(path, store_compressed, expected):
+    assert zip_stream.get_compress_type(path, store_compressed) == expected
+
+
+def test_files_removed_since_listing_are_skipped(files, tmp_path):
+    entries = [(str(tmp_path / 'gone.csv'), 'gone.csv'), (files['report.csv'], 'report.csv')]
+    with zipfile.ZipFile(io.BytesIO(b''.join(zip_stream.iter_zip(entries)))) as zf:
+        assert zf.namelist() == ['report.csv']
+
+
+def test_first_bytes_go_out_before_later_files_are_read(files, tmp_path):
+    later = tmp_path / 'later.csv'
+
+    def entries():
+        yield files['report.csv'], 'report.csv'
+        # Only written once the first entry has been sent
+        write_file(later, b'written late')
+        yield str(later), 'later.csv'
+
+    pieces = zip_stream.iter_zip(entries())
+    first = next(pieces)
+    assert first.startswith(b'PK\x03\x04') and not later.exists()
+
+    with zipfile.ZipFile(io.BytesIO(first + b''.join(pieces))) as zf:
+        assert zf.read('later.csv') == b'written late'
+
+
+def test_empty_archive():
+    with zipfile.ZipFile(io.BytesIO(b''.join(zip_stream.iter_zip([])))) as zf:
+        assert zf.namelist() == []
@@ -2,55 +2,44 @@ import json
 import pandas as pd
 import os
 import logging
+from es_reader import read_aggregation_output
+from report_writer import ReportWriter
+from table_cache import cached_table
+from flatten_aggs import Columns, flatten_buckets
 
 logging.basicConfig(filename='/app/logs/unit_areas.log', level=logging.INFO, 
                     format='%(asctime)s - %(levelname)s - %(message)s')
 logging.info("Running updated unit_areas.py script")
 
+@cached_table
 def parse_elasticsearch_output(file_path, is_above_900=False):
-    with open(file_path, 'r') as file:
-        data = json.load(file)
+    data, buckets = read_aggregation_output(file_path)
     
     if 'error' in data:
         logging.error("Elasticsearch query failed. Error details:")
         logging.error(json.dumps(data['error'], indent=2))
         return None
     
-    results = []
+    # Below 900 case: one row per histogram bucket
+    if not is_above_900:
+        df = flatten_buckets(buckets, 'municipalities > unit_usage > unit_areas',
+                             ['municipality_code', 'unit_usage', 'area_range'])
+        df['area_range'] = [f"{min_area}-{min_area + 20}" for min_area in df['area_range'].tolist()]
+        return df
     
-    for municipality in data['aggregations']['municipalities']['buckets']:
+    # Above 900 case: handle large units
+    columns = Columns(['municipality_code', 'unit_usage', 'area_range', 'count'])
+    
+    for municipality in buckets:
         municipality_code = municipality['key']
         
         for usage in municipality['unit_usage']['buckets']:
-            unit_usage = usage['key']
-            
-            # Below 900 case: iterate over the histogram buckets
-            if not is_above_900:
-                for area_bucket in usage['unit_areas']['buckets']:
-                    min_area = area_bucket['key']
-                    max_area = min_area + 20
-                    count = area_bucket['doc_count']
-                    
-                    results.append({
-                        'municipality_code': municipality_code,
-                        'unit_usage': unit_usage,
-                        'area_range': f"{min_area}-{max_area}",
-                        'count': count
-                    })
-            # Above 900 case: handle large units
-            else:
-                if 'large_units' in usage:
-                    large_units_count = usage['large_units']['doc_count']
-                    results.append({
-                        'municipality_code': municipality_code,
-                        'unit_usage': unit_usage,
-                        'area_range': "900+",
-                        'count': large_units_count
-                    })
+            if 'large_units' in usage:
+                columns.append(municipality_code, usage['key'], "900+", usage['large_units']['doc_count'])
     
-    return pd.DataFrame(results)
+    return columns.to_frame()
 
-if __name__ == "__main__":
+def main():
     try:
         # Define file paths relative to the main directory
         below_900_file = os.environ.get('BELOW_900_FILE', 'unit_areas_below_900.txt')
@@ -97,8 +86,8 @@ if __name__ == "__main__":
         os.makedirs(os.path.dirname(output_path), exist_ok=True)
 
         # Save to Excel
-        with pd.ExcelWriter(output_path, engine='openpyxl') as writer:
-            combined_df.to_excel(writer, sheet_name='Detailed Data', index=False)
+        with ReportWriter(output_path) as writer:
+            writer.write_sheet(combined_df, 'Detailed Data')
             
             # Create a summary sheet
             summary_stats_df = pd.DataFrame({
@@ -111,7 +100,7 @@ if __name__ == "__main__":
             # Add total row
             total_row = pd.DataFrame({'Unit Usage': ['Total'], 'Area Range': [''], 'Avg Units': [total_buildings], 'Max Units': [None], 'Min Units': [None]})
             summary_stats_df = pd.concat([summary_stats_df, total_row], ignore_index=True)
-            summary_stats_df.to_excel(writer, sheet_name='Summary Statistics', index=False)
+            writer.write_sheet(summary_stats_df, 'Summary Statistics')
 
         logging.info(f"Results saved to {output_path}")
 
@@ -120,3 +109,6 @@ if __name__ == "__main__":
         raise
 
     logging.info("Script completed successfully")
+
+if __name__ == "__main__":
+    main()
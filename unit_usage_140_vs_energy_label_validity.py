@@ -1,39 +1,42 @@
-import json
 import pandas as pd
 import os
 import logging
+from es_reader import read_aggregation_output
+from report_writer import ReportWriter
+from table_cache import cached_table
+from flatten_aggs import Columns
 
 logging.basicConfig(filename='/app/logs/unit_usage_140_vs_energy_label_validity.log', level=logging.INFO, 
                     format='%(asctime)s - %(levelname)s - %(message)s')
 
+@cached_table
 def parse_energy_label_validity(file_path):
-    with open(file_path, 'r') as file:
-        data = json.load(file)
+    data, buckets = read_aggregation_output(file_path)
     
-    results = []
+    columns = Columns(['municipality_code', 'total_units', 'valid_energy_labels', 'percentage_valid'],
+                      categorical=['municipality_code'])
     
-    for municipality in data['aggregations']['municipalities']['buckets']:
-        municipality_code = municipality['key']
-        total_units = municipality['doc_count']
-        
+    for municipality in buckets:
+        if 'percentage_valid' in municipality:
+            # Counted and divided by the pipeline query (query/pipeline/)
+            columns.append(municipality['key'], municipality['doc_count'],
+                           municipality['valid_energy_labels']['doc_count'], municipality['percentage_valid']['value'])
+            continue
         valid_labels = 0
         for validity in municipality['energy_label_validity']['buckets']:
             if validity['key_as_string'] == 'true':
                 valid_labels = validity['doc_count']
                 break
         
-        percentage_valid = (valid_labels / total_units) * 100 if total_units > 0 else 0
-        
-        results.append({
-            'municipality_code': municipality_code,
-            'total_units': total_units,
-            'valid_energy_labels': valid_labels,
-            'percentage_valid': percentage_valid
-        })
+        columns.append(municipality['key'], municipality['doc_count'], valid_labels, None)
     
-    return pd.DataFrame(results)
+    df = columns.to_frame()
+    # Share of units with a valid label, 0 where there are no units, unless the query computed it
+    df['percentage_valid'] = df['percentage_valid'].astype(float).fillna(
+        (df['valid_energy_labels'] / df['total_units'] * 100).where(df['total_units'] > 0, 0))
+    return df
 
-if __name__ == "__main__":
+def main():
     try:
         input_file = os.environ.get('INPUT_FILE', 'unit_usage_140_vs_energy_label_validity.txt')
         output_file = os.environ.get('OUTPUT_FILE', 'unit_usage_140_vs_energy_label_validity.xlsx')
@@ -65,15 +68,15 @@ if __name__ == "__main__":
 
         # Save to Excel
         output_path = f"/app/output/{output_file}"
-        with pd.ExcelWriter(output_path, engine='openpyxl') as writer:
-            df.to_excel(writer, sheet_name='Municipality Data', index=False)
+        with ReportWriter(output_path) as writer:
+            writer.write_sheet(df, 'Municipality Data')
             
             # Create a summary sheet
             summary_df = pd.DataFrame({
                 'Metric': ['Total Units', 'Total Valid Energy Labels', 'Overall Percentage'],
                 'Value': [total_units, total_valid_labels, f"{overall_percentage:.2f}%"]
             })
-            summary_df.to_excel(writer, sheet_name='Summary', index=False)
+            writer.write_sheet(summary_df, 'Summary')
         
         logging.info(f"Results saved to {output_path}")
 
@@ -81,4 +84,7 @@ if __name__ == "__main__":
         logging.error(f"An error occurred: {str(e)}")
         raise
 
-    logging.info("Script completed successfully")
\ No newline at end of file
+    logging.info("Script completed successfully")
+
+if __name__ == "__main__":
+    main()
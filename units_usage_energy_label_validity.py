@@ -1,43 +1,45 @@
-import json
 import pandas as pd
 import os
 import logging
+from es_reader import read_aggregation_output
+from report_writer import ReportWriter
+from table_cache import cached_table
+from flatten_aggs import Columns
 
 logging.basicConfig(filename='/app/logs/units_usage_energy_label_validity.log', level=logging.INFO, 
                     format='%(asctime)s - %(levelname)s - %(message)s')
 
+@cached_table
 def parse_energy_label_validity(file_path):
-    with open(file_path, 'r') as file:
-        data = json.load(file)
+    data, buckets = read_aggregation_output(file_path)
     
-    results = []
+    columns = Columns(['municipality_code', 'unit_usage', 'total_units', 'valid_energy_labels', 'percentage_valid'],
+                      categorical=['municipality_code', 'unit_usage'])
     
-    for municipality in data['aggregations']['municipalities']['buckets']:
+    for municipality in buckets:
         municipality_code = municipality['key']
         
         for usage in municipality['unit_usage']['buckets']:
-            usage_code = usage['key']
-            total_units = usage['doc_count']
-            
+            if 'percentage_valid' in usage:
+                # Counted and divided by the pipeline query (query/pipeline/)
+                columns.append(municipality_code, usage['key'], usage['doc_count'],
+                               usage['valid_energy_labels']['doc_count'], usage['percentage_valid']['value'])
+                continue
             valid_labels = 0
             for validity in usage['energy_label_validity']['buckets']:
                 if validity['key_as_string'] == 'true':
                     valid_labels = validity['doc_count']
                     break
             
-            percentage_valid = (valid_labels / total_units) * 100 if total_units > 0 else 0
-            
-            results.append({
-                'municipality_code': municipality_code,
-                'unit_usage': usage_code,
-                'total_units': total_units,
-                'valid_energy_labels': valid_labels,
-                'percentage_valid': percentage_valid
-            })
+            columns.append(municipality_code, usage['key'], usage['doc_count'], valid_labels, None)
     
-    return pd.DataFrame(results)
+    df = columns.to_frame()
+    # Share of units with a valid label, 0 where there are no units, unless the query computed it
+    df['percentage_valid'] = df['percentage_valid'].astype(float).fillna(
+        (df['valid_energy_labels'] / df['total_units'] * 100).where(df['total_units'] > 0, 0))
+    return df
 
-if __name__ == "__main__":
+def main():
     try:
         input_file = os.environ.get('INPUT_FILE', 'units_usage_energy_label_validity.txt')
         output_file = os.environ.get('OUTPUT_FILE', 'units_usage_energy_label_validity.xlsx')
@@ -68,7 +70,7 @@ if __name__ == "__main__":
         logging.info(f"Overall percentage of valid energy labels: {overall_percentage:.2f}%")
 
         # Calculate statistics by unit usage
-        usage_stats = df.groupby('unit_usage').agg({
+        usage_stats = df.groupby('unit_usage', observed=True).agg({
             'total_units': 'sum',
             'valid_energy_labels': 'sum'
         }).reset_index()
@@ -80,18 +82,18 @@ if __name__ == "__main__":
 
         # Save to Excel
         output_path = f"/app/output/{output_file}"
-        with pd.ExcelWriter(output_path, engine='openpyxl') as writer:
-            df.to_excel(writer, sheet_name='Municipality Data', index=False)
+        with ReportWriter(output_path) as writer:
+            writer.write_sheet(df, 'Municipality Data')
             
             # Create a summary sheet
             summary_df = pd.DataFrame({
                 'Metric': ['Total Units', 'Total Valid Energy Labels', 'Overall Percentage'],
                 'Value': [total_units, total_valid_labels, f"{overall_percentage:.2f}%"]
             })
-            summary_df.to_excel(writer, sheet_name='Overall Summary', index=False)
+            writer.write_sheet(summary_df, 'Overall Summary')
             
             # Add usage statistics to the Excel file
-            usage_stats.to_excel(writer, sheet_name='Usage Summary', index=False)
+            writer.write_sheet(usage_stats, 'Usage Summary')
         
         logging.info(f"Results saved to {output_path}")
 
@@ -99,4 +101,7 @@ if __name__ == "__main__":
         logging.error(f"An error occurred: {str(e)}")
         raise
 
-    logging.info("Script completed successfully")
\ No newline at end of file
+    logging.info("Script completed successfully")
+
+if __name__ == "__main__":
+    main()
@@ -1,8 +1,11 @@
-import json
 import pandas as pd
 import os
 import time
 import logging
+from es_reader import read_aggregation_output
+from report_writer import ReportWriter
+from table_cache import cached_table
+from flatten_aggs import flatten_buckets
 
 log_dir = '/app/logs'
 log_file = os.path.join(log_dir, 'year_extension_vs_construction.log')
@@ -13,10 +16,10 @@ if not os.path.exists(log_dir):
 logging.basicConfig(filename=log_file, level=logging.INFO, 
                     format='%(asctime)s - %(levelname)s - %(message)s')
 
+@cached_table
 def parse_elasticsearch_output(file_path):
     # Load Elasticsearch output from file
-    with open(file_path, 'r') as file:
-        data = json.load(file)
+    data, buckets = read_aggregation_output(file_path)
     
     # Check if query timed out and log a warning
     if data.get('timed_out'):
@@ -25,31 +28,14 @@ def parse_elasticsearch_output(file_path):
     total_hits = data['hits']['total']['value']
     logging.info(f"Total buildings with extension year < construction year: {total_hits}")
 
-    results = []
-    
     # If total_hits is zero, explicitly log that no data matches the criteria
     if total_hits == 0:
         logging.info("No data matches the criteria. Empty results will be saved.")
         return pd.DataFrame()  # Return an empty DataFrame
     
-    # Process municipality-level buckets
-    for municipality in data['aggregations']['municipalities']['buckets']:
-        municipality_code = municipality['key']
-
-        # Process unit usage buckets within the municipality
-        for usage in municipality['units_usage']['buckets']:
-            unit_usage = usage['key']
-            usage_count = usage['doc_count']
-
-            # Append the result
-            results.append({
-                'Municipality Code': municipality_code,
-                'Unit Usage': unit_usage,
-                'Count': usage_count
-            })
-
-    # Convert results to a Pandas DataFrame
-    return pd.DataFrame(results)
+    # One row per unit usage bucket within each municipality
+    return flatten_buckets(buckets, 'municipalities > units_usage', ['Municipality Code', 'Unit Usage'], count_column='Count',
+                           categorical=['Municipality Code', 'Unit Usage'])
 
 def retry_query(file_path, max_retries=3, delay=10):
     """Retry logic for parsing Elasticsearch query."""
@@ -63,7 +49,7 @@ def retry_query(file_path, max_retries=3, delay=10):
                 raise
             time.sleep(delay)
 
-if __name__ == "__main__":
+def main():
     try:
         input_file = os.environ.get('INPUT_FILE', 'year_extension_vs_construction.txt')
         output_file = os.environ.get('OUTPUT_FILE', 'year_extension_vs_construction.xlsx')
@@ -84,8 +70,8 @@ if __name__ == "__main__":
 
         # Save results to Excel (even if empty)
         output_path = f"/app/output/{output_file}"
-        with pd.ExcelWriter(output_path, engine='openpyxl') as writer:
-            df.to_excel(writer, sheet_name='Year Comparison Aggregation', index=False)
+        with ReportWriter(output_path) as writer:
+            writer.write_sheet(df, 'Year Comparison Aggregation')
 
         logging.info(f"Results saved to {output_path}")
 
@@ -94,3 +80,6 @@ if __name__ == "__main__":
         raise
 
     logging.info("Script completed successfully")
+
+if __name__ == "__main__":
+    main()
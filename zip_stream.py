@@ -0,0 +1,74 @@
+import io
+import os
+import zipfile
+
+# Files are read and compressed this many bytes at a time
+ZIP_CHUNK_SIZE = int(os.environ.get('ZIP_CHUNK_SIZE', 1024 * 1024))
+# Files that are compressed already (xlsx and parquet are zip/compressed
+# containers) are stored as they are instead of deflated again; set
+# ZIP_STORE_COMPRESSED=0 to deflate everything
+ZIP_STORE_COMPRESSED = os.environ.get('ZIP_STORE_COMPRESSED', '1').lower() in ('1', 'true', 'yes')
+COMPRESSED_EXTENSIONS = {'.xlsx', '.parquet', '.zip', '.gz', '.feather', '.png', '.jpg'}
+
+
+class _ChunkBuffer(io.RawIOBase):
+    """Write-only file that hands out what was written since the last take().
+
+    It cannot seek or tell, so zipfile writes every entry with a data
+    descriptor after its contents instead of going back to patch the header.
+    """
+
+    def __init__(self):
+        super().__init__()
+        self._chunks = []
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self._chunks.append(bytes(data))
+        return len(data)
+
+    def take(self):
+        data = b''.join(self._chunks)
+        self._chunks = []
+        return data
+
+
+def get_compress_type(path, store_compressed=None):
+    store_compressed = ZIP_STORE_COMPRESSED if store_compressed is None else store_compressed
+    if store_compressed and os.path.splitext(path)[1].lower() in COMPRESSED_EXTENSIONS:
+        return zipfile.ZIP_STORED
+    return zipfile.ZIP_DEFLATED
+
+
+def iter_zip(entries, store_compressed=None):
+    """Yield a ZIP archive of `entries` ((path, name in the archive) pairs) piece by piece.
+
+    Each file is read and compressed ZIP_CHUNK_SIZE bytes at a time and the
+    compressed bytes are yielded as they come, so the archive is never held
+    in memory and the first bytes go out before the last file is read.
+    """
+    buffer = _ChunkBuffer()
+    with zipfile.ZipFile(buffer, 'w') as zf:
+        for path, arcname in entries:
+            try:
+                info = zipfile.ZipInfo.from_file(path, arcname)
+            except FileNotFoundError:
+                # Removed since the entries were listed
+                continue
+            info.compress_type = get_compress_type(path, store_compressed)
+            with open(path, 'rb') as src, zf.open(info, 'w') as dst:
+                for chunk in iter(lambda: src.read(ZIP_CHUNK_SIZE), b''):
+                    dst.write(chunk)
+                    data = buffer.take()
+                    if data:
+                        yield data
+            # The end of the entry is written when it is closed
+            data = buffer.take()
+            if data:
+                yield data
+    # The central directory is written when the archive is closed
+    data = buffer.take()
+    if data:
+        yield data